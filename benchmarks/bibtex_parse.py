@@ -0,0 +1,77 @@
+"""
+Compare parsing a large bib file with bibtexparser against parse_bib's own
+tokenizer, serially and in parallel
+
+$ PYTHONPATH=. python benchmarks/bibtex_parse.py --entries 20000
+"""
+import argparse
+import random
+import tempfile
+import time
+from pathlib import Path
+
+from pedroai.bibtex import parse_bib
+
+WORDS = (
+    "neural attention language model question answering adversarial learning"
+    " transformer retrieval graph reasoning evaluation dataset benchmark"
+).split()
+
+
+def write_bib(path: Path, n_entries: int, seed: int = 0):
+    rng = random.Random(seed)
+    with open(path, "w") as f:
+        f.write('@string{acl = "Association for Computational Linguistics"}\n')
+        f.write(
+            '@string{emnlp = "Empirical Methods in Natural Language Processing"}\n\n'
+        )
+        for i in range(n_entries):
+            title = " ".join(rng.choice(WORDS) for _ in range(rng.randint(4, 12)))
+            authors = " and ".join(
+                f"Author{rng.randint(0, 5000)}, First" for _ in range(rng.randint(1, 6))
+            )
+            f.write(f"@inproceedings{{key{i},\n")
+            f.write(f"  title = {{{{{title.title()}}}: A {{Study}}}},\n")
+            f.write(f"  author = {{{authors}}},\n")
+            f.write(f"  booktitle = {rng.choice(['acl', 'emnlp'])},\n")
+            f.write(f"  year = {rng.randint(1990, 2023)},\n")
+            f.write(f"  month = {rng.choice(['jan', 'jun', 'nov'])},\n")
+            f.write(f'  pages = "{rng.randint(1, 500)}--{rng.randint(501, 900)}",\n')
+            f.write(
+                f"  abstract = {{We study {title}.\n    Results show {rng.random():.3f}"
+                " improvement.}\n"
+            )
+            f.write("}\n\n")
+
+
+def measure(name: str, parse):
+    start = time.perf_counter()
+    bib = parse()
+    print(f"{name:>14}: {time.perf_counter() - start:.2f}s")
+    return bib
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entries", type=int, default=20_000)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = Path(tmp_dir) / "large.bib"
+        write_bib(path, args.entries)
+        print(f"{args.entries} entries, {path.stat().st_size / 2**20:.1f} MiB")
+        slow = measure("bibtexparser", lambda: parse_bib(path, fast=False))
+        serial = measure("fast", lambda: parse_bib(path, workers=1))
+        parallel = measure(
+            f"fast {args.workers} workers",
+            lambda: parse_bib(path, workers=args.workers),
+        )
+        for bib in (serial, parallel):
+            assert slow.entries == bib.entries
+            assert slow.strings == bib.strings
+            assert slow.comments == bib.comments
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""
+Compare reading wide jsonlines records in full against reading two fields with
+read_jsonlines(fields=...)
+
+$ python benchmarks/jsonl_projection.py --records 100000 --width 200
+"""
+import argparse
+import json
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+from pedroai.io import read_jsonlines
+
+
+def write_wide_jsonlines(path: Path, n_records: int, width: int):
+    with open(path, "w") as f:
+        for i in range(n_records):
+            features = {
+                f"feature_{j}": {"value": j * 0.5, "name": f"feature {j}"}
+                for j in range(width)
+            }
+            f.write(json.dumps({"id": i, "label": i % 7, **features}))
+            f.write("\n")
+
+
+def measure(name: str, read):
+    tracemalloc.start()
+    start = time.perf_counter()
+    records = read()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:>10}: {elapsed:.2f}s, peak memory {peak / 2**20:.1f} MiB")
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--records", type=int, default=100_000)
+    parser.add_argument("--width", type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = Path(tmp_dir) / "wide.jsonl"
+        write_wide_jsonlines(path, args.records, args.width)
+        print(f"{args.records} records, {path.stat().st_size / 2**20:.1f} MiB")
+        full = measure("full", lambda: read_jsonlines(path))
+        projected = measure(
+            "projected", lambda: read_jsonlines(path, fields=["id", "label"])
+        )
+        assert [{"id": r["id"], "label": r["label"]} for r in full] == projected
+
+
+if __name__ == "__main__":
+    main()
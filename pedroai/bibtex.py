@@ -1,77 +1,786 @@
 import re
 import copy
-from typing import List
+import functools
+import hashlib
+import os
+import pickle
+import shutil
+import tempfile
+import unicodedata
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple, Union
 from pathlib import Path
 
 import bibtexparser
+import numpy as np
 import typer
 import tantivy
 from rich.console import Console
 
+from pedroai import io
+
 app = typer.Typer()
 console = Console()
 
-def parse_bib(filename):
-    parser = bibtexparser.bparser.BibTexParser(
+# Bump when the schema or the saved files change, so old persisted indexes are not used
+BIB_INDEX_VERSION = 1
+BIB_INDEX_DIR = os.path.join(io.CACHE_DIR, 'bibtex_index')
+# Bump when the tokenized items or the formatting change, so old format caches are not used
+FORMAT_CACHE_VERSION = 1
+
+# MinHash signatures of title character 3-grams, split into LSH bands of rows.
+# Titles with 3-gram Jaccard similarity s share a band with probability
+# 1 - (1 - s^rows)^bands, which for 32 bands of 4 rows is 0.5 at s=0.38
+MINHASH_PERMUTATIONS = 128
+LSH_BANDS = 32
+MINHASH_PRIME = (1 << 31) - 1
+# Buckets with more entries than this are not compared pairwise, they are too generic
+MAX_BUCKET_SIZE = 50
+SIMILARITY_BLOCK = 1 << 16
+# The standard fields of each BibTeX entry type, from btxdoc. When duplicates are
+# merged, standard fields are only copied to entries whose type has them, so an
+# @article does not get a booktitle. Other fields, like doi, are always copied.
+_NOTE = ('month', 'note', 'year')
+_BOOK = ('address', 'edition', 'editor', 'number', 'publisher', 'series', 'volume')
+ENTRY_FIELDS = {
+    'article': {'author', 'journal', 'number', 'pages', 'title', 'volume', *_NOTE},
+    'book': {'author', 'title', *_BOOK, *_NOTE},
+    'booklet': {'address', 'author', 'howpublished', 'title', *_NOTE},
+    'inbook': {'author', 'chapter', 'pages', 'title', 'type', *_BOOK, *_NOTE},
+    'incollection': {
+        'author', 'booktitle', 'chapter', 'pages', 'title', 'type', *_BOOK, *_NOTE
+    },
+    'inproceedings': {
+        'address', 'author', 'booktitle', 'editor', 'number', 'organization', 'pages',
+        'publisher', 'series', 'title', 'volume', *_NOTE,
+    },
+    'manual': {'address', 'author', 'edition', 'organization', 'title', *_NOTE},
+    'mastersthesis': {'address', 'author', 'school', 'title', 'type', *_NOTE},
+    'misc': {'author', 'howpublished', 'title', *_NOTE},
+    'proceedings': {
+        'address', 'editor', 'number', 'organization', 'publisher', 'series', 'title',
+        'volume', *_NOTE,
+    },
+    'techreport': {'address', 'author', 'institution', 'number', 'title', 'type', *_NOTE},
+    'unpublished': {'author', 'title', *_NOTE},
+}
+ENTRY_FIELDS['conference'] = ENTRY_FIELDS['inproceedings']
+ENTRY_FIELDS['phdthesis'] = ENTRY_FIELDS['mastersthesis']
+_STANDARD_FIELDS = set().union(*ENTRY_FIELDS.values())
+DOI_PATTERN = re.compile(r'(10\.\d{4,9}/[^\s,}]+)')
+ARXIV_PATTERN = re.compile(
+    r'arxiv(?:\.org/(?:abs|pdf)/|[:/ .]\s*)([a-z\-]+/\d{7}|\d{4}\.\d{4,5})', re.IGNORECASE
+)
+
+# Tokens of the bibtex grammar of bibtexparser, which tokenizes with pyparsing
+BIB_BATCH_SIZE = 1 << 20
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+# Comments end before an @ that starts a line
+_BOUNDARY = re.compile(r'\n[ \t\r\n]*@')
+_BRACES = re.compile(r'[{}]')
+_QUOTE_OR_BRACES = re.compile(r'["{}]')
+_INTEGER = re.compile(r'[0-9]+')
+_STRING_NAME = re.compile(r'[A-Za-z0-9_\-:]+')
+_FIELD_NAME = re.compile(r'([A-Za-z0-9_\-().+]+)[ \t\n\r]*=[ \t\n\r]*')
+# A field with a number or a string without nested braces, not followed by #
+_SIMPLE_FIELD = re.compile(
+    r'([A-Za-z0-9_\-().+]+)[ \t\n\r]*=[ \t\n\r]*'
+    r'(?:\{([^{}]*)\}|"([^"{}]*)"|([0-9]+))(?![ \t\n\r]*#)'
+)
+_ENTRY_START = re.compile(r'@[ \t\n\r]*([A-Za-z]+)[ \t\n\r]*([{(])[ \t\n\r]*')
+_STRING_START = re.compile(
+    r'(?i:@string)(?![A-Za-z0-9_$])[ \t\n\r]*([{(])[ \t\n\r]*'
+    r'([A-Za-z0-9_\-:]+)[ \t\n\r]*=[ \t\n\r]*'
+)
+_PREAMBLE_START = re.compile(r'(?i:@preamble)(?![A-Za-z0-9_$])[ \t\n\r]*([{(])[ \t\n\r]*')
+_COMMENT_START = re.compile(r'(?i:@comment)(?![A-Za-z0-9_$])')
+_CLOSE = {'{': '}', '(': ')'}
+
+
+def parse_bib(filename, fast: bool = True, workers: Optional[int] = None):
+    """
+    Parse a bib file with its @strings and the common month strings interpolated.
+
+    By default the file is parsed with parse_bib_string, which gives the same
+    database as bibtexparser much faster, and with fast=False by bibtexparser.
+    """
+    if not fast:
+        with open(filename, 'r') as f:
+            bib = bibtexparser.load(f, parser=_bibtexparser())
+            return bib
+    with open(filename, 'r') as f:
+        text = f.read()
+    try:
+        return parse_bib_string(text, workers=workers)
+    except _Unsupported:
+        return parse_bib(filename, fast=False)
+
+
+def _bibtexparser():
+    return bibtexparser.bparser.BibTexParser(
         ignore_nonstandard_types=False,
         interpolate_strings=True,
         common_strings=True,
     )
-    with open(filename, 'r') as f:
-        bib = bibtexparser.load(f, parser=parser)
-        return bib
 
 
+def parse_bib_string(text: str, workers: Optional[int] = None, batch_size: int = BIB_BATCH_SIZE):
+    """
+    Parse bibtex into the same BibDatabase as parse_bib(..., fast=False), without
+    a grammar engine.
+
+    The text is split before @s that start a line, the only places where
+    bibtexparser ends a comment. With more than one worker, text longer than
+    batch_size is split into up to workers batches that are tokenized in a
+    process pool. An item that might continue past the end of its batch, like an
+    entry with a line starting with @ in a braced value, is parsed again from the
+    full text.
+    """
+    text = _prepare(text)
+    workers = (os.cpu_count() or 1) if workers is None else workers
+    starts = _batch_starts(text, min(workers, len(text) // batch_size))
+    if len(starts) == 1:
+        items, _ = _parse_items(text, 0, len(text))
+        return _bib_database(items)
+
+    ends = starts[1:] + [len(text)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        batches = executor.map(
+            _parse_batch, [text[start:end] for start, end in zip(starts, ends)],
+            [end < len(text) for end in ends],
+        )
+        return _bib_database(_join_batches(text, starts, batches))
+
+
+def parse_bib_cached(text: str, chunks: dict) -> Tuple:
+    """
+    Parse like parse_bib_string, splitting text before every @ that starts a line
+    and reusing the tokenized chunks in chunks, keyed by the hash of their text.
+    Returns the database and the chunks of this text, to pass to the next call.
+    """
+    text = _prepare(text)
+    starts = [0] + [m.end() - 1 for m in _BOUNDARY.finditer(text)]
+    ends = starts[1:] + [len(text)]
+    used = {}
+    batches = []
+    for start, end in zip(starts, ends):
+        chunk = text[start:end]
+        key = (hashlib.sha256(chunk.encode()).digest(), end < len(text))
+        if key not in used:
+            used[key] = chunks[key] if key in chunks else _parse_batch(chunk, end < len(text))
+        batches.append(used[key])
+    return _bib_database(_join_batches(text, starts, batches)), used
+
+
+def _prepare(text: str) -> str:
+    if text.startswith('\ufeff'):
+        text = text[1:]
+    # pyparsing expands tabs before parsing, which changes values containing them
+    return text.expandtabs()
+
+
+def _batch_starts(text: str, n_batches: int) -> List[int]:
+    starts = [0]
+    for i in range(1, n_batches):
+        m = _BOUNDARY.search(text, max(len(text) * i // n_batches, starts[-1]))
+        if m is None:
+            break
+        if m.end() - 1 > starts[-1]:
+            starts.append(m.end() - 1)
+    return starts
+
+
+def _parse_batch(text: str, partial: bool) -> Tuple[list, int]:
+    return _parse_items(text, 0, len(text), partial=partial)
+
+
+def _join_batches(text: str, starts: List[int], batches) -> list:
+    ends = starts[1:] + [len(text)]
+    items = []
+    pos = 0
+    for start, end, (batch_items, batch_pos) in zip(starts, ends, batches):
+        if pos == start:
+            items.extend(batch_items)
+            pos = start + batch_pos
+        # Otherwise the last item of the previous batch continued into this one
+        if pos < end:
+            more, pos = _parse_items(text, pos, end)
+            items.extend(more)
+    return items
+
+
+def _bib_database(items: list):
+    bib = bibtexparser.bibdatabase.BibDatabase()
+    bib.load_common_strings()
+    for kind, *args in items:
+        if kind == 'entry':
+            bib.entries.extend(args)
+        elif kind == 'unresolved_entry':
+            entry_type, key, fields = args
+            fields = {name: _interpolate(value, bib) for name, value in fields.items()}
+            bib.entries.append(_entry(entry_type, key, fields))
+        elif kind == 'string':
+            name, value = args
+            bib.strings[name] = _interpolate(value, bib)
+        elif kind == 'preamble':
+            bib.preambles.extend(args)
+        else:
+            bib.comments.extend(args)
+    return bib
+
+
+class _ParseFailure(Exception):
+    pass
+
+
+class _Truncated(Exception):
+    pass
+
+
+class _Unsupported(Exception):
+    """Input that parse_bib leaves to bibtexparser"""
+
+
+class _Name(NamedTuple):
+    """Reference to an @string in a value"""
+    name: str
+
+
+def _skip(text: str, pos: int) -> int:
+    # _WHITESPACE matches the empty string, so it always matches
+    return _WHITESPACE.match(text, pos).end()  # type: ignore
+
+
+def _strip_after_new_lines(value: str) -> str:
+    lines = value.splitlines()
+    if len(lines) > 1:
+        lines = [lines[0]] + [line.lstrip() for line in lines[1:]]
+    return '\n'.join(lines)
+
+
+def _interpolate(value, bib) -> str:
+    if isinstance(value, str):
+        return value
+    return ''.join(bib.expand_string(p.name) if isinstance(p, _Name) else p for p in value)
+
+
+def _braced(text: str, pos: int) -> Tuple[str, int]:
+    depth = 0
+    for m in _BRACES.finditer(text, pos):
+        if m.group() == '{':
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 0:
+                return text[pos + 1:m.start()], m.end()
+    raise _ParseFailure()
+
+
+def _quoted(text: str, pos: int) -> Tuple[str, int]:
+    depth = 0
+    for m in _QUOTE_OR_BRACES.finditer(text, pos + 1):
+        c = m.group()
+        if c == '{':
+            depth += 1
+        elif c == '}':
+            if depth == 0:
+                raise _ParseFailure()
+            depth -= 1
+        elif depth == 0:
+            return text[pos + 1:m.start()], m.end()
+    raise _ParseFailure()
+
+
+def _parse_value(text: str, pos: int, integer: bool = True) -> Tuple[list, int]:
+    """
+    Parse a number, or quoted or braced strings and @string names joined by #,
+    into a list of pieces
+    """
+    if integer:
+        m = _INTEGER.match(text, pos)
+        if m is not None:
+            return [m.group()], m.end()
+    pieces = []
+    piece: Union[str, _Name]
+    while True:
+        c = text[pos:pos + 1]
+        if c == '{':
+            piece, pos = _braced(text, pos)
+        elif c == '"':
+            piece, pos = _quoted(text, pos)
+        else:
+            m = _STRING_NAME.match(text, pos)
+            if m is None:
+                raise _ParseFailure()
+            piece, pos = _Name(m.group().lower()), m.end()
+        pieces.append(piece)
+        after = _skip(text, pos)
+        if not text.startswith('#', after):
+            return pieces, pos
+        pos = _skip(text, after + 1)
+
+
+def _as_value(pieces: list):
+    """
+    A single string as bibtexparser cleans it, or a tuple of pieces to
+    interpolate once the @strings defined before it are known
+    """
+    if len(pieces) == 1 and not isinstance(pieces[0], _Name):
+        return '' if pieces[0] == '{}' else pieces[0]
+    return tuple(pieces)
+
+
+def _parse_field(text: str, pos: int) -> Tuple[tuple, int]:
+    m = _SIMPLE_FIELD.match(text, pos)
+    if m is not None:
+        # The last group that matched is the value
+        value = m.group(m.lastindex)  # type: ignore
+        return (m.group(1), _strip_after_new_lines(value)), m.end()
+    m = _FIELD_NAME.match(text, pos)
+    if m is None:
+        raise _ParseFailure()
+    pieces, pos = _parse_value(text, m.end())
+    pieces = [p if isinstance(p, _Name) else _strip_after_new_lines(p) for p in pieces]
+    return (m.group(1), _as_value(pieces)), pos
+
+
+def _parse_entry(text: str, pos: int) -> Tuple[tuple, int]:
+    m = _ENTRY_START.match(text, pos)
+    if m is None:
+        raise _ParseFailure()
+    comma = text.find(',', m.end())
+    key = text[m.end():comma].strip()
+    if comma == -1 or key.split() != [key]:
+        raise _ParseFailure()
+    close = _CLOSE[m.group(2)]
+    field, pos = _parse_field(text, _skip(text, comma + 1))
+    parsed = [field]
+    while True:
+        pos = _skip(text, pos)
+        if text.startswith(',', pos):
+            try:
+                field, pos = _parse_field(text, _skip(text, pos + 1))
+                parsed.append(field)
+                continue
+            except _ParseFailure:
+                # A trailing comma
+                pos = _skip(text, pos + 1)
+        if not text.startswith(close, pos):
+            raise _ParseFailure()
+        break
+    # Like bibtexparser keep the first of repeated fields, in reverse order
+    fields = dict(reversed(parsed))
+    if any(not isinstance(value, str) for value in fields.values()):
+        return ('unresolved_entry', m.group(1), key, fields), pos + 1
+    return ('entry', _entry(m.group(1), key, fields)), pos + 1
+
+
+def _entry(entry_type: str, key: str, fields: dict) -> dict:
+    entry = {name.lower(): value for name, value in fields.items()}
+    entry['ENTRYTYPE'] = entry_type.lower()
+    entry['ID'] = key
+    return entry
+
+
+def _parse_string(text: str, pos: int) -> Tuple[tuple, int]:
+    m = _STRING_START.match(text, pos)
+    if m is None:
+        raise _ParseFailure()
+    pieces, pos = _parse_value(text, m.end(), integer=False)
+    pos = _skip(text, pos)
+    if not text.startswith(_CLOSE[m.group(1)], pos):
+        raise _ParseFailure()
+    return ('string', m.group(2).lower(), _as_value(pieces)), pos + 1
+
+
+def _parse_preamble(text: str, pos: int) -> Tuple[tuple, int]:
+    m = _PREAMBLE_START.match(text, pos)
+    if m is None:
+        raise _ParseFailure()
+    pieces, pos = _parse_value(text, m.end())
+    pos = _skip(text, pos)
+    if not text.startswith(_CLOSE[m.group(1)], pos):
+        raise _ParseFailure()
+    if len(pieces) != 1 or isinstance(pieces[0], _Name):
+        # bibtexparser keeps these as uninterpolated expressions
+        raise _Unsupported('@preamble with @string names')
+    return ('preamble', pieces[0]), pos + 1
+
+
+def _comment(text: str, pos: int) -> Tuple[str, int]:
+    m = _BOUNDARY.search(text, pos)
+    end = len(text) if m is None else m.start()
+    return text[pos:end].rstrip(' \t\r\n'), end
+
+
+def _parse_item(text: str, pos: int, partial: bool) -> Tuple[tuple, int]:
+    if text.startswith('@', pos):
+        for parse in (_parse_string, _parse_preamble):
+            try:
+                return parse(text, pos)
+            except _ParseFailure:
+                pass
+        m = _COMMENT_START.match(text, pos)
+        if m is not None:
+            start = _skip(text, m.end())
+            if partial and start == len(text):
+                raise _Truncated()
+            comment, end = _comment(text, start)
+            if comment.startswith('{'):
+                comment = comment[1:]
+            if comment.endswith('}'):
+                comment = comment[:-1]
+            return ('comment', comment), end
+        try:
+            return _parse_entry(text, pos)
+        except _ParseFailure as e:
+            if partial:
+                # It might be complete in the full text
+                raise _Truncated() from e
+    comment, end = _comment(text, pos)
+    return ('comment', comment), end
+
+
+def _parse_items(text: str, pos: int, end: int, partial: bool = False) -> Tuple[list, int]:
+    """
+    Parse the items of text that start before end, returning them and the
+    position after the last one. With partial, stop before an item that might
+    continue past the end of text.
+    """
+    items = []
+    pos = _skip(text, pos)
+    while pos < end:
+        try:
+            item, next_pos = _parse_item(text, pos, partial)
+        except _Truncated:
+            break
+        items.append(item)
+        pos = _skip(text, next_pos)
+    return items, pos
+
+
+def title_schema():
+    schema_builder = tantivy.SchemaBuilder()
+    schema_builder.add_text_field("title", stored=True, tokenizer_name='en_stem')
+    schema_builder.add_text_field("id", stored=True, tokenizer_name='raw')
+    return schema_builder.build()
+
+
+def build_title_index(entries: List[dict], path: Optional[str] = None):
+    """
+    Index the title and ID of every entry with a single commit, in memory or in the
+    directory at path
+    """
+    index = tantivy.Index(title_schema(), path=path)
+    writer = index.writer()
+    for e in entries:
+        writer.add_document(tantivy.Document(title=e.get('title', ''), id=e['ID']))
+    writer.commit()
+    writer.wait_merging_threads()
+    index.reload()
+    return index
+
+
+def _bib_hash(filename) -> str:
+    hasher = hashlib.sha256(f'{BIB_INDEX_VERSION}\n'.encode())
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def load_indexed_bib(filename, persist: bool = False, index_dir: str = BIB_INDEX_DIR) -> Tuple:
+    """
+    Parse a bib file and index its titles, returning the database and the index.
+
+    If persist is True, the parsed database and the index are saved under
+    index_dir in a directory named by the hash of the file, and later calls with
+    the same file contents load them instead of parsing and indexing again.
+    """
+    if not persist:
+        bib = parse_bib(filename)
+        return bib, build_title_index(bib.entries)
+
+    directory = os.path.join(index_dir, _bib_hash(filename))
+    if not os.path.exists(directory):
+        bib = parse_bib(filename)
+        os.makedirs(index_dir, exist_ok=True)
+        # Build in a temporary directory that is renamed when complete, so a
+        # partially written index is never used
+        temp_dir = tempfile.mkdtemp(dir=index_dir, prefix='.tmp-')
+        try:
+            os.mkdir(os.path.join(temp_dir, 'index'))
+            build_title_index(bib.entries, os.path.join(temp_dir, 'index'))
+            with open(os.path.join(temp_dir, 'bib.pkl'), 'wb') as f:
+                pickle.dump(bib, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.rename(temp_dir, directory)
+        except OSError:
+            # Another merge persisted the same file first
+            if not os.path.exists(directory):
+                raise
+        finally:
+            if os.path.exists(temp_dir):
+                shutil.rmtree(temp_dir)
+    else:
+        console.log(f"Using persisted index of {filename}: {directory}")
+    with open(os.path.join(directory, 'bib.pkl'), 'rb') as f:
+        bib = pickle.load(f)
+    return bib, tantivy.Index.open(os.path.join(directory, 'index'))
 
 
 @app.command('format')
-def format_bibtex(input_file: Path, output_file: Path):
-    writer = bibtexparser.bwriter.BibTexWriter()
-    writer.order_entries_by = ('ENTRYTYPE', 'year', 'title')
-    writer.indent = '    '
-    writer.add_trailing_comma = True
-    bib = parse_bib(input_file)
-    out = writer.write(bib)
+def format_bibtex(
+    input_file: Path,
+    output_file: Optional[Path] = typer.Argument(None),
+    check: bool = False,
+    cache: bool = True,
+):
+    """
+    Format input_file, sorting entries by type, year and title, and write it to
+    output_file, by default input_file. Nothing is written if output_file would
+    not change. With --check nothing is written either, and the exit code is 1
+    if output_file would change.
+
+    Unless --no-cache is given, the tokenized text and the rendered entries are
+    cached by their hash. Unchanged entries are not parsed or rendered again,
+    and if input_file and output_file are what the last run read and wrote, the
+    file is not formatted at all.
+    """
+    output_file = input_file if output_file is None else output_file
+    with open(input_file, 'r') as f:
+        text = f.read()
+    current = None
+    if os.path.exists(output_file):
+        with open(output_file, 'r') as f:
+            current = f.read()
+    cache_path = format_cache_path(input_file) if cache else None
+    header = _read_format_cache(cache_path, header_only=True)
+    if (
+        current is not None
+        and header.get('input') == _text_hash(text)
+        and header.get('output') == _text_hash(current)
+    ):
+        out = current
+    else:
+        out = format_bib_text(text, cache_path=cache_path)
+
+    if out == current:
+        return
+    if check:
+        console.print(f"Formatting would change: {output_file}")
+        raise typer.Exit(code=1)
     with open(output_file, 'w') as f:
         f.write(out)
 
+
+def format_cache_path(input_file: Path) -> str:
+    key = hashlib.sha256(os.path.abspath(input_file).encode('utf8')).hexdigest()[:32]
+    return os.path.join(io.CACHE_DIR, 'bibtex_format', f'{key}.pkl')
+
+
+def _text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode('utf8')).hexdigest()
+
+
+def _read_format_cache(cache_path: Optional[str], header_only: bool = False) -> dict:
+    # The header is pickled before the chunks and entries, so it can be read alone
+    if cache_path is None or not os.path.exists(cache_path):
+        return {}
+    with open(cache_path, 'rb') as f:
+        cache = pickle.load(f)
+        if cache.get('version') != FORMAT_CACHE_VERSION:
+            return {}
+        if not header_only:
+            cache.update(pickle.load(f))
+    return cache
+
+
+def format_bib_text(text: str, cache_path: Optional[str] = None) -> str:
+    """
+    Format bibtex text like write_bib(parse_bib(...)) does.
+
+    If cache_path is given, the tokenized chunks and the rendered entries of the
+    previous call are loaded from it and reused, and the ones of this text are
+    saved to it with the hashes of text and the output.
+    """
+    cache = _read_format_cache(cache_path)
+    try:
+        bib, chunks = parse_bib_cached(text, cache.get('chunks', {}))
+    except _Unsupported:
+        bib, chunks = bibtexparser.loads(text, parser=_bibtexparser()), {}
+    writer = _format_writer(_CachedWriter(cache.get('rendered', {})))
+    out = writer.write(bib)
+    if cache_path is not None:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with io.atomic_path(cache_path) as temp_path, open(temp_path, 'wb') as f:
+            header = {
+                'version': FORMAT_CACHE_VERSION,
+                'input': _text_hash(text),
+                'output': _text_hash(out),
+            }
+            pickle.dump(header, f, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump(
+                {'chunks': chunks, 'rendered': writer.used}, f, protocol=pickle.HIGHEST_PROTOCOL
+            )
+    return out
+
+
+class _CachedWriter(bibtexparser.bwriter.BibTexWriter):
+    """
+    BibTexWriter that reuses the text of entries it rendered before, keyed by
+    their fields, and records the entries it writes in used
+    """
+
+    def __init__(self, rendered: dict):
+        super().__init__()
+        self.rendered = rendered
+        self.used: Dict[tuple, str] = {}
+
+    def _entry_to_bibtex(self, entry):
+        key = tuple(entry.items())
+        text = self.rendered.get(key)
+        if text is None:
+            text = super()._entry_to_bibtex(entry)
+        self.used[key] = text
+        return text
+
+
 @app.command('merge')
-def merge_bibtex(input_files: List[Path], output_file: Path):
+def merge_bibtex(
+    input_files: List[Path],
+    output_file: Path,
+    persist_index: bool = False,
+    index_dir: str = BIB_INDEX_DIR,
+    batch: bool = False,
+    report_file: Optional[Path] = None,
+    threshold: float = 0.5,
+    auto_merge: float = 0.9,
+    new_only: bool = False,
+    workers: int = os.cpu_count() or 1,
+):
+    """
+    Merge the entries of all input files into output_file, see merge_bibs.
+    Entries of the first file are always kept with their keys. Entries of later
+    files that are identical to an earlier one are dropped, duplicates with at
+    least --auto-merge confidence are merged into the entry from the earliest
+    file, and entries whose key is taken by a different entry get a new key.
+    Files are parsed by a pool of --workers processes, and duplicate clusters
+    with at least --threshold confidence and renamed keys are written to
+    --report-file. With --new-only, entries from the first file are not written.
+
+    Unless --batch is given, each entry that is not from the first file is shown
+    with the most similar entry of the first file. With --persist-index, the
+    index of the first file is saved under --index-dir and reused by later merges
+    against the same file.
+    """
     if len(input_files) == 0:
         raise ValueError("Must provide at least one input file")
-    schema_builder = tantivy.SchemaBuilder()
-    schema_builder.add_text_field("title", stored=True, tokenizer_name='en_stem')
-    schema_builder.add_text_field("id", stored=True, tokenizer_name='raw')
-    schema =  schema_builder.build()
-    index = tantivy.Index(schema)
-    writer = index.writer()
+    if batch and persist_index:
+        raise ValueError("The index is only used by interactive merges, not with --batch")
+    if batch:
+        bibs = parse_bibs(input_files, workers=workers)
+    else:
+        first_bib, index = load_indexed_bib(
+            input_files[0], persist=persist_index, index_dir=index_dir
+        )
+        bibs = [first_bib] + parse_bibs(input_files[1:], workers=workers)
+    for f, bib in zip(input_files, bibs):
+        console.print(f"Entries in {f}: {len(bib.entries)}")
 
-    first_bib = parse_bib(input_files[0])
-    key_to_entry = first_bib.entries_dict
-    for e in first_bib.entries:
-        writer.add_document(tantivy.Document(title=e['title'], id=e['ID']))
-        writer.commit()
-    searcher = index.searcher()
+    entries, origins, report = merge_bibs(
+        bibs, [str(f) for f in input_files], threshold=threshold, auto_merge=auto_merge
+    )
+    console.print(
+        f"Entries: {report['entries']} Identical: {report['identical_entries']}"
+        f" Duplicate clusters: {report['clusters']} Merged: {report['merged_clusters']}"
+        f" Renamed keys: {len(report['renamed'])} Merged entries: {len(entries)}"
+    )
+    if report_file is not None:
+        console.print(f"Writing merge report to: {report_file}")
+        io.write_json(report_file, report)
+    if not batch:
+        _show_similar([e for e, i in zip(entries, origins) if i != 0], index, bibs[0].entries_dict)
+    if new_only:
+        entries = [e for e, i in zip(entries, origins) if i != 0]
 
-    path_to_bib = {}
-    for f in input_files[1:]:
-        bib = parse_bib(f)
-        path_to_bib[f] = bib
-        total = len(bib.entries)
-        skipped = 0
-        new_entries = {}
+    console.print(f"Outputting {len(entries)} entries to: {output_file}")
+    db = bibtexparser.bibdatabase.BibDatabase()
+    for bib in bibs:
+        for key, value in bib.strings.items():
+            db.strings.setdefault(key, value)
+    db.entries = entries
+    write_bib(db, output_file)
+
+
+def parse_bibs(filenames: List[Path], workers: int = 1) -> list:
+    """Parse bib files, in a pool of workers processes if there are several"""
+    if workers <= 1 or len(filenames) <= 1:
+        return [parse_bib(f) for f in filenames]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(functools.partial(parse_bib, workers=1), filenames))
+
+
+def merge_bibs(
+    bibs: list, sources: List[str], threshold: float = 0.5, auto_merge: float = 0.9
+) -> Tuple[List[dict], List[int], dict]:
+    """
+    Merge the entries of the databases in bibs into the first. The entries of the
+    first database are all kept with their keys, since papers cite them. Entries
+    of later databases with the same key and fields as an earlier entry are
+    dropped, then their duplicates, of each other or of the first database's
+    entries, are found and merged at once like dedup_entries. Finally an entry of
+    a later database whose key is used by an earlier entry gets the key with the
+    first free suffix of _2, _3, and so on. Returns the merged entries, the index
+    of the database each came from, and a json serializable report.
+    """
+    entries = list(bibs[0].entries)
+    entry_sources = [sources[0]] * len(entries)
+    origins = [0] * len(entries)
+    seen = {tuple(sorted(entry.items())) for entry in entries}
+    for i, bib in enumerate(bibs[1:], 1):
         for entry in bib.entries:
-            if entry['ID'] in key_to_entry or entry['ID'] in new_entries:
-                skipped += 1
-            else:
-                new_entries[entry['ID']] = f, entry
-        console.print(f"Entries in {f}, Total: {total} New: {len(new_entries)} Skipped: {skipped}")
-    
+            key = tuple(sorted(entry.items()))
+            if key not in seen:
+                seen.add(key)
+                entries.append(entry)
+                entry_sources.append(sources[i])
+                origins.append(i)
+    kept, report = _dedup(
+        entries, entry_sources, threshold=threshold, auto_merge=auto_merge,
+        fixed=len(bibs[0].entries),
+    )
+
+    taken = {entry['ID'] for _, entry in kept}
+    used = {entry['ID'] for i, entry in kept if origins[i] == 0}
+    renamed = []
+    merged = []
+    for i, entry in kept:
+        if origins[i] != 0 and entry['ID'] in used:
+            suffix = 2
+            while f"{entry['ID']}_{suffix}" in taken:
+                suffix += 1
+            new_id = f"{entry['ID']}_{suffix}"
+            taken.add(new_id)
+            renamed.append({'ID': entry['ID'], 'new_ID': new_id, 'source': entry_sources[i]})
+            entry = dict(entry, ID=new_id)
+        used.add(entry['ID'])
+        merged.append(entry)
+    n_entries = sum(len(bib.entries) for bib in bibs)
+    report = dict(
+        report, inputs=sources, entries=n_entries, identical_entries=n_entries - len(entries),
+        renamed=renamed,
+    )
+    return merged, [origins[i] for i, _ in kept], report
+
+
+def _show_similar(new_entries: List[dict], index, key_to_entry: dict):
+    searcher = index.searcher()
     console.rule(style='red bold')
-    for _, (_, entry) in new_entries.items():
+    for entry in new_entries:
         console.rule("Potentially new entry")
         console.print(entry)
-        normalized_title = re.sub(r"[^A-Za-z0-9 ]+", " ", entry["title"]).lower()
+        normalized_title = re.sub(r"[^A-Za-z0-9 ]+", " ", entry.get("title", "")).lower()
         query = index.parse_query(normalized_title, ['title'])
         similar = searcher.search(query, 1).hits
         if len(similar) > 0:
@@ -80,16 +789,364 @@ def merge_bibtex(input_files: List[Path], output_file: Path):
             console.rule("Most similar existing entry")
             console.print(key_to_entry[similar_bib['id'][0]])
         console.rule(style='red bold')
-    console.print(f"Outputting new entry candidates to: {output_file}")
-    new_db = bibtexparser.bibdatabase.BibDatabase()
-    new_db.strings = copy.deepcopy(first_bib.strings)
-    for _, entry in new_entries.values():
-        new_db.entries.append(entry)
 
-    writer = bibtexparser.bwriter.BibTexWriter()
+
+def normalize_title(title: str) -> str:
+    """
+    Lowercase a title and reduce it to ascii letters, digits and single spaces,
+    dropping latex commands, braces and accents
+    """
+    title = re.sub(r'\\(?:[a-zA-Z]+|.)', '', title).replace('{', '').replace('}', '')
+    title = unicodedata.normalize('NFKD', title).encode('ascii', 'ignore').decode()
+    return re.sub(r'[^a-z0-9]+', ' ', title.lower()).strip()
+
+
+def _first_author(entry: dict) -> str:
+    authors = entry.get('author', '').split(' and ')[0]
+    last_name = authors.split(',')[0] if ',' in authors else authors
+    words = normalize_title(last_name).split()
+    return words[-1] if len(words) > 0 else ''
+
+
+def _year(entry: dict) -> Optional[int]:
+    match = re.search(r'\d{4}', entry.get('year', ''))
+    return None if match is None else int(match.group())
+
+
+def _doi(entry: dict) -> Optional[str]:
+    for field in ('doi', 'url'):
+        match = DOI_PATTERN.search(entry.get(field, ''))
+        if match is not None:
+            return match.group(1).lower().rstrip('.')
+    return None
+
+
+def _arxiv_id(entry: dict) -> Optional[str]:
+    eprint = entry.get('eprint', '').strip()
+    if re.fullmatch(r'\d{4}\.\d{4,5}(v\d+)?|[a-z\-]+/\d{7}(v\d+)?', eprint):
+        return re.sub(r'v\d+$', '', eprint)
+    for field in ('journal', 'url', 'doi', 'note', 'volume'):
+        match = ARXIV_PATTERN.search(entry.get(field, ''))
+        if match is not None:
+            return match.group(1).lower()
+    return None
+
+
+def minhash_signatures(titles: List[str], seed: int = 0) -> np.ndarray:
+    """
+    Return a (len(titles), MINHASH_PERMUTATIONS) array of MinHash signatures of the
+    character 3-grams of normalized titles. Empty titles get a signature of all
+    MINHASH_PRIME, which never matches a real title.
+    """
+    rng = np.random.RandomState(seed)
+    a = rng.randint(1, MINHASH_PRIME, size=(MINHASH_PERMUTATIONS, 1)).astype(np.uint64)
+    b = rng.randint(0, MINHASH_PRIME, size=(MINHASH_PERMUTATIONS, 1)).astype(np.uint64)
+    signatures = np.full((len(titles), MINHASH_PERMUTATIONS), MINHASH_PRIME, dtype=np.uint64)
+    # Normalized titles are ascii, so each 3-gram packs into 24 bits
+    grams, rows = [], []
+    for i, title in enumerate(titles):
+        if len(title) == 0:
+            continue
+        data = np.frombuffer(f' {title} '.encode(), dtype=np.uint8).astype(np.uint64)
+        grams.append(data[:-2] << np.uint64(16) | data[1:-1] << np.uint64(8) | data[2:])
+        rows.append(i)
+    # Hash blocks of titles at once, taking the minimum over each title's 3-grams
+    block = 256
+    for start in range(0, len(rows), block):
+        block_grams = grams[start : start + block]
+        block_offsets = np.cumsum([0] + [len(g) for g in block_grams[:-1]])
+        hashes = (a * np.concatenate(block_grams)[None, :] + b) % np.uint64(MINHASH_PRIME)
+        signatures[rows[start : start + block]] = np.minimum.reduceat(
+            hashes, block_offsets, axis=1
+        ).T
+    return signatures
+
+
+def _bucket_pairs(
+    keys: np.ndarray, rows: np.ndarray, refine: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """
+    Return the (i, j) pairs, i < j, of the given rows with equal keys. Buckets with
+    more than MAX_BUCKET_SIZE rows are split by the columns of refine in turn, and
+    are skipped if they are still too large.
+    """
+    order = rows[np.argsort(keys[rows], kind='stable')]
+    sorted_keys = keys[order]
+    boundaries = np.nonzero(sorted_keys[1:] != sorted_keys[:-1])[0] + 1
+    pairs = [np.zeros((0, 2), dtype=np.int64)]
+    for bucket in np.split(order, boundaries):
+        if len(bucket) < 2:
+            continue
+        if len(bucket) <= MAX_BUCKET_SIZE:
+            i, j = np.triu_indices(len(bucket), k=1)
+            bucket = np.sort(bucket)
+            pairs.append(np.stack([bucket[i], bucket[j]], axis=1))
+        elif refine is not None and refine.shape[1] > 0:
+            pairs.append(_bucket_pairs(refine[:, 0], bucket, refine[:, 1:]))
+    return np.concatenate(pairs)
+
+
+def _key_ids(values: List[Optional[str]]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Map values to integer ids, returning the ids and which values are not None
+    """
+    ids: Dict[str, int] = {}
+    keys = np.array([-1 if v is None else ids.setdefault(v, len(ids)) for v in values])
+    return keys, keys >= 0
+
+
+def score_duplicates(entries: List[dict]) -> Dict[str, np.ndarray]:
+    """
+    Find candidate duplicate pairs among entries and score them. Candidates share
+    an LSH band of their title MinHash, a DOI, an arXiv ID or a first author and
+    year. Returns arrays of the pair indices (a, b), title_similarity (estimated
+    3-gram Jaccard), doi, arxiv and author_year matches and the confidence.
+    """
+    n_entries = len(entries)
+    titles = [normalize_title(e.get('title', '')) for e in entries]
+    signatures = minhash_signatures(titles)
+    has_title = np.array([len(t) > 0 for t in titles], dtype=bool)
+
+    candidates = []
+    rows = MINHASH_PERMUTATIONS // LSH_BANDS
+    multipliers = np.random.RandomState(1).randint(1, 1 << 62, size=rows).astype(np.uint64)
+    # Wrapping uint64 arithmetic is fine for bucket keys
+    band_keys = (signatures.reshape(n_entries, LSH_BANDS, rows) * multipliers).sum(axis=2)
+    title_rows = np.nonzero(has_title)[0]
+    for band in range(LSH_BANDS):
+        # Oversized buckets of generic titles are split by the following bands
+        refine = np.roll(band_keys, -band, axis=1)[:, 1:]
+        candidates.append(_bucket_pairs(band_keys[:, band], title_rows, refine))
+    dois, has_doi = _key_ids([_doi(e) for e in entries])
+    arxivs, has_arxiv = _key_ids([_arxiv_id(e) for e in entries])
+    years = [_year(e) for e in entries]
+    authors, has_author = _key_ids([_first_author(e) or None for e in entries])
+    author_years, has_author_year = _key_ids([
+        None if year is None or author == '' else f'{author} {year}'
+        for author, year in zip((_first_author(e) for e in entries), years)
+    ])
+    candidates.append(_bucket_pairs(dois, np.nonzero(has_doi)[0]))
+    candidates.append(_bucket_pairs(arxivs, np.nonzero(has_arxiv)[0]))
+    candidates.append(_bucket_pairs(author_years, np.nonzero(has_author_year)[0]))
+    pairs = np.concatenate(candidates)
+    codes = np.unique(pairs[:, 0] * n_entries + pairs[:, 1])
+    a, b = codes // n_entries, codes % n_entries
+
+    # In blocks, since comparing full signatures of every pair at once takes
+    # MINHASH_PERMUTATIONS * 16 bytes per pair
+    title_similarity = np.concatenate([np.zeros(0)] + [
+        (
+            signatures[a[i:i + SIMILARITY_BLOCK]] == signatures[b[i:i + SIMILARITY_BLOCK]]
+        ).mean(axis=1)
+        for i in range(0, len(a), SIMILARITY_BLOCK)
+    ])
+    title_similarity[~(has_title[a] & has_title[b])] = 0
+    doi = has_doi[a] & (dois[a] == dois[b])
+    doi_conflict = has_doi[a] & has_doi[b] & (dois[a] != dois[b])
+    arxiv = has_arxiv[a] & (arxivs[a] == arxivs[b])
+    author_year = has_author_year[a] & (author_years[a] == author_years[b])
+    author_conflict = has_author[a] & has_author[b] & (authors[a] != authors[b])
+    year_array = np.array([-1 if y is None else y for y in years])
+    known_years = (year_array[a] >= 0) & (year_array[b] >= 0)
+    year_gap = np.where(known_years, np.abs(year_array[a] - year_array[b]), 0)
+
+    # Similar titles are discounted when the first authors or years disagree,
+    # though preprints are often a year older than their publication
+    confidence = title_similarity * np.where(author_conflict, 0.7, 1.0)
+    confidence *= np.where(year_gap == 0, 1.0, np.where(year_gap == 1, 0.9, 0.7))
+    confidence = np.where(doi_conflict & ~arxiv, confidence * 0.5, confidence)
+    confidence = np.maximum(confidence, np.where(arxiv, 0.99, 0))
+    confidence = np.maximum(confidence, np.where(doi, 1.0, 0))
+    return {
+        'a': a, 'b': b, 'title_similarity': title_similarity, 'doi': doi,
+        'arxiv': arxiv, 'author_year': author_year, 'confidence': confidence,
+    }
+
+
+def find_duplicates(entries: List[dict], threshold: float = 0.5, fixed: int = 0) -> List[dict]:
+    """
+    Cluster entries connected by duplicate pairs with at least threshold
+    confidence, see score_duplicates. Each cluster lists the indices of its
+    entries, its pairs and its confidence, the lowest confidence of the pairs that
+    joined it. Clusters are sorted by confidence, highest first.
+
+    Pairs of two of the first fixed entries are ignored, so those entries are
+    only compared to the entries after them.
+    """
+    scores = score_duplicates(entries)
+    keep = np.nonzero(
+        (scores['confidence'] >= threshold) & (np.maximum(scores['a'], scores['b']) >= fixed)
+    )[0]
+    keep = keep[np.argsort(-scores['confidence'][keep], kind='stable')]
+    parents = list(range(len(entries)))
+
+    def find(i: int) -> int:
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    # Kruskal style: joining highest confidence pairs first makes the cluster
+    # confidence the weakest link of its maximum spanning tree
+    cluster_confidence: Dict[int, float] = {}
+    cluster_pairs: Dict[int, List[dict]] = defaultdict(list)
+    for k in keep:
+        a, b = int(scores['a'][k]), int(scores['b'][k])
+        pair = {key: values[k].item() for key, values in scores.items()}
+        root_a, root_b = find(a), find(b)
+        if root_a != root_b:
+            parents[root_b] = root_a
+            confidence = min(
+                pair['confidence'],
+                cluster_confidence.pop(root_a, 1.0),
+                cluster_confidence.pop(root_b, 1.0),
+            )
+            cluster_confidence[root_a] = confidence
+            cluster_pairs[root_a].extend(cluster_pairs.pop(root_b, []))
+        cluster_pairs[find(a)].append(pair)
+
+    members: Dict[int, List[int]] = defaultdict(list)
+    for i in range(len(entries)):
+        members[find(i)].append(i)
+    clusters = [
+        {'entries': members[root], 'confidence': confidence, 'pairs': cluster_pairs[root]}
+        for root, confidence in cluster_confidence.items()
+    ]
+    return sorted(clusters, key=lambda c: (-c['confidence'], c['entries'][0]))
+
+
+def _cluster_report(cluster: dict, entries: List[dict], sources: List[str], merged: bool) -> dict:
+    return {
+        'confidence': round(cluster['confidence'], 4),
+        'merged': merged,
+        'entries': [
+            {'ID': entries[i]['ID'], 'source': sources[i], 'title': entries[i].get('title', '')}
+            for i in cluster['entries']
+        ],
+        'pairs': [
+            {
+                'a': entries[pair['a']]['ID'], 'b': entries[pair['b']]['ID'],
+                'confidence': round(pair['confidence'], 4),
+                'title_similarity': round(pair['title_similarity'], 4),
+                'doi': pair['doi'], 'arxiv': pair['arxiv'], 'author_year': pair['author_year'],
+            }
+            for pair in cluster['pairs']
+        ],
+    }
+
+
+def merge_entries(entries: List[dict]) -> dict:
+    """
+    Merge duplicate entries into a copy of the first, adding the fields it is
+    missing from the others in order. Standard fields that the first entry's
+    type does not have, see ENTRY_FIELDS, are not added.
+    """
+    merged = copy.deepcopy(entries[0])
+    allowed = ENTRY_FIELDS.get(merged['ENTRYTYPE'])
+    for entry in entries[1:]:
+        for field, value in entry.items():
+            if allowed is None or field in allowed or field not in _STANDARD_FIELDS:
+                merged.setdefault(field, value)
+    return merged
+
+
+def dedup_entries(
+    entries: List[dict], sources: List[str], threshold: float = 0.5, auto_merge: float = 0.9
+) -> Tuple[List[dict], dict]:
+    """
+    Find duplicate clusters among entries and merge the clusters with at least
+    auto_merge confidence, see find_duplicates and merge_entries. Returns the
+    deduplicated entries, in their original order, and a json serializable report
+    of every cluster with at least threshold confidence.
+    """
+    kept, report = _dedup(entries, sources, threshold=threshold, auto_merge=auto_merge)
+    return [entry for _, entry in kept], report
+
+
+def _dedup(
+    entries: List[dict], sources: List[str], threshold: float, auto_merge: float,
+    fixed: int = 0,
+) -> Tuple[List[Tuple[int, dict]], dict]:
+    # Like dedup_entries, but each kept entry is paired with its index in entries
+    # and the first fixed entries are never removed, see merge_bibs
+    clusters = find_duplicates(entries, threshold=threshold, fixed=fixed)
+    replaced: Dict[int, dict] = {}
+    removed: Set[int] = set()
+    report = []
+    for cluster in clusters:
+        merged = cluster['confidence'] >= auto_merge
+        if merged:
+            indices = cluster['entries']
+            # Other fixed entries in the cluster are kept as they are
+            merge = indices[:1] + [i for i in indices[1:] if i >= fixed]
+            replaced[merge[0]] = merge_entries([entries[i] for i in merge])
+            removed.update(merge[1:])
+        report.append(_cluster_report(cluster, entries, sources, merged))
+    kept = [
+        (i, replaced.get(i, entry)) for i, entry in enumerate(entries) if i not in removed
+    ]
+    n_merged = sum(1 for c in report if c['merged'])
+    return kept, {
+        'entries': len(entries),
+        'clusters': len(report),
+        'merged_clusters': n_merged,
+        'removed_entries': len(entries) - len(kept),
+        'threshold': threshold,
+        'auto_merge': auto_merge,
+        'duplicates': report,
+    }
+
+
+def _format_writer(writer=None):
+    writer = bibtexparser.bwriter.BibTexWriter() if writer is None else writer
     writer.order_entries_by = ('ENTRYTYPE', 'year', 'title')
     writer.indent = '    '
     writer.add_trailing_comma = True
-    out = writer.write(new_db)
+    return writer
+
+
+def write_bib(bib, output_file):
+    """
+    Write bib with the format command's settings
+    """
     with open(output_file, 'w') as f:
-        f.write(out)
+        f.write(_format_writer().write(bib))
+
+
+@app.command('dedup')
+def dedup_bibtex(
+    input_files: List[Path],
+    output_file: Path,
+    report_file: Optional[Path] = None,
+    threshold: float = 0.5,
+    auto_merge: float = 0.9,
+):
+    """
+    Find duplicate entries within and across the input files without any
+    prompts. Titles are compared with MinHash over character 3-grams and entries
+    are also matched on DOI, arXiv ID and first author and year. Duplicates with
+    at least --auto-merge confidence are merged, keeping the entry from the
+    earliest file and filling in its missing fields, and the entries are written
+    to output_file. The clusters with at least --threshold confidence are written
+    as json to --report-file for review.
+    """
+    entries, sources = [], []
+    strings: Dict[str, str] = {}
+    for f in input_files:
+        bib = parse_bib(f)
+        entries.extend(bib.entries)
+        sources.extend([str(f)] * len(bib.entries))
+        for key, value in bib.strings.items():
+            strings.setdefault(key, value)
+    deduped, report = dedup_entries(entries, sources, threshold=threshold, auto_merge=auto_merge)
+    console.print(
+        f"Entries: {report['entries']} Duplicate clusters: {report['clusters']}"
+        f" Merged: {report['merged_clusters']} Removed entries: {report['removed_entries']}"
+    )
+    if report_file is not None:
+        console.print(f"Writing duplicate report to: {report_file}")
+        io.write_json(report_file, report)
+    db = bibtexparser.bibdatabase.BibDatabase()
+    db.strings = copy.deepcopy(strings)
+    db.entries = deduped
+    write_bib(db, output_file)
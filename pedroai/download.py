@@ -1,13 +1,44 @@
+import hashlib
 import os
+import queue
 import subprocess
-from typing import Dict, List, Union
+import threading
+import time
+import urllib.parse
+from concurrent.futures import (
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+)
+from contextlib import contextmanager
+from functools import partial
+from typing import (
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Mapping,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 
+import requests
 import toml
 from pydantic import BaseModel
+from rich.progress import DownloadColumn, Progress, TaskID, TransferSpeedColumn
 import typer
 
+from pedroai import io
 from pedroai.log import get_logger
 
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
 log = get_logger(__name__)
 
 VERSION = "0.1.0"
@@ -26,7 +57,12 @@ class DownloadSpec(BaseModel):
 class Job(BaseModel):
     name: str
     command: str
-    check: str
+    # Legacy skip condition: the job does not run if this path exists
+    check: Optional[str] = None
+    # Job names or download keys that must finish before this job starts
+    depends_on: List[str] = []
+    inputs: List[str] = []
+    outputs: List[str] = []
 
 
 class Config(BaseModel):
@@ -36,27 +72,608 @@ class Config(BaseModel):
     jobs: Dict[str, Job]
 
 
-def _download_file(remote_file: str, local_file: str, dry_run: bool = False):
-    if not dry_run:
-        subprocess.run(
-            f"curl -f --create-dirs -o {local_file} {remote_file}",
-            shell=True,
-            check=True,
-        )
+class DownloadError(Exception):
+    pass
+
+
+class ChecksumError(DownloadError):
+    pass
+
+
+class JobError(Exception):
+    pass
+
+
+CHECKSUM_MANIFEST = ".pedroai_checksums.json"
+# Checksums without an algorithm: prefix are identified by their hex length
+CHECKSUM_LENGTHS = {32: "md5", 40: "sha1", 64: "sha256", 128: "sha512", 16: "xxh64"}
+XXHASH_ALGORITHMS = {
+    "xxhash": "xxh64",
+    "xxh64": "xxh64",
+    "xxh3": "xxh3_64",
+    "xxh128": "xxh3_128",
+}
+
+
+def parse_checksum(checksum: Optional[str]) -> Optional[Tuple[str, str]]:
+    """
+    Parse a checksum like sha256:<hex>, md5:<hex> or xxhash:<hex> into its
+    algorithm and lowercase hex digest. Bare hex digests are identified by length.
+    Empty checksums mean there is nothing to check.
+    """
+    if checksum is None or checksum.strip() == "":
+        return None
+    algorithm, _, digest = checksum.strip().rpartition(":")
+    if algorithm == "":
+        if len(digest) not in CHECKSUM_LENGTHS:
+            raise ValueError(f"Can't infer the algorithm of checksum: {checksum}")
+        algorithm = CHECKSUM_LENGTHS[len(digest)]
+    algorithm = algorithm.lower()
+    algorithm = XXHASH_ALGORITHMS.get(algorithm, algorithm)
+    new_hasher(algorithm)
+    return algorithm, digest.lower()
+
+
+def new_hasher(algorithm: str):
+    """
+    Return a hash object with update and hexdigest methods for the algorithm
+    """
+    if algorithm in XXHASH_ALGORITHMS.values():
+        if xxhash is None:
+            raise ImportError("xxhash checksums require: pip install xxhash")
+        return getattr(xxhash, algorithm)()
+    try:
+        return hashlib.new(algorithm)
+    except ValueError as e:
+        raise ValueError(f"Unsupported checksum algorithm: {algorithm}") from e
+
+
+def hash_file(path: str, algorithm: str) -> str:
+    hasher = new_hasher(algorithm)
+    with open(path, "rb") as f:
+        for chunk in iter(partial(f.read, io.DOWNLOAD_CHUNK_SIZE), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class ChecksumManifest:
+    """
+    Cache of verified file hashes saved as json, keyed on the absolute path. An
+    entry is only trusted while the file's size and mtime are unchanged, so
+    checking a file that was already verified costs a stat instead of a rehash.
+    """
+
+    def __init__(self, path: str = CHECKSUM_MANIFEST):
+        self.path = path
+        self._lock = threading.Lock()
+        self._changed = False
+        if os.path.exists(path):
+            self._entries = io.read_json(path)
+        else:
+            self._entries = {}
+
+    def lookup(self, local_file: str, algorithm: str) -> Optional[str]:
+        """
+        Return the cached digest of a file, or None if it is missing or stale
+        """
+        entry = self._entries.get(os.path.abspath(local_file))
+        if entry is None or entry["algorithm"] != algorithm:
+            return None
+        try:
+            stat = os.stat(local_file)
+        except FileNotFoundError:
+            return None
+        if entry["size"] != stat.st_size or entry["mtime_ns"] != stat.st_mtime_ns:
+            return None
+        return entry["digest"]
+
+    def record(self, local_file: str, algorithm: str, digest: str):
+        stat = os.stat(local_file)
+        with self._lock:
+            self._entries[os.path.abspath(local_file)] = {
+                "algorithm": algorithm,
+                "digest": digest,
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+            }
+            self._changed = True
+
+    def save(self):
+        """
+        Write the manifest if any file was recorded since it was loaded
+        """
+        with self._lock:
+            if self._changed:
+                io.write_json(self.path, self._entries, atomic=True)
+                self._changed = False
+
+
+def verify_files(
+    checksums: Dict[str, Tuple[str, str]],
+    manifest: Optional[ChecksumManifest] = None,
+    workers: int = 4,
+) -> Dict[str, bool]:
+    """
+    Check existing files against their (algorithm, digest) checksums, hashing the
+    files the manifest does not vouch for in a process pool. Returns whether each
+    file matched.
+    """
+    matches = {}
+    to_hash = {}
+    for local_file, (algorithm, digest) in checksums.items():
+        cached = None if manifest is None else manifest.lookup(local_file, algorithm)
+        if cached is None:
+            to_hash[local_file] = algorithm
+        else:
+            matches[local_file] = cached == digest
+    if len(to_hash) == 0:
+        return matches
+
+    log.info("Verifying checksums of %d files", len(to_hash))
+    if len(to_hash) == 1 or workers <= 1:
+        digests: Iterable[str] = [hash_file(f, a) for f, a in to_hash.items()]
+        executor = None
+    else:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        digests = executor.map(hash_file, to_hash.keys(), to_hash.values())
+    try:
+        for (local_file, algorithm), digest in zip(to_hash.items(), digests):
+            matches[local_file] = digest == checksums[local_file][1]
+            if manifest is not None:
+                manifest.record(local_file, algorithm, digest)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return matches
+
+
+class HostLimiter:
+    """
+    Limit the number of concurrent connections to each host
+    """
+
+    def __init__(self, max_per_host: int):
+        self._max_per_host = max_per_host
+        self._semaphores: Dict[str, threading.BoundedSemaphore] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def limit(self, url: str):
+        host = urllib.parse.urlsplit(url).netloc
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = threading.BoundedSemaphore(self._max_per_host)
+            semaphore = self._semaphores[host]
+        with semaphore:
+            yield
+
+
+def _is_retryable(error: Exception) -> bool:
+    """
+    Connection problems, timeouts and server errors are retried. Client errors
+    like 404s and local errors like a full disk are not
+    """
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code >= 500 or error.response.status_code == 429
+    return isinstance(
+        error,
+        (
+            requests.ConnectionError,
+            requests.Timeout,
+            requests.exceptions.ChunkedEncodingError,
+        ),
+    )
+
+
+def _download_file(
+    remote_file: str,
+    local_file: str,
+    dry_run: bool = False,
+    retries: int = 3,
+    backoff: float = 1.0,
+    session: Optional[requests.Session] = None,
+    host_limiter: Optional[HostLimiter] = None,
+    callback: Optional[Callable[[int, Optional[int]], None]] = None,
+    checksum: Optional[Tuple[str, str]] = None,
+    manifest: Optional[ChecksumManifest] = None,
+    segments: int = 1,
+):
+    """
+    Download a file, retrying failures with exponential backoff. Retries resume
+    from the partial download. If checksum is given, the file is hashed as it
+    streams in and removed if it does not match.
+
+    If segments is greater than one, the file is fetched over that many parallel
+    range requests when the server supports them, see io.download.
+    """
+    if dry_run:
+        return
+    for attempt in range(retries + 1):
+        hasher = None if checksum is None else new_hasher(checksum[0])
+        try:
+            if host_limiter is None:
+                io.download(
+                    remote_file,
+                    local_file,
+                    session=session,
+                    progress=callback is None,
+                    callback=callback,
+                    hasher=hasher,
+                    segments=segments,
+                )
+            else:
+                with host_limiter.limit(remote_file):
+                    io.download(
+                        remote_file,
+                        local_file,
+                        session=session,
+                        progress=callback is None,
+                        callback=callback,
+                        hasher=hasher,
+                        segments=segments,
+                    )
+            break
+        except Exception as e:  # pylint: disable=broad-except
+            if attempt == retries or not _is_retryable(e):
+                raise
+            delay = backoff * 2**attempt
+            log.warning(
+                "Download of %s failed (%s), retrying in %.1fs", remote_file, e, delay
+            )
+            time.sleep(delay)
+
+    if checksum is not None and hasher is not None:
+        algorithm, expected = checksum
+        digest = hasher.hexdigest()
+        if digest != expected:
+            os.remove(local_file)
+            raise ChecksumError(
+                f"Checksum mismatch for {local_file}: expected {algorithm}:{expected}"
+                f" but downloaded {algorithm}:{digest}"
+            )
+        if manifest is not None:
+            manifest.record(local_file, algorithm, digest)
 
 
 def download_file(
-    remote_file: str, local_file: str, overwrite=False, dry_run: bool = False
+    remote_file: str,
+    local_file: str,
+    overwrite=False,
+    dry_run: bool = False,
+    checksum: Optional[str] = None,
+    manifest: Optional[ChecksumManifest] = None,
+    **kwargs,
 ):
+    parsed_checksum = parse_checksum(checksum)
+    if os.path.exists(local_file) and not overwrite and parsed_checksum is not None:
+        if not verify_files({local_file: parsed_checksum}, manifest=manifest)[
+            local_file
+        ]:
+            log.warning("Checksum mismatch, re-downloading: %s", local_file)
+            if not dry_run:
+                os.remove(local_file)
+
     if os.path.exists(local_file):
         if overwrite:
             log.info("Overwriting, Downloading %s to %s", remote_file, local_file)
-            _download_file(remote_file, local_file, dry_run=dry_run)
+            _download_file(
+                remote_file,
+                local_file,
+                dry_run=dry_run,
+                checksum=parsed_checksum,
+                manifest=manifest,
+                **kwargs,
+            )
         else:
             log.info("File exists, skipping download of: %s", local_file)
     else:
         log.info("Downloading %s to %s", remote_file, local_file)
-        _download_file(remote_file, local_file, dry_run=dry_run)
+        _download_file(
+            remote_file,
+            local_file,
+            dry_run=dry_run,
+            checksum=parsed_checksum,
+            manifest=manifest,
+            **kwargs,
+        )
+
+
+def _remote_url(remote_file: Union[str, DownloadSpec]) -> str:
+    if isinstance(remote_file, str):
+        return remote_file
+    elif isinstance(remote_file, DownloadSpec):
+        return remote_file.url
+    else:
+        raise ValueError(f"Invalid type for remote_file: {type(remote_file)}")
+
+
+def _remote_checksum(remote_file: Union[str, DownloadSpec]) -> Optional[str]:
+    if isinstance(remote_file, DownloadSpec):
+        return remote_file.checksum
+    return None
+
+
+def download_files(
+    downloads: Mapping[str, Union[str, DownloadSpec]],
+    jobs: int = 4,
+    max_per_host: int = 4,
+    overwrite: bool = False,
+    dry_run: bool = False,
+    retries: int = 3,
+    backoff: float = 1.0,
+    manifest_path: Optional[str] = None,
+    segments: int = 1,
+    on_complete: Optional[Callable[[str, Optional[Exception]], None]] = None,
+) -> Dict[str, Exception]:
+    """
+    Download files concurrently with at most jobs downloads in flight and at most
+    max_per_host connections to any one host, showing a combined progress display.
+    Returns the exception of every download that failed, keyed by local file.
+
+    Files with checksums are verified: existing files are hashed in a process
+    pool (unless the manifest at manifest_path, if given, already verified them) and
+    re-downloaded if they do not match, new files are hashed while downloading.
+
+    With segments greater than one, each file is split into up to that many range
+    requests. Those count as one download against jobs and max_per_host.
+
+    If given, on_complete(local_file, error) is called as soon as each file is
+    ready (error is None) or has failed, so dependent work can start early.
+    """
+    if on_complete is None:
+
+        def _noop(_local_file: str, _error: Optional[Exception]):
+            pass
+
+        on_complete = _noop
+    manifest = None if manifest_path is None else ChecksumManifest(manifest_path)
+    failures: Dict[str, Exception] = {}
+    checksums = {}
+    for local_file, remote_file in downloads.items():
+        try:
+            checksum = parse_checksum(_remote_checksum(remote_file))
+        except (ImportError, ValueError) as e:
+            log.error("Invalid checksum for %s: %s", local_file, e)
+            failures[local_file] = e
+            on_complete(local_file, e)
+            continue
+        if checksum is not None:
+            checksums[local_file] = checksum
+
+    existing = {
+        local_file: checksum
+        for local_file, checksum in checksums.items()
+        if os.path.exists(local_file) and not overwrite
+    }
+    for local_file, match in verify_files(existing, manifest, workers=jobs).items():
+        if not match:
+            log.warning("Checksum mismatch, re-downloading: %s", local_file)
+            if not dry_run:
+                os.remove(local_file)
+
+    session = io.make_session(pool_size=max(jobs, max_per_host) * max(segments, 1))
+    host_limiter = HostLimiter(max_per_host)
+    try:
+        with Progress(
+            *Progress.get_default_columns(),
+            DownloadColumn(),
+            TransferSpeedColumn(),
+            console=io.console,
+            disable=dry_run,
+        ) as progress, ThreadPoolExecutor(max_workers=jobs) as executor:
+
+            def update(task: TaskID, downloaded: int, total: Optional[int]):
+                progress.update(task, completed=downloaded, total=total)
+
+            futures = {}
+            for local_file, remote_file in downloads.items():
+                if local_file in failures:
+                    continue
+                if os.path.exists(local_file) and not overwrite:
+                    log.info("File exists, skipping download of: %s", local_file)
+                    on_complete(local_file, None)
+                    continue
+                task = progress.add_task(local_file, total=None)
+                future = executor.submit(
+                    _download_file,
+                    _remote_url(remote_file),
+                    local_file,
+                    dry_run=dry_run,
+                    retries=retries,
+                    backoff=backoff,
+                    session=session,
+                    host_limiter=host_limiter,
+                    callback=partial(update, task),
+                    checksum=checksums.get(local_file),
+                    manifest=manifest,
+                    segments=segments,
+                )
+                futures[future] = local_file
+
+            for future in as_completed(futures):
+                local_file = futures[future]
+                try:
+                    future.result()
+                except Exception as e:  # pylint: disable=broad-except
+                    log.error("Failed to download %s: %s", local_file, e)
+                    failures[local_file] = e
+                    on_complete(local_file, e)
+                else:
+                    on_complete(local_file, None)
+    finally:
+        if manifest is not None and not dry_run:
+            manifest.save()
+    return failures
+
+
+_DOWNLOADS_DONE = object()
+
+
+def _newest_mtime(paths: Iterable[str]) -> Optional[float]:
+    mtimes = [os.stat(p).st_mtime_ns for p in paths if os.path.exists(p)]
+    return max(mtimes) if len(mtimes) > 0 else None
+
+
+def job_is_current(job: Job) -> bool:
+    """
+    Whether a job can be skipped. Jobs with outputs are current, like make, when
+    every output exists and none is older than the newest input. Jobs without
+    outputs fall back on their check path existing.
+    """
+    if len(job.outputs) > 0:
+        if not all(os.path.exists(p) for p in job.outputs):
+            return False
+        newest_input = _newest_mtime(job.inputs)
+        oldest_output = min(os.stat(p).st_mtime_ns for p in job.outputs)
+        return newest_input is None or newest_input <= oldest_output
+    return job.check is not None and os.path.exists(job.check)
+
+
+def job_dependencies(
+    jobs: Dict[str, Job], downloads: Iterable[str] = ()
+) -> Dict[str, Set[str]]:
+    """
+    Return the job names and download keys each job waits on: its depends_on
+    entries, plus downloads and other jobs' outputs that it lists as inputs.
+    Jobs that declare neither wait on every download and on the previous such
+    job, so they run one at a time in file order once downloads finish.
+    Raises ValueError for unknown dependencies and dependency cycles.
+    """
+    downloads = set(downloads)
+    producers = {}
+    for name, job in jobs.items():
+        for output in job.outputs:
+            producers[os.path.normpath(output)] = name
+
+    graph = {}
+    previous_undeclared = None
+    for name, job in jobs.items():
+        deps = set()
+        if len(job.depends_on) == 0 and len(job.inputs) == 0:
+            deps.update(downloads)
+            if previous_undeclared is not None:
+                deps.add(previous_undeclared)
+            previous_undeclared = name
+        for dep in job.depends_on:
+            if dep not in jobs and dep not in downloads:
+                raise ValueError(
+                    f"Job {name} depends on unknown job or download: {dep}"
+                )
+            deps.add(dep)
+        for path in job.inputs:
+            if path in downloads:
+                deps.add(path)
+            producer = producers.get(os.path.normpath(path))
+            if producer is not None and producer != name:
+                deps.add(producer)
+        graph[name] = deps
+
+    # Depth first search for cycles among jobs
+    visiting, visited = set(), set()
+
+    def visit(name: str, path: List[str]):
+        if name in visited:
+            return
+        if name in visiting:
+            cycle = path[path.index(name) :] + [name]
+            raise ValueError(f"Job dependency cycle: {' -> '.join(cycle)}")
+        visiting.add(name)
+        for dep in graph[name]:
+            if dep in jobs:
+                visit(dep, path + [name])
+        visiting.remove(name)
+        visited.add(name)
+
+    for name in jobs:
+        visit(name, [])
+    return graph
+
+
+def _run_job(job: Job, dry_run: bool):
+    if job_is_current(job):
+        log.info("Job is up to date, skipping: %s", job.name)
+        return
+    log.info("Running: %s", job.command)
+    if not dry_run:
+        subprocess.run(job.command, shell=True, check=True)
+
+
+def run_jobs(
+    jobs: Dict[str, Job],
+    max_workers: int = 4,
+    dry_run: bool = False,
+    downloads: Iterable[str] = (),
+    pending_downloads: Iterable[str] = (),
+    events: Optional["queue.Queue"] = None,
+) -> Dict[str, Exception]:
+    """
+    Run jobs concurrently, at most max_workers at a time, starting each job as
+    soon as its dependencies finish, in file order among those that are ready.
+    Jobs whose dependencies failed are not run. Returns the exception of every
+    job that failed, keyed by job name.
+
+    Jobs may depend on the download keys in downloads. Those in pending_downloads
+    are still in flight: their completion is read from events as (local_file,
+    error) pairs, followed by _DOWNLOADS_DONE once every download has been reported.
+    """
+    pending_downloads = set(pending_downloads)
+    graph = job_dependencies(jobs, pending_downloads.union(downloads))
+    if events is None:
+        events = queue.Queue()
+    failures: Dict[str, Exception] = {}
+    failed_downloads: Dict[str, Exception] = {}
+    done: Set[str] = set()
+    waiting = set(jobs)
+    running = 0
+
+    def is_done(dep: str) -> bool:
+        return dep in done or (dep not in jobs and dep not in pending_downloads)
+
+    def finished(name: str, future: Future):
+        events.put((("job", name), future.exception()))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while len(waiting) > 0 or running > 0:
+            for name in [n for n in jobs if n in waiting]:
+                deps = graph[name]
+                failed = [d for d in deps if d in failures or d in failed_downloads]
+                if len(failed) > 0:
+                    log.error("Not running %s, dependencies failed: %s", name, failed)
+                    failures[name] = JobError(
+                        f"Dependencies failed: {', '.join(failed)}"
+                    )
+                    waiting.remove(name)
+                elif all(is_done(d) for d in deps):
+                    future = executor.submit(_run_job, jobs[name], dry_run)
+                    future.add_done_callback(partial(finished, name))
+                    waiting.remove(name)
+                    running += 1
+            if len(waiting) == 0 and running == 0:
+                break
+
+            event = events.get()
+            if event is _DOWNLOADS_DONE:
+                # Downloads that were never reported will not arrive
+                for local_file in pending_downloads - done:
+                    failed_downloads.setdefault(
+                        local_file, DownloadError(f"Not downloaded: {local_file}")
+                    )
+                continue
+            node, error = event
+            if isinstance(node, tuple):
+                node = node[1]
+                running -= 1
+                if error is not None:
+                    log.error("Job %s failed: %s", node, error)
+                    failures[node] = error
+                else:
+                    done.add(node)
+            elif error is not None:
+                failed_downloads[node] = error
+            else:
+                done.add(node)
+    return failures
+
 
 def main(
     config_file: str = "files.toml",
@@ -64,6 +681,11 @@ def main(
     download: bool = True,
     dry_run: bool = False,
     enforce_version: bool = True,
+    jobs: int = 4,
+    job_workers: int = 4,
+    max_per_host: int = 4,
+    retries: int = 3,
+    segments: int = 1,
 ):
     log.info("Configuration")
     log.info("config_file: %s", config_file)
@@ -71,6 +693,8 @@ def main(
     log.info("download: %s", download)
     log.info("dry_run: %s", dry_run)
     log.info("enforce_version: %s", enforce_version)
+    log.info("jobs: %s", jobs)
+    log.info("job_workers: %s", job_workers)
     with open(config_file) as f:
         log.info("Validating: %s", config_file)
         config = Config(**toml.load(f))
@@ -90,23 +714,43 @@ def main(
             if not dry_run:
                 os.makedirs(directory, exist_ok=True)
 
-    if download:
-        for local_file, remote_file in config.downloads.items():
-            if isinstance(remote_file, str):
-                download_file(
-                    remote_file, local_file, overwrite=overwrite, dry_run=dry_run
-                )
-            elif isinstance(remote_file, DownloadSpec):
-                download_file(
-                    remote_file.url, local_file, overwrite=overwrite, dry_run=dry_run
-                )
-            else:
-                raise ValueError(f"Invalid type for remote_file: {type(remote_file)}")
+    # Fail on unknown dependencies and cycles before downloading anything
+    job_dependencies(config.jobs, config.downloads)
 
-    for job in config.jobs.values():
-        log.info("Running: %s", job.command)
-        if not dry_run:
-            if os.path.exists(job.check):
-                log.info("Check path exists, skipping: %s", job.check)
-            else:
-                subprocess.run(job.command, shell=True, check=True)
+    # Jobs start as soon as the downloads they depend on finish, so downloads
+    # run in the background while the job scheduler waits on their completion
+    events: "queue.Queue" = queue.Queue()
+    with ThreadPoolExecutor(max_workers=1) as background:
+        if download:
+            downloads_future = background.submit(
+                download_files,
+                config.downloads,
+                jobs=jobs,
+                max_per_host=max_per_host,
+                overwrite=overwrite,
+                dry_run=dry_run,
+                retries=retries,
+                segments=segments,
+                manifest_path=os.path.join(
+                    os.path.dirname(config_file), CHECKSUM_MANIFEST
+                ),
+                on_complete=lambda local_file, error: events.put((local_file, error)),
+            )
+            downloads_future.add_done_callback(lambda _: events.put(_DOWNLOADS_DONE))
+            pending_downloads = set(config.downloads)
+        else:
+            pending_downloads = set()
+        job_failures = run_jobs(
+            config.jobs,
+            max_workers=job_workers,
+            dry_run=dry_run,
+            downloads=config.downloads,
+            pending_downloads=pending_downloads,
+            events=events,
+        )
+        failures = downloads_future.result() if download else {}
+
+    if len(failures) > 0:
+        raise DownloadError(f"{len(failures)} downloads failed: {', '.join(failures)}")
+    if len(job_failures) > 0:
+        raise JobError(f"{len(job_failures)} jobs failed: {', '.join(job_failures)}")
@@ -1,18 +1,475 @@
+import hashlib
 import logging
+import os
+import pickle
+import re
+import time
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Sequence, Set, Tuple
 import typer
-from rich.progress import track
+from rich.console import Console
+from rich.filesize import decimal
+from rich.progress import Progress, SpinnerColumn, TextColumn, TimeElapsedColumn
+from rich.table import Table
+
+from pedroai import io
+from pedroai.iter import batched
 
 
 app = typer.Typer()
+console = Console()
 
+SIZE_UNITS = {
+    "": 1,
+    "k": 10**3,
+    "m": 10**6,
+    "g": 10**9,
+    "t": 10**12,
+    "p": 10**15,
+}
+DURATION_UNITS = {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+DU_CACHE_VERSION = 1
+# (mtime_ns, [(file name, size)], [subdirectory names]) of one directory
+DirRecord = Tuple[int, List[Tuple[str, int]], List[str]]
 
-@app.command()
-def rmf(directory: Path, glob_pattern: str, dry_run: bool = False):
-    files = list(directory.glob(glob_pattern))
-    for f in track(files):
-        if dry_run:
-            logging.info("Dry run enabled, skipping delete: %s", f)
+
+def parse_size(size: str) -> int:
+    """
+    Parse a size like 512, 100k, 1.5G or 2TB into bytes
+    """
+    match = re.fullmatch(r"\s*([\d.]+)\s*([kmgtp]?)b?\s*", size.lower())
+    if match is None:
+        raise typer.BadParameter(f"Invalid size: {size}")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2)])
+
+
+def parse_duration(duration: str) -> float:
+    """
+    Parse a duration like 90, 30m, 12h or 7d into seconds
+    """
+    match = re.fullmatch(r"\s*([\d.]+)\s*([smhdw]?)\s*", duration.lower())
+    if match is None:
+        raise typer.BadParameter(f"Invalid duration: {duration}")
+    return float(match.group(1)) * DURATION_UNITS[match.group(2)]
+
+
+def _translate_segment(segment: str) -> str:
+    """
+    Translate one path segment of a glob to a regex where wildcards do not match /
+    """
+    regex, i = "", 0
+    while i < len(segment):
+        c = segment[i]
+        i += 1
+        if c == "*":
+            regex += "[^/]*"
+        elif c == "?":
+            regex += "[^/]"
+        elif c == "[":
+            # Like fnmatch, a ] right after [ or [! is part of the set
+            j = i + 1 if segment[i : i + 1] == "!" else i
+            end = segment.find("]", j + 1)
+            if end < 0:
+                regex += "\\["
+                continue
+            chars = segment[i:end].replace("\\", "\\\\").replace("[", "\\[")
+            if chars.startswith("!"):
+                chars = "^" + chars[1:]
+            elif chars.startswith("^"):
+                chars = "\\" + chars
+            regex += f"[{chars}]"
+            i = end + 1
+        else:
+            regex += re.escape(c)
+    return regex
+
+
+class GlobMatcher:
+    """
+    Match paths relative to a root directory against a glob like pathlib's, where
+    ** matches any number of directories. Directories that can not contain a match
+    are reported by can_contain so walks can skip them, which bounds the depth of
+    walks for patterns without **.
+    """
+
+    def __init__(self, pattern: str):
+        self.pattern = pattern
+        self.segments = [s for s in pattern.strip("/").split("/") if s not in ("", ".")]
+        regex = ""
+        for i, segment in enumerate(self.segments):
+            last = i == len(self.segments) - 1
+            if segment == "**":
+                regex += ".*" if last else "(?:[^/]+/)*"
+            else:
+                regex += _translate_segment(segment) + ("" if last else "/")
+        self._regex = re.compile(regex, re.DOTALL)
+        # Directory names before the first ** must match their segment
+        if "**" in self.segments:
+            self._prefix = self.segments[: self.segments.index("**")]
+            self._max_depth = None
         else:
-            if f.is_file():
-                f.unlink()
+            self._prefix = self.segments[:-1]
+            self._max_depth = len(self.segments) - 1
+        self._prefix_regexes = [re.compile(_translate_segment(s)) for s in self._prefix]
+
+    def matches(self, rel_path: str) -> bool:
+        return self._regex.fullmatch(rel_path) is not None
+
+    def can_contain(self, rel_dir: str) -> bool:
+        """
+        Whether the directory at rel_dir, relative to the root, can contain matches
+        """
+        parts = [] if rel_dir == "" else rel_dir.split("/")
+        if self._max_depth is not None and len(parts) > self._max_depth:
+            return False
+        return all(
+            regex.fullmatch(part) is not None
+            for regex, part in zip(self._prefix_regexes, parts)
+        )
+
+
+def walk_matches(directory: Path, matcher: GlobMatcher) -> Iterator[os.DirEntry]:
+    """
+    Stream the files under directory that match, without building a list of the
+    whole tree first. Symlinked directories are neither followed nor matched.
+    """
+    stack = [""]
+    while len(stack) > 0:
+        rel_dir = stack.pop()
+        try:
+            entries = os.scandir(os.path.join(directory, rel_dir))
+        except (FileNotFoundError, PermissionError) as e:
+            logging.warning("Skipping directory %s: %s", rel_dir, e)
+            continue
+        with entries:
+            for entry in entries:
+                rel_path = entry.name if rel_dir == "" else f"{rel_dir}/{entry.name}"
+                if entry.is_dir(follow_symlinks=False):
+                    if matcher.can_contain(rel_path):
+                        stack.append(rel_path)
+                elif entry.is_file() and matcher.matches(rel_path):
+                    yield entry
+
+
+def _remove_batch(
+    entries: List[os.DirEntry],
+    dry_run: bool,
+    modified_before: Optional[float],
+    min_size: Optional[int],
+    max_size: Optional[int],
+) -> Tuple[int, int, List[str]]:
+    """
+    Remove the files in a batch that pass the filters, returning the number of
+    files and bytes removed and the directories they were in
+    """
+    removed, removed_bytes, directories = 0, 0, []
+    for entry in entries:
+        try:
+            stat = entry.stat()
+            if modified_before is not None and stat.st_mtime >= modified_before:
+                continue
+            if min_size is not None and stat.st_size < min_size:
+                continue
+            if max_size is not None and stat.st_size > max_size:
+                continue
+            if dry_run:
+                logging.debug("Dry run enabled, skipping delete: %s", entry.path)
+            else:
+                os.unlink(entry.path)
+        except FileNotFoundError:
+            continue
+        removed += 1
+        removed_bytes += stat.st_size
+        directories.append(os.path.dirname(entry.path))
+    return removed, removed_bytes, directories
+
+
+def _remove_empty_dirs(directory: Path, candidates: Set[str]) -> int:
+    """
+    Remove the candidate directories and their parents inside directory if they
+    are empty, deepest first, returning the number removed
+    """
+    root = os.path.abspath(directory)
+    pending = set()
+    for path in candidates:
+        path = os.path.abspath(path)
+        while path != root and path.startswith(root + os.sep) and path not in pending:
+            pending.add(path)
+            path = os.path.dirname(path)
+    removed = 0
+    for path in sorted(pending, key=lambda p: p.count(os.sep), reverse=True):
+        try:
+            os.rmdir(path)
+            removed += 1
+        except OSError:
+            # Not empty or already removed
+            pass
+    return removed
+
+
+@app.command()
+def rmf(
+    directory: Path,
+    glob_pattern: str,
+    dry_run: bool = False,
+    older_than: Optional[str] = None,
+    min_size: Optional[str] = None,
+    max_size: Optional[str] = None,
+    remove_empty_dirs: bool = False,
+    workers: int = 16,
+    batch_size: int = 1000,
+) -> Tuple[int, int]:
+    """
+    Remove the files under directory that match glob_pattern (for example
+    '**/*.pt') while the tree is walked, with a pool of workers threads unlinking
+    batches of batch_size files. Returns the number of files and bytes removed.
+
+    Files can be filtered by the age of their last modification with --older-than
+    (like 7d or 12h) and by size with --min-size and --max-size (like 100M).
+    With --remove-empty-dirs, directories left empty are removed as well. With
+    --dry-run nothing is removed, but the files and bytes that would be freed are
+    counted.
+    """
+    matcher = GlobMatcher(glob_pattern)
+    modified_before = (
+        None if older_than is None else time.time() - parse_duration(older_than)
+    )
+    min_bytes = None if min_size is None else parse_size(min_size)
+    max_bytes = None if max_size is None else parse_size(max_size)
+
+    removed, removed_bytes = 0, 0
+    directories: Set[str] = set()
+    start_time = time.perf_counter()
+    with Progress(
+        SpinnerColumn(),
+        TextColumn("{task.description}"),
+        TimeElapsedColumn(),
+        console=console,
+    ) as progress, ThreadPoolExecutor(max_workers=workers) as executor:
+        task = progress.add_task("Removing" if not dry_run else "Counting")
+        pending: Set[Future] = set()
+
+        def collect(done):
+            nonlocal removed, removed_bytes
+            for future in done:
+                n_files, n_bytes, dirs = future.result()
+                removed += n_files
+                removed_bytes += n_bytes
+                if remove_empty_dirs:
+                    directories.update(dirs)
+            elapsed = max(time.perf_counter() - start_time, 1e-9)
+            progress.update(
+                task,
+                description=f"{'Removed' if not dry_run else 'Found'} {removed} files"
+                f" ({decimal(removed_bytes)}), {removed / elapsed:.0f} files/s",
+            )
+
+        for batch in batched(walk_matches(directory, matcher), batch_size):
+            # Bound the batches in flight so memory does not grow with the tree
+            if len(pending) >= 2 * workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+            pending.add(
+                executor.submit(
+                    _remove_batch, batch, dry_run, modified_before, min_bytes, max_bytes
+                )
+            )
+        collect(wait(pending).done)
+
+    if dry_run:
+        console.log(
+            f"Dry run: would remove {removed} files, freeing {decimal(removed_bytes)}"
+        )
+    else:
+        console.log(
+            f"Removed {removed} files, freeing {decimal(removed_bytes)}"
+            f" in {time.perf_counter() - start_time:.1f}s"
+        )
+        if remove_empty_dirs:
+            console.log(
+                f"Removed {_remove_empty_dirs(directory, directories)} empty directories"
+            )
+    return removed, removed_bytes
+
+
+def _scan_dir(path: str, cached: Optional[DirRecord]) -> Tuple[DirRecord, bool]:
+    """
+    List one directory, reusing the cached record if the directory's mtime is
+    unchanged. Returns the record and whether it came from the cache.
+    """
+    # Read the mtime first, so changes made during the scan invalidate the record
+    mtime_ns = os.stat(path).st_mtime_ns
+    if cached is not None and cached[0] == mtime_ns:
+        return cached, True
+    files, subdirs = [], []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.name)
+            else:
+                try:
+                    files.append(
+                        (entry.name, entry.stat(follow_symlinks=False).st_size)
+                    )
+                except FileNotFoundError:
+                    continue
+    return (mtime_ns, files, subdirs), False
+
+
+def du_cache_path(directory: Path) -> str:
+    key = hashlib.sha256(os.path.abspath(directory).encode("utf8")).hexdigest()[:32]
+    return os.path.join(io.CACHE_DIR, "du", f"{key}.pkl")
+
+
+def scan_tree(
+    directory: Path,
+    workers: int = 16,
+    cache_path: Optional[str] = None,
+    progress: Optional[Progress] = None,
+) -> Tuple[Dict[str, DirRecord], int]:
+    """
+    Scan every directory under directory with a pool of workers threads, returning
+    a record per directory keyed by its path relative to directory ('' for the
+    root) and the number of directories that were listed.
+
+    If cache_path is given, the records of the previous scan are loaded from it and
+    only directories whose mtime changed are listed again, then the new records
+    are saved. Like any mtime based cache, files changed in place without adding,
+    removing or renaming files in their directory keep their cached size.
+    """
+    root = os.path.abspath(directory)
+    previous: Dict[str, DirRecord] = {}
+    if cache_path is not None and os.path.exists(cache_path):
+        with open(cache_path, "rb") as f:
+            cache = pickle.load(f)
+        if cache["version"] == DU_CACHE_VERSION and cache["root"] == root:
+            previous = cache["records"]
+
+    records: Dict[str, DirRecord] = {}
+    listed = 0
+    task = None if progress is None else progress.add_task("Scanning")
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {executor.submit(_scan_dir, root, previous.get("")): ""}
+        while len(pending) > 0:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                rel_dir = pending.pop(future)
+                try:
+                    record, cached = future.result()
+                except (FileNotFoundError, NotADirectoryError, PermissionError) as e:
+                    logging.warning("Skipping directory %s: %s", rel_dir, e)
+                    continue
+                records[rel_dir] = record
+                listed += 0 if cached else 1
+                for name in record[2]:
+                    rel_path = name if rel_dir == "" else f"{rel_dir}/{name}"
+                    future = executor.submit(
+                        _scan_dir, os.path.join(root, rel_path), previous.get(rel_path)
+                    )
+                    pending[future] = rel_path
+            if progress is not None and task is not None:
+                progress.update(
+                    task,
+                    description=f"Scanned {len(records)} directories, listed {listed}",
+                )
+
+    if cache_path is not None:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with io.atomic_path(cache_path) as temp_path, open(temp_path, "wb") as f:
+            cache = {"version": DU_CACHE_VERSION, "root": root, "records": records}
+            pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return records, listed
+
+
+def summarize_usage(
+    records: Dict[str, DirRecord], patterns: Sequence[str] = (), depth: int = 1
+) -> Tuple[Dict[str, List[int]], Dict[str, List[int]]]:
+    """
+    Aggregate [files, bytes] by group and by directory. Files are grouped by the
+    first glob in patterns that matches their path, or by extension if there are
+    no patterns. Directories are truncated to depth levels below the root.
+    """
+    matchers = [GlobMatcher(pattern) for pattern in patterns]
+    groups: Dict[str, List[int]] = defaultdict(lambda: [0, 0])
+    directories: Dict[str, List[int]] = defaultdict(lambda: [0, 0])
+    for rel_dir, (_, files, _) in records.items():
+        directory = "/".join(rel_dir.split("/")[:depth]) if rel_dir != "" else "."
+        directory_usage = directories[directory]
+        for name, size in files:
+            if len(matchers) == 0:
+                group = os.path.splitext(name)[1].lower() or "(none)"
+            else:
+                rel_path = name if rel_dir == "" else f"{rel_dir}/{name}"
+                group = next(
+                    (m.pattern for m in matchers if m.matches(rel_path)), "(other)"
+                )
+            groups[group][0] += 1
+            groups[group][1] += size
+            directory_usage[0] += 1
+            directory_usage[1] += size
+    return dict(groups), dict(directories)
+
+
+def _usage_table(
+    title: str, column: str, usage: Dict[str, List[int]], top: int
+) -> Table:
+    total = max(sum(size for _, size in usage.values()), 1)
+    table = Table(title=title)
+    table.add_column(column)
+    table.add_column("Files", justify="right")
+    table.add_column("Size", justify="right")
+    table.add_column("%", justify="right")
+    ranked = sorted(usage.items(), key=lambda item: item[1][1], reverse=True)
+    for key, (count, size) in ranked[:top]:
+        table.add_row(key, f"{count:,}", decimal(size), f"{100 * size / total:.1f}")
+    return table
+
+
+@app.command()
+def du(
+    directory: Path,
+    glob: Optional[List[str]] = None,
+    top: int = 20,
+    depth: int = 1,
+    workers: int = 16,
+    cache: bool = True,
+    refresh: bool = False,
+) -> Tuple[Dict[str, List[int]], Dict[str, List[int]]]:
+    """
+    Show where space goes under directory: the top groups of files (by extension,
+    or by --glob patterns) and top directories (--depth levels down) by size.
+
+    The tree is scanned by a pool of workers threads and the scan is cached, so
+    later runs only list directories whose mtime changed. Use --refresh to list
+    every directory again, or --no-cache to not read or write the cache.
+    """
+    cache_path = du_cache_path(directory) if cache else None
+    if refresh and cache_path is not None and os.path.exists(cache_path):
+        os.remove(cache_path)
+    start_time = time.perf_counter()
+    with Progress(
+        SpinnerColumn(),
+        TextColumn("{task.description}"),
+        TimeElapsedColumn(),
+        console=console,
+    ) as progress:
+        records, listed = scan_tree(
+            directory, workers=workers, cache_path=cache_path, progress=progress
+        )
+    patterns = [] if glob is None else glob
+    groups, directories = summarize_usage(records, patterns, depth=depth)
+    n_files = sum(count for count, _ in groups.values())
+    n_bytes = sum(size for _, size in groups.values())
+    console.log(
+        f"{n_files:,} files ({decimal(n_bytes)}) in {len(records):,} directories,"
+        f" listed {listed:,} in {time.perf_counter() - start_time:.1f}s"
+    )
+    console.print(
+        _usage_table(
+            "By pattern" if len(patterns) > 0 else "By extension", "Group", groups, top
+        )
+    )
+    console.print(_usage_table("By directory", "Directory", directories, top))
+    return groups, directories
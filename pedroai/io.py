@@ -1,16 +1,62 @@
+import bz2
+import gc
+import gzip
+import hashlib
 import json
+import lzma
+import math
+import mmap
 import os
+import pickle
+import queue
+import shutil
+import stat
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from contextlib import contextmanager
+from functools import partial
+from io import TextIOWrapper
+from itertools import chain
 from pathlib import Path
-from typing import Any, List, Union
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Union
 
+import numpy as np
 import requests
 import simdjson
+import typer
 from pydantic import BaseModel
 from rich.console import Console
+from rich.progress import DownloadColumn, Progress, TransferSpeedColumn
+
+from pedroai.iter import batched
+from pedroai.log import get_logger
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None  # type: ignore
 
 console = Console()
+log = get_logger(__name__)
+app = typer.Typer()
+
+# Size of the binary reads used when streaming jsonlines files
+CHUNK_SIZE = 1 << 22
 
 
 def shell(command: str):
@@ -21,75 +67,1917 @@ def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
 
-def read_json(path: Union[str, Path]):
+# Compression formats by file extension and by the magic bytes files start with
+COMPRESSION_EXTENSIONS = {
+    ".gz": "gzip",
+    ".bz2": "bz2",
+    ".xz": "xz",
+    ".lzma": "xz",
+    ".zst": "zstd",
+    ".zstd": "zstd",
+}
+COMPRESSION_MAGIC = {
+    b"\x1f\x8b": "gzip",
+    b"BZh": "bz2",
+    b"\xfd7zXZ\x00": "xz",
+    b"\x28\xb5\x2f\xfd": "zstd",
+}
+DEFAULT_COMPRESSION_LEVELS = {"gzip": 6, "bz2": 9, "xz": 6, "zstd": 3}
+
+
+def detect_compression(path: Union[str, Path], sniff: bool = True) -> Optional[str]:
+    """
+    Return the compression format of a file (gzip, bz2, xz or zstd) or None if it
+    is not compressed. The format is inferred from the extension, or if that is
+    not a known one and sniff is True, from the first bytes of the file.
+    """
+    compression = COMPRESSION_EXTENSIONS.get(Path(path).suffix.lower())
+    if compression is not None or not sniff or not os.path.isfile(path):
+        return compression
+    with open(path, "rb") as f:
+        header = f.read(6)
+    for magic, magic_compression in COMPRESSION_MAGIC.items():
+        if header.startswith(magic):
+            return magic_compression
+    return None
+
+
+def _require_zstandard():
+    if zstandard is None:
+        raise ImportError(
+            "Reading or writing zstd files requires: pip install pedroai[zstd]"
+        )
+    return zstandard
+
+
+def open_compressed(
+    path: Union[str, Path],
+    mode: str = "rb",
+    compression: Optional[str] = "infer",
+    compresslevel: Optional[int] = None,
+):
+    """
+    Open a binary or text file, transparently (de)compressing gzip, bz2, xz and
+    zstd. By default the compression is inferred by detect_compression, for writes
+    only the extension is used. Concatenated compressed streams are read back to
+    back, like zcat does.
+    """
+    if compression == "infer":
+        compression = detect_compression(path, sniff="r" in mode)
+    binary_mode = mode.replace("t", "")
+    if "b" not in binary_mode:
+        binary_mode += "b"
+
+    f: Any
+    if compression is None:
+        f = open(path, binary_mode)  # pylint: disable=consider-using-with
+    elif compression not in DEFAULT_COMPRESSION_LEVELS:
+        raise ValueError(f"Unknown compression: {compression}")
+    else:
+        if compresslevel is None:
+            compresslevel = DEFAULT_COMPRESSION_LEVELS[compression]
+        if compression == "gzip":
+            f = gzip.open(path, binary_mode, compresslevel=compresslevel)
+        elif compression == "bz2":
+            f = bz2.open(path, binary_mode, compresslevel=compresslevel)
+        elif compression == "xz":
+            f = lzma.open(
+                path, binary_mode, preset=None if "r" in mode else compresslevel
+            )
+        else:
+            raw = open(path, binary_mode)  # pylint: disable=consider-using-with
+            if "r" in mode:
+                f = (
+                    _require_zstandard()
+                    .ZstdDecompressor()
+                    .stream_reader(raw, read_across_frames=True, closefd=True)
+                )
+            else:
+                f = (
+                    _require_zstandard()
+                    .ZstdCompressor(level=compresslevel)
+                    .stream_writer(raw, closefd=True)
+                )
+
+    if "b" in mode:
+        return f
+    else:
+        return TextIOWrapper(f, encoding="utf-8")
+
+
+class _BackgroundReader:
     """
-    Read a json file from a string path
+    Read a binary file in a background thread, queueing up to max_chunks chunks.
+    For compressed files this overlaps decompression, which releases the GIL, with
+    parsing in the calling thread.
     """
-    with open(path) as f:
-        return simdjson.load(f)  # type: ignore
 
+    def __init__(self, f, chunk_size: int = CHUNK_SIZE, max_chunks: int = 4):
+        self._f = f
+        self._chunk_size = chunk_size
+        self._queue: queue.Queue = queue.Queue(maxsize=max_chunks)
+        self._closed = threading.Event()
+        self._buffer = b""
+        self._eof = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
 
-def write_json(path: Union[str, Path], obj: Any):
+    def _put(self, item) -> bool:
+        while not self._closed.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _run(self):
+        try:
+            while True:
+                chunk = self._f.read(self._chunk_size)
+                if not self._put(chunk) or not chunk:
+                    return
+        except Exception as e:  # pylint: disable=broad-except
+            self._put(e)
+
+    def _next_chunk(self) -> bytes:
+        if self._eof:
+            return b""
+        chunk = self._queue.get()
+        if isinstance(chunk, Exception):
+            self._eof = True
+            raise chunk
+        if not chunk:
+            self._eof = True
+        return chunk
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            chunks = [self._buffer]
+            self._buffer = b""
+            while True:
+                chunk = self._next_chunk()
+                if not chunk:
+                    return b"".join(chunks)
+                chunks.append(chunk)
+        if not self._buffer:
+            self._buffer = self._next_chunk()
+        out = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return out
+
+    def close(self):
+        self._closed.set()
+        self._thread.join()
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _open_for_read(path: Union[str, Path]):
+    """
+    Open a file for binary reading, decompressing in a background thread if needed
+    """
+    compression = detect_compression(path)
+    if compression is None:
+        return open(path, "rb")  # pylint: disable=consider-using-with
+    else:
+        return _BackgroundReader(open_compressed(path, "rb", compression=compression))
+
+
+def _fsync_path(path: Union[str, Path]):
+    """
+    Flush a file or directory's contents to disk
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    except OSError:
+        # Some platforms and filesystems don't support syncing directories
+        pass
+    finally:
+        os.close(fd)
+
+
+def _temp_path(path: Union[str, Path]) -> str:
+    """
+    Create an empty temporary file next to path, with the permissions a new file
+    at path would get
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=f".{name}.", suffix=".tmp")
+    os.close(fd)
+    if os.path.exists(path):
+        mode = os.stat(path).st_mode
+    else:
+        umask = os.umask(0)
+        os.umask(umask)
+        mode = 0o666 & ~umask
+    os.chmod(temp_path, stat.S_IMODE(mode))
+    return temp_path
+
+
+def _commit_temp_path(temp_path: str, path: Union[str, Path]):
+    """
+    Sync a finished temporary file to disk and atomically move it to path
+    """
+    _fsync_path(temp_path)
+    os.replace(temp_path, path)
+    _fsync_path(os.path.dirname(os.path.abspath(path)))
+
+
+@contextmanager
+def atomic_path(path: Union[str, Path]):
+    """
+    Yield a temporary path to write to instead of path. If the block succeeds, the
+    temporary file is synced to disk and renamed to path, otherwise it is deleted.
+    Readers either see the old file or the complete new one, never a partial write.
+
+    with atomic_path("model.pt") as temp_path:
+        torch.save(model, temp_path)
+    """
+    temp_path = _temp_path(path)
+    try:
+        yield temp_path
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    _commit_temp_path(temp_path, path)
+
+
+CACHE_DIR = os.environ.get(
+    "PEDROAI_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "pedroai")
+)
+_MISSING = object()
+
+
+def _hash_file(path: Union[str, Path]) -> str:
+    digest = hashlib.blake2b()
+    with open(path, "rb") as f:
+        for chunk in iter(partial(f.read, CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ParseCache:
+    """
+    Cache of parsed files, pickled to cache_dir and kept in an in-process LRU of
+    pickled bytes up to memory_budget bytes. Entries are keyed by the file's path,
+    size and mtime, and optionally a hash of its contents, so modified files are
+    parsed again. Unpickling is much faster than parsing json, and since the LRU
+    holds bytes, every hit returns a fresh copy that callers can mutate.
+    """
+
+    def __init__(
+        self, cache_dir: Optional[Union[str, Path]] = None, memory_budget: int = 1 << 30
+    ):
+        self.cache_dir = Path(
+            os.path.join(CACHE_DIR, "parsed") if cache_dir is None else cache_dir
+        )
+        self.memory_budget = memory_budget
+        self._entries: "OrderedDict[str, bytes]" = OrderedDict()
+        self._memory = 0
+        self._lock = threading.Lock()
+
+    def key(
+        self,
+        path: Union[str, Path],
+        kind: str,
+        options: Optional[Dict[str, Any]] = None,
+        content_hash: bool = False,
+    ) -> str:
+        """
+        Return the cache key of a file parsed as kind with the given options
+        """
+        file_stat = os.stat(path)
+        parts = [
+            os.path.abspath(path),
+            file_stat.st_size,
+            file_stat.st_mtime_ns,
+            kind,
+            options,
+            _hash_file(path) if content_hash else None,
+        ]
+        return hashlib.sha256(json.dumps(parts).encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.pkl"
+
+    def _remember(self, key: str, payload: bytes):
+        with self._lock:
+            if key in self._entries:
+                self._memory -= len(self._entries.pop(key))
+            if len(payload) > self.memory_budget:
+                return
+            self._entries[key] = payload
+            self._memory += len(payload)
+            while self._memory > self.memory_budget:
+                _, evicted = self._entries.popitem(last=False)
+                self._memory -= len(evicted)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        with self._lock:
+            payload = self._entries.get(key)
+            if payload is not None:
+                self._entries.move_to_end(key)
+        if payload is None:
+            try:
+                with open(self._path(key), "rb") as f:
+                    payload = f.read()
+            except FileNotFoundError:
+                return default
+            self._remember(key, payload)
+        with _gc_paused():
+            return pickle.loads(payload)
+
+    def put(self, key: str, value: Any):
+        payload = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        self._remember(key, payload)
+        try:
+            os.makedirs(self._path(key).parent, exist_ok=True)
+            with atomic_path(self._path(key)) as temp_path:
+                with open(temp_path, "wb") as f:
+                    f.write(payload)
+        except OSError as e:
+            log.warning("Could not write parse cache entry %s: %s", key, e)
+
+    def clear(self, disk: bool = True):
+        """
+        Empty the in-memory cache, and the cache directory if disk is True
+        """
+        with self._lock:
+            self._entries.clear()
+            self._memory = 0
+        if disk and self.cache_dir.exists():
+            shutil.rmtree(self.cache_dir)
+
+
+parse_cache = ParseCache()
+
+
+def _cached(
+    path: Union[str, Path],
+    kind: str,
+    options: Dict[str, Any],
+    content_hash: bool,
+    parse: Callable[[], Any],
+):
+    key = parse_cache.key(path, kind, options, content_hash=content_hash)
+    value = parse_cache.get(key, default=_MISSING)
+    if value is _MISSING:
+        value = parse()
+        parse_cache.put(key, value)
+    return value
+
+
+def read_json(path: Union[str, Path], cache: bool = False, content_hash: bool = False):
+    """
+    Read a json file from a string path, which may be compressed.
+    If cache is True, the parsed result is cached by parse_cache, see ParseCache.
+    """
+    if cache:
+        return _cached(path, "json", {}, content_hash, lambda: read_json(path))
+    with _open_for_read(path) as f:
+        return simdjson.loads(f.read())  # type: ignore
+
+
+def write_json(
+    path: Union[str, Path],
+    obj: Any,
+    compresslevel: Optional[int] = None,
+    atomic: bool = False,
+):
     """
     Write an object to a string path as json.
-    If the object is a pydantic model, export it to json
+    If the object is a pydantic model, export it to json.
+    If the path ends in .gz, .bz2, .xz or .zst it is compressed.
+    If atomic is True, the file is replaced atomically, see atomic_path.
     """
+    if atomic:
+        compression = detect_compression(path, sniff=False)
+        with atomic_path(path) as temp_path:
+            with open_compressed(
+                temp_path, "w", compression=compression, compresslevel=compresslevel
+            ) as f:
+                _write_json_file(f, obj)
+    else:
+        with open_compressed(path, "w", compresslevel=compresslevel) as f:
+            _write_json_file(f, obj)
+
+
+def _write_json_file(f, obj: Any):
     if isinstance(obj, BaseModel):
-        with open(path, "w") as f:
-            f.write(obj.json())
+        f.write(obj.json())
     else:
-        with open(path, "w") as f:
-            json.dump(obj, f)
+        json.dump(obj, f)
 
 
-def _read_jsonlines_list(path: Union[str, Path]):
+def _split_lines(buffer: bytes) -> List[bytes]:
     """
-    Read a jsonlines file into memory all at once
+    Split a buffer of complete lines, dropping blank lines
+    """
+    return [line for line in buffer.split(b"\n") if line and not line.isspace()]
+
+
+def _iter_file_lines(
+    f, start: int = 0, end: Optional[int] = None, chunk_size: int = CHUNK_SIZE
+):
+    """
+    Read a binary file in large chunks between byte offsets start and end,
+    yielding the non-blank lines of each chunk as a list of bytes.
+
+    Lines are split in C with bytes.split rather than one readline call per line,
+    and are never decoded to str since simdjson parses bytes directly.
+    """
+    if start != 0:
+        f.seek(start)
+    remaining = None if end is None else end - start
+    # Holds the pieces of a line that spans chunk boundaries
+    tail: List[bytes] = []
+    while remaining is None or remaining > 0:
+        chunk = f.read(chunk_size if remaining is None else min(chunk_size, remaining))
+        if not chunk:
+            break
+        if remaining is not None:
+            remaining -= len(chunk)
+        last_newline = chunk.rfind(b"\n")
+        if last_newline == -1:
+            tail.append(chunk)
+            continue
+        tail.append(chunk[: last_newline + 1])
+        yield _split_lines(b"".join(tail))
+        tail = [chunk[last_newline + 1 :]]
+    if tail:
+        yield _split_lines(b"".join(tail))
+
+
+def _iter_mmap_lines(
+    f, start: int = 0, end: Optional[int] = None, chunk_size: int = CHUNK_SIZE
+):
+    """
+    Memory map a binary file and yield the non-blank lines between byte offsets
+    start and end, one list of bytes per chunk of roughly chunk_size bytes
+    """
+    size = os.fstat(f.fileno()).st_size
+    end = size if end is None else min(end, size)
+    if end <= start:
+        return
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        position = start
+        while position < end:
+            newline = mapped.find(b"\n", min(position + chunk_size, end) - 1, end)
+            chunk_end = end if newline == -1 else newline + 1
+            yield _split_lines(mapped[position:chunk_end])
+            position = chunk_end
+
+
+def _iter_jsonlines_chunks(
+    path: Union[str, Path],
+    start: int = 0,
+    end: Optional[int] = None,
+    use_mmap: bool = False,
+):
+    """
+    Yield the raw lines of a jsonlines file between byte offsets start and end,
+    one list of lines per chunk read from the file. Compressed files are streamed
+    from start to finish and can't be memory mapped.
+    """
+    if detect_compression(path) is not None:
+        if start != 0 or end is not None:
+            raise ValueError("Byte ranges are not supported for compressed files")
+        with _open_for_read(path) as f:
+            yield from _iter_file_lines(f)
+        return
+
+    with open(path, "rb") as f:
+        if use_mmap:
+            yield from _iter_mmap_lines(f, start=start, end=end)
+        else:
+            yield from _iter_file_lines(f, start=start, end=end)
+
+
+@contextmanager
+def _gc_paused():
+    """
+    Parsed json objects never contain reference cycles, but allocating millions of
+    them repeatedly triggers the cyclic garbage collector, which can take over half
+    the time spent building large lists of records.
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def _path_tokens(path: str) -> List[str]:
+    """
+    Split a field path into its keys, paths starting with / are json pointers
+    (RFC 6901) and all others are dotted paths like a.b.0
+    """
+    if path.startswith("/"):
+        return [t.replace("~1", "/").replace("~0", "~") for t in path[1:].split("/")]
+    elif path == "":
+        return []
+    else:
+        return path.split(".")
+
+
+def _path_pointer(path: str) -> str:
+    """
+    Convert a field path to a json pointer
+    """
+    return "".join(
+        "/" + t.replace("~", "~0").replace("/", "~1") for t in _path_tokens(path)
+    )
+
+
+def _path_pointer_key(key: str) -> str:
+    """
+    Return the json pointer to a top level key
+    """
+    return "/" + key.replace("~", "~0").replace("/", "~1")
+
+
+def get_path(obj: Any, path: str, default: Any = None) -> Any:
+    """
+    Return the value at path in a parsed json object, or default if it is missing.
+    Paths are either dotted like authors.0.name or json pointers like
+    /authors/0/name.
+    """
+    value = obj
+    for token in _path_tokens(path):
+        if isinstance(value, dict):
+            if token not in value:
+                return default
+            value = value[token]
+        elif isinstance(value, list):
+            try:
+                value = value[int(token)]
+            except (ValueError, IndexError):
+                return default
+        else:
+            return default
+    return value
+
+
+def project(obj: Any, fields: List[str]) -> Dict[str, Any]:
+    """
+    Select fields from a parsed json object, returning a dictionary from each
+    field path to its value (None if missing)
+    """
+    return {field: get_path(obj, field) for field in fields}
+
+
+def _jsonlines_parser(fields: Optional[List[str]] = None) -> Callable[[bytes], Any]:
+    """
+    Return a function that parses one jsonlines line. Without fields the whole
+    line is converted to python objects, with fields simdjson's lazy proxy is kept
+    and only the selected values are converted.
     """
     parser = simdjson.Parser()
+    if fields is None:
+        return partial(parser.parse, recursive=True)
+
+    pointers = [(field, _path_pointer(field)) for field in fields]
+
+    def parse_fields(line: bytes) -> Dict[str, Any]:
+        doc = parser.parse(line)
+        if not isinstance(doc, (simdjson.Object, simdjson.Array)):
+            # Scalars have no fields
+            return {field: None for field in fields}
+        out: Dict[str, Any] = {}
+        for field, pointer in pointers:
+            try:
+                value = doc.at_pointer(pointer)
+            except (KeyError, IndexError, TypeError):
+                value = None
+            if isinstance(value, simdjson.Object):
+                out[field] = value.as_dict()
+            elif isinstance(value, simdjson.Array):
+                out[field] = value.as_list()
+            else:
+                out[field] = value
+        return out
+
+    return parse_fields
+
+
+def _read_jsonlines_list(
+    path: Union[str, Path],
+    start: int = 0,
+    end: Optional[int] = None,
+    use_mmap: bool = False,
+    fields: Optional[List[str]] = None,
+):
+    """
+    Read a jsonlines file into memory all at once
+    """
+    parse = _jsonlines_parser(fields)
     out = []
-    with open(path) as f:
-        for line in f:
-            out.append(parser.parse(line, recursive=True))
+    with _gc_paused():
+        for lines in _iter_jsonlines_chunks(
+            path, start=start, end=end, use_mmap=use_mmap
+        ):
+            out.extend([parse(line) for line in lines])
     return out
 
 
-def _read_jsonlines_lazy(path: Union[str, Path]):
+def _read_jsonlines_lazy(
+    path: Union[str, Path], use_mmap: bool = False, fields: Optional[List[str]] = None
+):
     """
     Lazily return the contents of a jsonlines file
     """
-    parser = simdjson.Parser()
-    with open(path) as f:
-        for line in f:
-            yield parser.parse(line, recursive=True)
+    parse = _jsonlines_parser(fields)
+    for lines in _iter_jsonlines_chunks(path, use_mmap=use_mmap):
+        for line in lines:
+            yield parse(line)
+
 
+def _read_jsonlines_lazy_batches(
+    path: Union[str, Path],
+    batch_size: int,
+    use_mmap: bool = False,
+    fields: Optional[List[str]] = None,
+):
+    """
+    Lazily return the contents of a jsonlines file in lists of batch_size objects
+    """
+    parse = _jsonlines_parser(fields)
+    lines = chain.from_iterable(_iter_jsonlines_chunks(path, use_mmap=use_mmap))
+    for batch in batched(lines, batch_size):
+        yield [parse(line) for line in batch]
 
-def read_jsonlines(path: Union[str, Path], lazy: bool = False):
+
+def _jsonlines_ranges(path: Union[str, Path], n_shards: int) -> List[Tuple[int, int]]:
+    """
+    Split a jsonlines file into at most n_shards byte ranges that start and end
+    on line boundaries
+    """
+    size = os.path.getsize(path)
+    boundaries = [0]
+    with open(path, "rb") as f:
+        for i in range(1, n_shards):
+            offset = size * i // n_shards
+            if offset <= boundaries[-1]:
+                continue
+            # Back up one byte so that a boundary already on a line start is kept
+            f.seek(offset - 1)
+            f.readline()
+            offset = f.tell()
+            if offset >= size:
+                break
+            if offset > boundaries[-1]:
+                boundaries.append(offset)
+    boundaries.append(size)
+    return [
+        (start, end) for start, end in zip(boundaries, boundaries[1:]) if end > start
+    ]
+
+
+def _parse_jsonlines(lines: List[bytes], fields: Optional[List[str]] = None):
+    """
+    Parse a list of raw jsonlines lines, run in worker processes
+    """
+    parse = _jsonlines_parser(fields)
+    with _gc_paused():
+        return [parse(line) for line in lines]
+
+
+def _jsonlines_parallel_tasks(
+    path: Union[str, Path],
+    workers: int,
+    use_mmap: bool = False,
+    fields: Optional[List[str]] = None,
+):
+    """
+    Yield (function, args) pairs whose results are consecutive shards of a
+    jsonlines file
+    """
+    if detect_compression(path) is None:
+        # More shards than workers balances uneven lines and keeps lazy readers streaming
+        for start, end in _jsonlines_ranges(path, workers * 4):
+            yield _read_jsonlines_list, (path, start, end, use_mmap, fields)
+    else:
+        # Compressed files can't be split by byte offset, so they are decompressed
+        # here and the raw lines are parsed in the pool
+        for lines in _iter_jsonlines_chunks(path):
+            yield _parse_jsonlines, (lines, fields)
+
+
+def _read_jsonlines_parallel(
+    path: Union[str, Path],
+    workers: int,
+    ordered: bool = True,
+    use_mmap: bool = False,
+    fields: Optional[List[str]] = None,
+):
+    """
+    Parse shards of a jsonlines file in a process pool, yielding one list of
+    parsed objects per shard. Uncompressed files are sharded by byte ranges that
+    workers read themselves. At most 2 * workers shards are in flight so that lazy
+    consumers bound memory use.
+    """
+    tasks = _jsonlines_parallel_tasks(path, workers, use_mmap=use_mmap, fields=fields)
+    max_pending = workers * 2
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        if ordered:
+            pending: deque = deque()
+            for function, args in tasks:
+                pending.append(executor.submit(function, *args))
+                if len(pending) >= max_pending:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        else:
+            running = set()
+            for function, args in tasks:
+                running.add(executor.submit(function, *args))
+                if len(running) >= max_pending:
+                    done, running = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+            for future in wait(running).done:
+                yield future.result()
+
+
+def _read_jsonlines_parallel_list(
+    path: Union[str, Path],
+    workers: int,
+    ordered: bool = True,
+    use_mmap: bool = False,
+    fields: Optional[List[str]] = None,
+):
+    out = []
+    with _gc_paused():
+        for shard in _read_jsonlines_parallel(
+            path, workers, ordered=ordered, use_mmap=use_mmap, fields=fields
+        ):
+            out.extend(shard)
+    return out
+
+
+def _read_jsonlines_parallel_lazy(
+    path: Union[str, Path],
+    workers: int,
+    ordered: bool = True,
+    use_mmap: bool = False,
+    fields: Optional[List[str]] = None,
+):
+    for shard in _read_jsonlines_parallel(
+        path, workers, ordered=ordered, use_mmap=use_mmap, fields=fields
+    ):
+        yield from shard
+
+
+def read_jsonlines(
+    path: Union[str, Path],
+    lazy: bool = False,
+    workers: Optional[int] = None,
+    ordered: bool = True,
+    batch_size: Optional[int] = None,
+    use_mmap: bool = False,
+    fields: Optional[List[str]] = None,
+    cache: bool = False,
+    content_hash: bool = False,
+):
     """
     Read a jsonlines file as a list/iterator of json objects
+
+    If workers is greater than one, the file is split into newline aligned byte
+    ranges that are parsed in a pool of that many processes. Results are returned
+    in file order unless ordered=False, in which case shards are returned as soon
+    as they are parsed.
+
+    If batch_size is set, lists of up to batch_size objects are returned instead of
+    single objects. With use_mmap=True the file is memory mapped instead of read
+    in chunks.
+
+    If fields is set, each object is a dictionary from field to value that only
+    contains those fields, see project for the path syntax. Only the selected
+    values are converted to python objects, which for wide records is much faster
+    and smaller than materializing the whole record.
+
+    Files compressed with gzip, bz2, xz or zstd are decompressed in a background
+    thread while parsing, see detect_compression.
+
+    If cache is True, the parsed list is cached by parse_cache keyed on the path,
+    size, mtime and, if content_hash is True, a hash of the file, see ParseCache.
     """
-    if lazy:
-        return _read_jsonlines_lazy(path)
+    if cache:
+        if lazy:
+            raise ValueError("Lazy reads can't be cached")
+        return _cached(
+            path,
+            "jsonlines",
+            {"fields": fields, "batch_size": batch_size, "ordered": ordered},
+            content_hash,
+            lambda: read_jsonlines(
+                path,
+                workers=workers,
+                ordered=ordered,
+                batch_size=batch_size,
+                use_mmap=use_mmap,
+                fields=fields,
+            ),
+        )
+    if workers is not None and workers > 1:
+        if lazy:
+            out = _read_jsonlines_parallel_lazy(
+                path, workers, ordered=ordered, use_mmap=use_mmap, fields=fields
+            )
+        else:
+            out = _read_jsonlines_parallel_list(
+                path, workers, ordered=ordered, use_mmap=use_mmap, fields=fields
+            )
+    elif lazy:
+        if batch_size is not None:
+            return _read_jsonlines_lazy_batches(
+                path, batch_size, use_mmap=use_mmap, fields=fields
+            )
+        out = _read_jsonlines_lazy(path, use_mmap=use_mmap, fields=fields)
+    else:
+        out = _read_jsonlines_list(path, use_mmap=use_mmap, fields=fields)
+
+    if batch_size is None:
+        return out
+    elif lazy:
+        return batched(out, batch_size)
+    else:
+        return list(batched(out, batch_size))
+
+
+def _json_default(obj: Any) -> Any:
+    """
+    Serialize objects the json encoders don't know about, like nested pydantic models
+    """
+    if isinstance(obj, BaseModel):
+        return obj.dict()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps_jsonline(obj: Any) -> bytes:
+    """
+    Serialize an object to one line of json as bytes, using orjson if it is
+    installed and the standard library otherwise. Pydantic models are exported
+    with their own json method, like in write_json.
+    """
+    if isinstance(obj, BaseModel):
+        return obj.json().encode("utf-8")
+    if orjson is not None:
+        try:
+            out = orjson.dumps(
+                obj, default=_json_default, option=orjson.OPT_NON_STR_KEYS
+            )
+            # orjson writes NaN and Infinity as null, unlike the standard library
+            if b"null" not in out or not _has_non_finite(obj):
+                return out
+        except orjson.JSONEncodeError:
+            # Fall back for values orjson rejects, like integers over 64 bits
+            pass
+    # Match orjson's compact, unescaped output so the line does not depend on what is installed
+    return json.dumps(
+        obj, default=_json_default, separators=(",", ":"), ensure_ascii=False
+    ).encode("utf-8")
+
+
+def _has_non_finite(obj: Any) -> bool:
+    if isinstance(obj, float):
+        return not math.isfinite(obj)
+    if isinstance(obj, dict):
+        return any(_has_non_finite(value) for value in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return any(_has_non_finite(value) for value in obj)
+    if isinstance(obj, BaseModel):
+        return _has_non_finite(obj.dict())
+    return False
+
+
+def _compressed_segment_writer(
+    raw, compression: Optional[str], compresslevel: Optional[int] = None
+):
+    """
+    Wrap an open binary file in a compressor whose close ends the compressed stream
+    but leaves the underlying file open
+    """
+    if compression is None:
+        return raw
+    if compresslevel is None:
+        compresslevel = DEFAULT_COMPRESSION_LEVELS[compression]
+    if compression == "gzip":
+        return gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=compresslevel)
+    elif compression == "bz2":
+        return bz2.BZ2File(raw, "wb", compresslevel=compresslevel)
+    elif compression == "xz":
+        return lzma.LZMAFile(raw, "wb", preset=compresslevel)
+    elif compression == "zstd":
+        return (
+            _require_zstandard()
+            .ZstdCompressor(level=compresslevel)
+            .stream_writer(raw, closefd=False)
+        )
     else:
-        return _read_jsonlines_list(path)
+        raise ValueError(f"Unknown compression: {compression}")
 
 
-def write_jsonlines(path: Union[str, Path], elements: List[Any]):
+def _checkpoint_path(path: Union[str, Path]) -> str:
+    directory, name = os.path.split(os.path.abspath(path))
+    return os.path.join(directory, f".{name}.checkpoint")
+
+
+def _write_checkpoint(path: Union[str, Path], offset: int):
+    with atomic_path(_checkpoint_path(path)) as temp_path:
+        with open(temp_path, "w") as f:
+            f.write(str(offset))
+
+
+class JsonlWriter:
     """
-    Write a list of json serialiazable objects to the path given
+    Incrementally write json objects to a jsonlines file, buffering serialized
+    lines in memory and writing them in blocks of about buffer_size bytes.
+    If the path ends in .gz, .bz2, .xz or .zst it is compressed.
+
+    with JsonlWriter("predictions.jsonl") as writer:
+        for prediction in predict():
+            writer.write(prediction)
+
+    If atomic is True, lines are written to a temporary file that replaces path
+    only once the writer is closed without an error, see atomic_path.
+
+    If append is True, lines are appended to path and committed by checkpoint,
+    which syncs them to disk and records the committed size in a hidden
+    .<name>.checkpoint file. If the process dies, the next append writer truncates
+    the file back to the last checkpoint, so preempted jobs can resume without
+    leaving partial lines behind. Compressed files get one compressed stream per
+    checkpoint, which readers decompress back to back.
     """
-    with open(path, "w") as f:
-        for e in elements:
-            f.write(json.dumps(e))
-            f.write("\n")
+
+    def __init__(
+        self,
+        path: Union[str, Path],
+        compresslevel: Optional[int] = None,
+        buffer_size: int = CHUNK_SIZE,
+        atomic: bool = False,
+        append: bool = False,
+    ):
+        if atomic and append:
+            raise ValueError("Atomic and append writes can't be combined")
+        self.path = path
+        self.count = 0
+        self._buffer_size = buffer_size
+        self._buffer: List[bytes] = []
+        self._buffered = 0
+        self._compression = detect_compression(path, sniff=False)
+        self._compresslevel = compresslevel
+        self._atomic = atomic
+        self._append = append
+        self._temp_path: Optional[str] = None
+        self._raw = None
+        self._f: Any = None
+        if append:
+            self._committed = self._recover()
+            self._raw = open(path, "ab")  # pylint: disable=consider-using-with
+            _write_checkpoint(path, self._committed)
+        elif atomic:
+            self._temp_path = _temp_path(path)
+            self._f = open_compressed(
+                self._temp_path,
+                "wb",
+                compression=self._compression,
+                compresslevel=compresslevel,
+            )
+        else:
+            self._f = open_compressed(path, "wb", compresslevel=compresslevel)
+
+    def _recover(self) -> int:
+        """
+        Truncate an appended file to its last checkpoint if a previous writer died,
+        returning the size of the committed file
+        """
+        if not os.path.exists(self.path):
+            return 0
+        checkpoint_path = _checkpoint_path(self.path)
+        if os.path.exists(checkpoint_path):
+            with open(checkpoint_path) as f:
+                committed = int(f.read())
+            if os.path.getsize(self.path) > committed:
+                log.warning(
+                    "Truncating %s to its last checkpoint at %d bytes",
+                    self.path,
+                    committed,
+                )
+                os.truncate(self.path, committed)
+        return os.path.getsize(self.path)
+
+    def write(self, obj: Any):
+        line = dumps_jsonline(obj)
+        self._buffer.append(line)
+        self._buffered += len(line) + 1
+        self.count += 1
+        if self._buffered >= self._buffer_size:
+            self.flush()
+
+    def write_all(self, elements: Iterable[Any]):
+        for batch in batched(elements, 1024):
+            lines = [dumps_jsonline(e) for e in batch]
+            self._buffer.extend(lines)
+            self._buffered += sum(len(line) for line in lines) + len(lines)
+            self.count += len(lines)
+            if self._buffered >= self._buffer_size:
+                self.flush()
+
+    def flush(self):
+        """
+        Write buffered lines to the underlying file
+        """
+        if self._buffer:
+            if self._f is None:
+                # Appended compressed streams are only started once there is data
+                self._f = _compressed_segment_writer(
+                    self._raw, self._compression, self._compresslevel
+                )
+            self._buffer.append(b"")
+            self._f.write(b"\n".join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
+        if self._f is not None:
+            self._f.flush()
+
+    def checkpoint(self):
+        """
+        Commit every line written so far to disk, only available in append mode
+        """
+        if not self._append:
+            raise ValueError("Checkpoints are only supported in append mode")
+        self.flush()
+        if self._f is not None and self._f is not self._raw:
+            self._f.close()
+        self._f = None
+        self._raw.flush()
+        os.fsync(self._raw.fileno())
+        self._committed = self._raw.tell()
+        _write_checkpoint(self.path, self._committed)
+
+    def close(self):
+        if self._append:
+            self.checkpoint()
+            self._raw.close()
+            os.remove(_checkpoint_path(self.path))
+        else:
+            self.flush()
+            self._f.close()
+            if self._atomic:
+                _commit_temp_path(self._temp_path, self.path)
+
+    def abort(self):
+        """
+        Close the writer, discarding everything since the last checkpoint in append
+        mode or the whole file in atomic mode
+        """
+        if self._append:
+            if self._f is not None and self._f is not self._raw:
+                self._f.close()
+            self._raw.truncate(self._committed)
+            self._raw.close()
+            os.remove(_checkpoint_path(self.path))
+        else:
+            self._f.close()
+            if self._atomic:
+                os.remove(self._temp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None and (self._atomic or self._append):
+            self.abort()
+        else:
+            self.close()
 
 
-def download(remote_path, local_path):
+def write_jsonlines(
+    path: Union[str, Path],
+    elements: Iterable[Any],
+    compresslevel: Optional[int] = None,
+    atomic: bool = False,
+):
+    """
+    Write json serialiazable objects (or pydantic models) from a list or any other
+    iterable to the path given, see JsonlWriter.
+    If the path ends in .gz, .bz2, .xz or .zst it is compressed.
+    If atomic is True, the file is replaced atomically, see atomic_path.
+    """
+    with JsonlWriter(path, compresslevel=compresslevel, atomic=atomic) as writer:
+        writer.write_all(elements)
+
+
+# The bytes that bytes.isspace() considers whitespace
+WHITESPACE_BYTES = b" \t\n\r\x0b\x0c"
+
+
+class JsonlIndex:
+    """
+    Random access to the records of an uncompressed jsonlines file through an
+    array of line start offsets. The offsets are saved next to the file as
+    <path>.idx.npy, a uint64 array of [file size, file mtime in ns, offsets...],
+    and rebuilt whenever the file's size or mtime no longer match.
+
+    index = JsonlIndex("data.jsonl")
+    len(index), index[42], index[10:20], index.sample(100, seed=0)
+
+    For SLURM array jobs, each task can read its own contiguous block of records:
+
+    for record in index.shard(task_id, n_tasks):
+        ...
+    """
+
+    def __init__(
+        self,
+        path: Union[str, Path],
+        index_path: Optional[Union[str, Path]] = None,
+        rebuild: bool = False,
+    ):
+        if detect_compression(path) is not None:
+            raise ValueError(f"Compressed files can't be indexed: {path}")
+        self.path = path
+        self.index_path = f"{path}.idx.npy" if index_path is None else index_path
+        self._file = open(path, "rb")  # pylint: disable=consider-using-with
+        file_stat = os.fstat(self._file.fileno())
+        self._size = file_stat.st_size
+        self._mtime_ns = file_stat.st_mtime_ns
+        offsets = None if rebuild else self._load()
+        if offsets is None:
+            offsets = self._build()
+        self._offsets = offsets
+        if self._size == 0:
+            self._mapped = None
+        else:
+            self._mapped = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._parser = simdjson.Parser()
+
+    def _load(self) -> Optional[np.ndarray]:
+        if not os.path.exists(self.index_path):
+            return None
+        saved = np.load(self.index_path, mmap_mode="r")
+        if (
+            saved.dtype != np.uint64
+            or len(saved) < 2
+            or saved[0] != self._size
+            or saved[1] != self._mtime_ns
+        ):
+            log.info("Index is out of date, rebuilding: %s", self.index_path)
+            return None
+        return saved[2:]
+
+    def _build(self) -> np.ndarray:
+        """
+        Find the start of every non-blank line and save the offsets if the index
+        path is writable
+        """
+        newlines = []
+        position = 0
+        self._file.seek(0)
+        while True:
+            chunk = self._file.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            chunk_newlines = np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == 10)
+            newlines.append(chunk_newlines.astype(np.uint64) + np.uint64(position))
+            position += len(chunk)
+        ends = np.concatenate(newlines + [np.array([self._size], dtype=np.uint64)])
+        starts = np.concatenate([np.zeros(1, dtype=np.uint64), ends[:-1] + 1])
+        non_empty = ends > starts
+        offsets, ends = starts[non_empty], ends[non_empty]
+        if len(offsets) > 0:
+            # Only lines that start with whitespace can be blank
+            whitespace = np.frombuffer(WHITESPACE_BYTES, dtype=np.uint8)
+            with mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                first_bytes = np.frombuffer(mapped, dtype=np.uint8)[offsets]
+                blank = [
+                    i
+                    for i in np.flatnonzero(np.isin(first_bytes, whitespace))
+                    if mapped[int(offsets[i]) : int(ends[i])].isspace()
+                ]
+            offsets = np.delete(offsets, blank)
+
+        saved = np.concatenate(
+            [np.array([self._size, self._mtime_ns], dtype=np.uint64), offsets]
+        )
+        try:
+            with atomic_path(self.index_path) as temp_path:
+                with open(temp_path, "wb") as f:
+                    np.save(f, saved)
+        except OSError as e:
+            log.warning("Could not save index, keeping it in memory: %s", e)
+        return offsets
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def read_line(self, i: int) -> bytes:
+        """
+        Return the raw bytes of the i-th record
+        """
+        if i < 0:
+            i += len(self)
+        # Empty files have no records and are not mapped
+        if self._mapped is None or not 0 <= i < len(self):
+            raise IndexError(f"Record index out of range: {i}")
+        start = int(self._offsets[i])
+        end = self._mapped.find(b"\n", start)
+        return self._mapped[start : self._size if end == -1 else end]
+
+    def __getitem__(self, key: Union[int, slice]):
+        if isinstance(key, slice):
+            return [self[i] for i in range(*key.indices(len(self)))]
+        return self._parser.parse(self.read_line(key), recursive=True)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def sample(
+        self, k: int, seed: Optional[int] = None, replace: bool = False
+    ) -> List[Any]:
+        """
+        Return k records chosen uniformly at random
+        """
+        rng = np.random.default_rng(seed)
+        return [self[int(i)] for i in rng.choice(len(self), size=k, replace=replace)]
+
+    def shard(self, index: int, count: int):
+        """
+        Yield the records of the index-th of count contiguous, equally sized shards
+        """
+        if not 0 <= index < count:
+            raise ValueError(f"Invalid shard {index} of {count}")
+        start = len(self) * index // count
+        end = len(self) * (index + 1) // count
+        for i in range(start, end):
+            yield self[i]
+
+    def close(self):
+        if self._mapped is not None:
+            self._mapped.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+COLUMN_STORE_VERSION = 1
+COLUMN_DTYPES = {"bool": np.bool_, "int": np.int64, "float": np.float64}
+
+
+def _column_kind(value: Any) -> str:
+    if isinstance(value, bool):
+        return "bool"
+    elif isinstance(value, int):
+        return "int"
+    elif isinstance(value, float):
+        return "float"
+    elif isinstance(value, str):
+        return "str"
+    else:
+        return "json"
+
+
+def _resolve_column_kind(kinds: set) -> str:
+    """
+    Pick the storage kind of a column from the kinds of its non-null values.
+    Integers mixed with floats are stored as floats, other mixes as json strings.
+    """
+    if len(kinds) == 1:
+        return next(iter(kinds))
+    elif kinds == {"int", "float"}:
+        return "float"
+    else:
+        return "json"
+
+
+def _encode_column_value(kind: str, value: Any) -> bytes:
+    if kind == "str":
+        return value.encode("utf-8")
+    else:
+        return dumps_jsonline(value)
+
+
+def convert_jsonl_to_columns(
+    jsonl_path: Union[str, Path],
+    output_dir: Union[str, Path],
+    columns: Optional[List[str]] = None,
+):
+    """
+    Convert a jsonlines file of objects to a directory of memory mappable columns,
+    read back with ColumnStore. By default every top level key is a column.
+
+    The file is read twice, once to infer the type of each column and once to
+    write the columns, so memory use does not grow with the file. Booleans,
+    integers and floats are stored as .npy arrays, strings as utf-8 data plus an
+    array of offsets and anything else (lists, objects, mixed types) as json
+    strings. Columns with missing or null values get a boolean validity mask.
+    """
+    column_kinds: Dict[str, set] = {}
+    column_nulls: Dict[str, bool] = {}
+    n_rows = 0
+    for record in read_jsonlines(jsonl_path, lazy=True, fields=columns):
+        if columns is None:
+            for name in record:
+                if name not in column_kinds:
+                    column_kinds[name] = set()
+                    column_nulls[name] = n_rows > 0
+            if len(record) < len(column_kinds):
+                for name in column_kinds.keys() - record.keys():
+                    column_nulls[name] = True
+        for name, value in record.items():
+            if value is None:
+                column_nulls[name] = True
+            else:
+                column_kinds.setdefault(name, set()).add(_column_kind(value))
+        n_rows += 1
+    names = list(column_kinds) if columns is None else columns
+    # Discovered keys are top level even if they contain dots, given columns may be
+    # nested paths like meta.label
+    paths = [_path_pointer_key(name) for name in names] if columns is None else names
+    kinds = [_resolve_column_kind(column_kinds.get(name, {"json"})) for name in names]
+    nullable = [column_nulls.get(name, False) for name in names]
+
+    os.makedirs(output_dir, exist_ok=True)
+    output_dir = Path(output_dir)
+    arrays: List[Any] = []
+    offsets: List[Any] = []
+    data_files: List[Any] = []
+    valids: List[Any] = []
+    for i, kind in enumerate(kinds):
+        if kind in COLUMN_DTYPES:
+            arrays.append(
+                np.lib.format.open_memmap(
+                    output_dir / f"{i}.npy",
+                    mode="w+",
+                    dtype=COLUMN_DTYPES[kind],
+                    shape=(n_rows,),
+                )
+            )
+            offsets.append(None)
+            data_files.append(None)
+        else:
+            arrays.append(None)
+            column_offsets = np.lib.format.open_memmap(
+                output_dir / f"{i}.offsets.npy",
+                mode="w+",
+                dtype=np.uint64,
+                shape=(n_rows + 1,),
+            )
+            column_offsets[0] = 0
+            offsets.append(column_offsets)
+            data_files.append(
+                open(  # pylint: disable=consider-using-with
+                    output_dir / f"{i}.data", "wb"
+                )
+            )
+        valids.append(
+            np.lib.format.open_memmap(
+                output_dir / f"{i}.valid.npy",
+                mode="w+",
+                dtype=np.bool_,
+                shape=(n_rows,),
+            )
+            if nullable[i]
+            else None
+        )
+
+    row = 0
+    data_sizes = [0] * len(names)
+    try:
+        for batch in read_jsonlines(
+            jsonl_path, lazy=True, batch_size=65536, fields=paths
+        ):
+            end = row + len(batch)
+            for i, (path, kind) in enumerate(zip(paths, kinds)):
+                values = [record[path] for record in batch]
+                if valids[i] is not None:
+                    valids[i][row:end] = [v is not None for v in values]
+                if kind in COLUMN_DTYPES:
+                    if kind == "float":
+                        values = [np.nan if v is None else v for v in values]
+                    else:
+                        values = [0 if v is None else v for v in values]
+                    arrays[i][row:end] = values
+                else:
+                    encoded = [
+                        b"" if v is None else _encode_column_value(kind, v)
+                        for v in values
+                    ]
+                    data_files[i].write(b"".join(encoded))
+                    lengths = np.fromiter(
+                        (len(e) for e in encoded), dtype=np.uint64, count=len(encoded)
+                    )
+                    offsets[i][row + 1 : end + 1] = np.cumsum(lengths) + np.uint64(
+                        data_sizes[i]
+                    )
+                    data_sizes[i] += int(lengths.sum())
+            row = end
+    finally:
+        for data_file in data_files:
+            if data_file is not None:
+                data_file.close()
+    for array in arrays + offsets + valids:
+        if array is not None:
+            array.flush()
+
+    # The metadata is written last so that partial conversions are not readable
+    write_json(
+        output_dir / "columns.json",
+        {
+            "version": COLUMN_STORE_VERSION,
+            "source": str(jsonl_path),
+            "rows": n_rows,
+            "columns": [
+                {"name": name, "kind": kind, "nullable": null}
+                for name, kind, null in zip(names, kinds, nullable)
+            ],
+        },
+        atomic=True,
+    )
+
+
+class StringColumn:
+    """
+    A memory mapped column of strings (or json values) stored as utf-8 data and
+    an array of row offsets into it. Integer indexing decodes one value, slicing
+    returns another StringColumn without copying.
+    """
+
+    def __init__(self, kind: str, offsets: np.ndarray, data, valid=None):
+        self.kind = kind
+        self._offsets = offsets
+        self._data = data
+        self._valid = valid
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, key: Union[int, slice]):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            stop = max(start, stop)
+            return StringColumn(
+                self.kind,
+                self._offsets[start : stop + 1],
+                self._data,
+                None if self._valid is None else self._valid[start:stop],
+            )
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError(f"Row index out of range: {key}")
+        if self._valid is not None and not self._valid[key]:
+            return None
+        value = bytes(self._data[int(self._offsets[key]) : int(self._offsets[key + 1])])
+        if self.kind == "str":
+            return value.decode("utf-8")
+        else:
+            return json.loads(value)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def to_list(self) -> List[Any]:
+        return list(self)
+
+
+class ColumnStore:
+    """
+    Read a column store written by convert_jsonl_to_columns. Numeric columns are
+    memory mapped numpy arrays and text columns are StringColumns, so loading a
+    store and slicing rows costs no parsing or copying.
+
+    store = ColumnStore("data_columns")
+    store["label"][:1000], store.read(["id", "text"], start=0, stop=100)
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        meta = read_json(self.path / "columns.json")
+        if meta["version"] != COLUMN_STORE_VERSION:
+            raise ValueError(f"Unsupported column store version: {meta['version']}")
+        self._rows = meta["rows"]
+        self._columns = {
+            column["name"]: (i, column) for i, column in enumerate(meta["columns"])
+        }
+        self._cache: Dict[str, Any] = {}
+
+    @property
+    def columns(self) -> List[str]:
+        return list(self._columns)
+
+    def __len__(self) -> int:
+        return self._rows
+
+    def valid(self, name: str) -> Optional[np.ndarray]:
+        """
+        Return the mask of rows where the column is not null, or None if it has
+        no nulls
+        """
+        i, column = self._columns[name]
+        if column["nullable"]:
+            return np.load(self.path / f"{i}.valid.npy", mmap_mode="r")
+        return None
+
+    def __getitem__(self, name: str):
+        if name not in self._cache:
+            i, column = self._columns[name]
+            if column["kind"] in COLUMN_DTYPES:
+                self._cache[name] = np.load(self.path / f"{i}.npy", mmap_mode="r")
+            else:
+                data_path = self.path / f"{i}.data"
+                if os.path.getsize(data_path) == 0:
+                    data: Any = b""
+                else:
+                    data = np.memmap(data_path, dtype=np.uint8, mode="r")
+                self._cache[name] = StringColumn(
+                    column["kind"],
+                    np.load(self.path / f"{i}.offsets.npy", mmap_mode="r"),
+                    data,
+                    self.valid(name),
+                )
+        return self._cache[name]
+
+    def read(
+        self,
+        columns: Optional[List[str]] = None,
+        start: int = 0,
+        stop: Optional[int] = None,
+    ) -> Dict[str, Any]:
+        """
+        Return the rows [start, stop) of the given columns (default all of them)
+        """
+        names = self.columns if columns is None else columns
+        return {name: self[name][start:stop] for name in names}
+
+
+@app.command("columns")
+def convert_jsonl_to_columns_command(
+    jsonl_path: Path,
+    output_dir: Path,
+    column: Optional[List[str]] = typer.Option(
+        None, help="Column to keep, repeat for several, defaults to all"
+    ),
+):
+    """
+    Convert a jsonlines file to a memory mapped column store
+    """
+    convert_jsonl_to_columns(jsonl_path, output_dir, columns=column or None)
+    console.log(f"Wrote {len(ColumnStore(output_dir))} rows to {output_dir}")
+
+
+# Size of the blocks downloads are streamed in
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+# Segmented downloads split files into ranges of at least this many bytes
+SEGMENT_MIN_SIZE = 1 << 20
+SEGMENTS_SUFFIX = ".segments"
+_session: Optional[requests.Session] = None
+_session_lock = threading.Lock()
+
+
+def make_session(pool_size: int = 16) -> requests.Session:
+    """
+    Create a requests session that keeps up to pool_size connections per host open
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_session() -> requests.Session:
+    """
+    Return a requests session shared by downloads so that connections to the same
+    host are pooled and reused
+    """
+    global _session  # pylint: disable=global-statement
+    with _session_lock:
+        if _session is None:
+            _session = make_session()
+        return _session
+
+
+def _content_range_total(response: requests.Response) -> Optional[int]:
+    """
+    Return the full size of the resource from a Content-Range: bytes a-b/size header
+    """
+    content_range = response.headers.get("Content-Range", "")
+    _, _, total = content_range.rpartition("/")
+    return int(total) if total.isdigit() else None
+
+
+def _ranged_size(
+    session: requests.Session, remote_path: str, timeout: float
+) -> Optional[int]:
+    """
+    Return the size of remote_path if the server supports range requests, else None.
+    Servers that reject HEAD, like presigned URLs that only allow GET, are
+    downloaded in one request whose errors are the ones that get reported.
+    """
+    response = session.head(remote_path, allow_redirects=True, timeout=timeout)
+    if not response.ok:
+        return None
+    if response.headers.get("Accept-Ranges", "").lower() != "bytes":
+        return None
+    length = response.headers.get("Content-Length", "")
+    return int(length) if length.isdigit() else None
+
+
+def _segment_ranges(size: int, segments: int) -> List[List[int]]:
+    """
+    Split size bytes into [start, end, downloaded] ranges of roughly equal size
+    """
+    segments = max(1, min(segments, size // SEGMENT_MIN_SIZE))
+    bounds = [size * i // segments for i in range(segments + 1)]
+    return [[start, end, 0] for start, end in zip(bounds, bounds[1:])]
+
+
+def _download_segment(
+    session: requests.Session,
+    remote_path: str,
+    fd: int,
+    segment: List[int],
+    chunk_size: int,
+    timeout: float,
+    stop: threading.Event,
+):
+    """
+    Download the rest of one [start, end, downloaded] range into its place in the
+    file open as fd, counting progress in segment[2]
+    """
+    start, end, _ = segment
+    if start + segment[2] >= end:
+        return
+    headers = {"Range": f"bytes={start + segment[2]}-{end - 1}"}
+    with session.get(
+        remote_path, stream=True, headers=headers, timeout=timeout
+    ) as response:
+        response.raise_for_status()
+        if response.status_code != 206:
+            raise IOError(f"Server ignored the range request for {remote_path}")
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            if stop.is_set():
+                return
+            chunk = chunk[: end - start - segment[2]]
+            view = memoryview(chunk)
+            while len(view) > 0:
+                written = os.pwrite(fd, view, start + segment[2])
+                view = view[written:]
+                segment[2] += written
+    if start + segment[2] != end:
+        # The connection closed early, which is worth retrying unlike local IOErrors
+        raise requests.ConnectionError(
+            f"Incomplete download of {remote_path} bytes {start}-{end - 1}:"
+            f" {segment[2]} of {end - start} bytes"
+        )
+
+
+def _download_segmented(
+    remote_path: str,
+    part_path: str,
+    size: int,
+    segments: int,
+    chunk_size: int,
+    session: requests.Session,
+    progress: bool,
+    callback: Optional[Callable[[int, Optional[int]], None]],
+    timeout: float,
+) -> int:
+    """
+    Download size bytes of remote_path into part_path over parallel range requests,
+    returning the number of bytes that were already downloaded by an earlier attempt.
+
+    part_path is preallocated as a sparse file and each range is written in place.
+    The progress of every range is saved next to part_path, so an interrupted
+    download resumes each range where it stopped.
+    """
+    state_path = part_path + SEGMENTS_SUFFIX
+    state = None
+    if os.path.exists(state_path) and os.path.exists(part_path):
+        state = read_json(state_path)
+        if state["size"] != size or os.path.getsize(part_path) != size:
+            state = None
+    if state is None:
+        state = {"size": size, "segments": _segment_ranges(size, segments)}
+        with open(part_path, "wb") as f:
+            f.truncate(size)
+        write_json(state_path, state, atomic=True)
+    ranges = state["segments"]
+    offset = sum(segment[2] for segment in ranges)
+
+    stop = threading.Event()
+    fd = os.open(part_path, os.O_WRONLY)
+    try:
+        with ThreadPoolExecutor(max_workers=len(ranges)) as executor, Progress(
+            *Progress.get_default_columns(),
+            DownloadColumn(),
+            TransferSpeedColumn(),
+            console=console,
+            disable=not progress,
+        ) as progress_bar:
+            task = progress_bar.add_task(
+                os.path.basename(part_path[: -len(".part")]),
+                total=size,
+                completed=offset,
+            )
+            futures = [
+                executor.submit(
+                    _download_segment,
+                    session,
+                    remote_path,
+                    fd,
+                    segment,
+                    chunk_size,
+                    timeout,
+                    stop,
+                )
+                for segment in ranges
+            ]
+            try:
+                last_save = time.monotonic()
+                pending = set(futures)
+                while len(pending) > 0:
+                    finished, pending = wait(
+                        pending, timeout=0.2, return_when=FIRST_COMPLETED
+                    )
+                    downloaded = sum(segment[2] for segment in ranges)
+                    progress_bar.update(task, completed=downloaded)
+                    if callback is not None:
+                        callback(downloaded, size)
+                    for future in finished:
+                        future.result()
+                    if time.monotonic() - last_save > 1:
+                        write_json(state_path, state, atomic=True)
+                        last_save = time.monotonic()
+            finally:
+                stop.set()
+    finally:
+        os.close(fd)
+        write_json(state_path, state, atomic=True)
+    os.remove(state_path)
+    return offset
+
+
+def download(
+    remote_path: str,
+    local_path: Union[str, Path],
+    chunk_size: int = DOWNLOAD_CHUNK_SIZE,
+    session: Optional[requests.Session] = None,
+    resume: bool = True,
+    progress: bool = True,
+    callback: Optional[Callable[[int, Optional[int]], None]] = None,
+    timeout: float = 60,
+    hasher: Optional[Any] = None,
+    segments: int = 1,
+) -> int:
+    """
+    Download remote_path to local_path, returning the size of the file.
+
+    The response is streamed in chunk_size blocks to local_path + ".part", which is
+    renamed to local_path once complete, so local_path is never a partial file.
+    If resume is True and a .part file exists from an interrupted download, the
+    rest of the file is requested with an HTTP Range header, and the download
+    restarts from scratch if the server does not support ranges.
+
+    If progress is True, a progress bar with the throughput is shown. callback is
+    called after every chunk with the bytes downloaded so far and the total size,
+    if known.
+
+    If hasher (for example hashlib.sha256()) is given, it is updated with the file
+    contents as they stream in, so the file does not have to be read again to
+    verify its checksum.
+
+    If segments is greater than one and the server supports range requests, the
+    file is split into up to that many byte ranges which are downloaded in
+    parallel, each over its own connection. Segmented downloads resume each range
+    separately and update hasher by reading the finished file.
+    """
+    session = get_session() if session is None else session
+    local_path = str(local_path)
+    part_path = local_path + ".part"
+    directory = os.path.dirname(local_path)
+    if directory != "":
+        os.makedirs(directory, exist_ok=True)
+
     console.log(f"Downloading {remote_path} to {local_path}")
-    response = requests.get(remote_path, stream=True)
-    with open(local_path, "w") as f:
-        for data in response.iter_content():
-            f.write(data)
+    start_time = time.perf_counter()
+    size = None
+    if segments > 1:
+        size = _ranged_size(session, remote_path, timeout)
+        if size is None:
+            log.info("Server does not support ranges, downloading in one segment")
+    if size is not None:
+        if not resume:
+            _remove_partial_download(part_path)
+        offset = _download_segmented(
+            remote_path,
+            part_path,
+            size,
+            segments,
+            chunk_size,
+            session,
+            progress,
+            callback,
+            timeout,
+        )
+        if hasher is not None:
+            with open(part_path, "rb") as f:
+                for chunk in iter(partial(f.read, chunk_size), b""):
+                    hasher.update(chunk)
+        _commit_temp_path(part_path, local_path)
+        _log_download(local_path, size, offset, start_time)
+        return size
+
+    if not resume or os.path.exists(part_path + SEGMENTS_SUFFIX):
+        # A segmented .part file is preallocated, so its size is not progress
+        _remove_partial_download(part_path)
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {"Range": f"bytes={offset}-"} if offset > 0 else {}
+    with session.get(
+        remote_path, stream=True, headers=headers, timeout=timeout
+    ) as response:
+        if response.status_code == 416 and _content_range_total(response) == offset:
+            # The previous attempt downloaded everything but was not renamed
+            total: Optional[int] = offset
+            chunks: Iterable[bytes] = []
+        else:
+            response.raise_for_status()
+            if offset > 0 and response.status_code != 206:
+                log.info("Server ignored the range request, restarting download")
+                offset = 0
+            if "Content-Length" in response.headers:
+                total = offset + int(response.headers["Content-Length"])
+            else:
+                total = None
+            chunks = response.iter_content(chunk_size=chunk_size)
+
+        if hasher is not None and offset > 0:
+            with open(part_path, "rb") as f:
+                for chunk in iter(partial(f.read, chunk_size), b""):
+                    hasher.update(chunk)
+
+        downloaded = offset
+        with open(part_path, "ab" if offset > 0 else "wb") as f, Progress(
+            *Progress.get_default_columns(),
+            DownloadColumn(),
+            TransferSpeedColumn(),
+            console=console,
+            disable=not progress,
+        ) as progress_bar:
+            task = progress_bar.add_task(
+                os.path.basename(local_path), total=total, completed=offset
+            )
+            for chunk in chunks:
+                f.write(chunk)
+                if hasher is not None:
+                    hasher.update(chunk)
+                downloaded += len(chunk)
+                progress_bar.update(task, completed=downloaded)
+                if callback is not None:
+                    callback(downloaded, total)
+
+    if total is not None and downloaded != total:
+        raise IOError(
+            f"Incomplete download of {remote_path}: {downloaded} of {total} bytes"
+        )
+    _commit_temp_path(part_path, local_path)
+    _log_download(local_path, downloaded, offset, start_time)
+    return downloaded
+
+
+def _remove_partial_download(part_path: str):
+    for path in (part_path, part_path + SEGMENTS_SUFFIX):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _log_download(local_path: str, downloaded: int, offset: int, start_time: float):
+    elapsed = time.perf_counter() - start_time
+    console.log(
+        f"Downloaded {downloaded / 2**20:.1f} MiB to {local_path} in {elapsed:.1f}s"
+        f" ({(downloaded - offset) / 2**20 / max(elapsed, 1e-9):.1f} MiB/s)"
+    )
 
 
 class requires_file:
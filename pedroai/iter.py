@@ -1,4 +1,4 @@
-from typing import Callable, Dict, Iterable, List, TypeVar
+from typing import Callable, Dict, Generator, Iterable, List, TypeVar
 
 T = TypeVar("T")
 K = TypeVar("K")
@@ -14,3 +14,19 @@ def group_by(func: Callable[[T], K], iterable: Iterable[T]) -> Dict[K, List[T]]:
             entries[key] = [e]
 
     return entries
+
+
+def batched(iterable: Iterable[T], size: int) -> Generator[List[T], None, None]:
+    """
+    Yield lists of up to size consecutive elements of iterable
+    """
+    if size < 1:
+        raise ValueError("Batch size must be at least one")
+    batch: List[T] = []
+    for e in iterable:
+        batch.append(e)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
@@ -1,6 +1,6 @@
 import typer
 
-from pedroai import download, notifications, bibtex, snapshot, files, slurm_logs, slurm_tui
+from pedroai import download, notifications, bibtex, snapshot, files, io, slurm_logs, slurm_tui
 
 def stui():
     app = slurm_tui.SlurmDashboardApp()
@@ -9,9 +9,12 @@ def stui():
 cli = typer.Typer()
 cli.add_typer(bibtex.app, name='bibtex')
 cli.add_typer(files.app, name='files')
+cli.add_typer(io.app, name='io')
 cli.command(name='pushcuts')(notifications.pushcuts_main)
 cli.command(name='download')(download.main)
 cli.command(name='snapshot')(snapshot.main)
+cli.command(name='snapshot-restore')(snapshot.restore_main)
+cli.command(name='snapshot-gc')(snapshot.gc_main)
 cli.command(name='slogs')(slurm_logs.main)
 cli.command(name='stui')(stui)
 
@@ -1,28 +1,690 @@
 import os
-from typing import Optional, List
+from typing import Any, Dict, Iterable, Optional, List, Set, Tuple
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from stat import S_ISDIR
+import errno
+import fcntl
+import fnmatch
+import hashlib
 import random
+import shlex
 import shutil
 import subprocess
+import sys
+import tempfile
+import time
 import os
 import typer
+from pydantic import BaseModel
 from rich.console import Console
 
+from pedroai import io
+
 SNAPSHOT_DIR = os.environ.get("SNAPSHOT_DIR", "snapshotted_experiments")
 
 console = Console()
 cli = typer.Typer()
 
+LINK_MODES = ("hardlink", "reflink", "copy")
+# ioctl that shares the data blocks of two files on copy-on-write filesystems, from linux/fs.h
+FICLONE = 0x40049409
+# copy_file_range and sendfile fail with these when the files do not support them
+COPY_FALLBACK_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF}
+COPY_WORKERS = 16
+
+OBJECTS_DIR = "objects"
+MANIFESTS_DIR = "manifests"
+MANIFEST_VERSION = 1
+# Unreferenced objects younger than this many seconds may belong to a snapshot in progress
+GC_MIN_AGE = 3600
+
+
+class BatchError(Exception):
+    pass
+
+
+class SnapshotStats(BaseModel):
+    files: int = 0
+    total_bytes: int = 0
+    copied: int = 0
+    copied_bytes: int = 0
+    linked: int = 0
+    unchanged: int = 0
+    removed: int = 0
+    elapsed: float = 0
+
+
+def _excluded(name: str, exclude: List[str]) -> bool:
+    return any(fnmatch.fnmatch(name, pattern) for pattern in exclude)
+
+
+def _stat(path: str) -> Optional[os.stat_result]:
+    try:
+        return os.stat(path)
+    except FileNotFoundError:
+        console.log(f"Skipping missing file or broken symlink: {path}")
+        return None
+
+
+def _walk_files(
+    root: str, rel_dir: str, exclude: List[str], skip: Set[str]
+) -> Dict[str, os.stat_result]:
+    files = {}
+    stack = [rel_dir]
+    while len(stack) > 0:
+        rel_dir = stack.pop()
+        with os.scandir(os.path.join(root, rel_dir)) as entries:
+            for entry in entries:
+                if _excluded(entry.name, exclude):
+                    continue
+                rel_path = os.path.join(rel_dir, entry.name)
+                if entry.is_dir():
+                    if os.path.realpath(entry.path) not in skip:
+                        stack.append(rel_path)
+                else:
+                    stat = _stat(entry.path)
+                    if stat is not None:
+                        files[rel_path] = stat
+    return files
+
+
+def git_files(root: str) -> Optional[List[str]]:
+    """
+    Return the tracked and untracked but not ignored files under root relative to
+    root, or None if root is not in a git repository
+    """
+    try:
+        result = subprocess.run(
+            ["git", "ls-files", "-z", "--cached", "--others", "--exclude-standard"],
+            cwd=root, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    paths = result.stdout.decode("utf8", errors="surrogateescape").split("\0")
+    return sorted({path for path in paths if path != ""})
+
+
+def git_ignored(root: str, paths: Iterable[str]) -> Set[str]:
+    """
+    Return the paths, relative to root, that git ignores in root, or an empty set if
+    root is not in a git repository
+    """
+    paths = list(paths)
+    if len(paths) == 0:
+        return set()
+    try:
+        # Exits with 1 if no path is ignored
+        result = subprocess.run(
+            ["git", "check-ignore", "-z", "--stdin"],
+            cwd=root, input="\0".join(paths).encode("utf8", errors="surrogateescape"),
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+        )
+    except OSError:
+        return set()
+    if result.returncode not in (0, 1):
+        return set()
+    ignored = result.stdout.decode("utf8", errors="surrogateescape").split("\0")
+    return {path for path in ignored if path != ""}
+
+
+def list_files(
+    root: str,
+    exclude: List[str],
+    skip: Iterable[str] = (),
+    gitignore: bool = False,
+    workers: int = COPY_WORKERS,
+) -> Dict[str, os.stat_result]:
+    """
+    Return the stat of every file under root keyed by its path relative to root.
+    Like shutil.ignore_patterns, files and directories with a name matching an
+    exclude pattern are skipped, and so are the directories in skip.
+
+    With gitignore=True and root in a git repository, only files listed by
+    git ls-files (tracked, or untracked and not ignored) are included, so ignored
+    data and virtualenv directories are never walked. Files are then stat'ed in a
+    pool of workers threads, which hides the latency of network filesystems.
+    """
+    skip = {os.path.realpath(path) for path in skip}
+    paths = git_files(root) if gitignore else None
+    if paths is None:
+        return _walk_files(root, "", exclude, skip)
+
+    real_root = os.path.realpath(root)
+    skip_prefixes = tuple(
+        os.path.relpath(path, real_root) + os.sep for path in skip
+        if path.startswith(real_root + os.sep)
+    )
+    paths = [
+        path for path in paths
+        if not path.startswith(skip_prefixes)
+        and not any(_excluded(part, exclude) for part in path.split("/"))
+    ]
+    files = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        stats = executor.map(_stat, [os.path.join(root, path) for path in paths])
+        for path, stat in zip(paths, stats):
+            if stat is None:
+                continue
+            rel_path = os.path.normpath(path)
+            if S_ISDIR(stat.st_mode):
+                # Submodules are listed as directories
+                files.update(_walk_files(root, rel_path, exclude, skip))
+            else:
+                files[rel_path] = stat
+    return files
+
+
+def _unchanged(source: os.stat_result, target: os.stat_result) -> bool:
+    # The same quick check as rsync, copies and links keep the size, mtime and mode
+    return (
+        source.st_size == target.st_size
+        and source.st_mtime_ns == target.st_mtime_ns
+        and source.st_mode == target.st_mode
+    )
+
+
+def _copy_range(source_fd: int, target_fd: int, size: int):
+    """
+    Copy size bytes inside the kernel, with copy_file_range where available, which
+    lets NFS 4.2 and copy-on-write filesystems copy without moving the data
+    through this machine, otherwise with sendfile
+    """
+    copied = 0
+    while copied < size:
+        if hasattr(os, "copy_file_range"):
+            sent = os.copy_file_range(source_fd, target_fd, size - copied)
+        else:
+            sent = os.sendfile(target_fd, source_fd, copied, size - copied)
+        if sent == 0:
+            break
+        copied += sent
+
+
+def copy_file(source: str, target: str):
+    """
+    Copy the contents and metadata of source to target like shutil.copy2, using
+    copy_file_range or sendfile when the filesystems support them
+    """
+    with open(source, "rb") as src, open(target, "wb") as dst:
+        try:
+            _copy_range(src.fileno(), dst.fileno(), os.fstat(src.fileno()).st_size)
+        except OSError as e:
+            if e.errno not in COPY_FALLBACK_ERRNOS:
+                raise
+            src.seek(0)
+            dst.seek(0)
+            dst.truncate()
+            shutil.copyfileobj(src, dst, 1 << 20)
+    shutil.copystat(source, target)
+
+
+def _link(source: str, target: str, link_mode: str) -> bool:
+    """
+    Create target from source as a hardlink or reflink, returning False if the
+    filesystem does not support it
+    """
+    try:
+        if link_mode == "hardlink":
+            os.link(source, target)
+        else:
+            with open(source, "rb") as src, open(target, "wb") as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            shutil.copystat(source, target)
+        return True
+    except OSError:
+        if os.path.exists(target):
+            os.remove(target)
+        return False
+
+
+def latest_snapshot(base_dir: str, exclude: Optional[Path] = None) -> Optional[Path]:
+    """
+    Return the most recently modified experiment_* directory in base_dir
+    """
+    if not os.path.isdir(base_dir):
+        return None
+    snapshots = [
+        path for path in Path(base_dir).glob("experiment_*")
+        if path.is_dir() and (exclude is None or path.resolve() != exclude.resolve())
+    ]
+    if len(snapshots) == 0:
+        return None
+    return max(snapshots, key=lambda path: path.stat().st_mtime_ns)
+
+
+def _sync_file(
+    source_dir: str,
+    target_dir: str,
+    rel_path: str,
+    replace: bool,
+    link_dest: Optional[str],
+    link_mode: str,
+) -> bool:
+    """
+    Link or copy one file into target_dir, returning whether it was linked
+    """
+    target = os.path.join(target_dir, rel_path)
+    if replace:
+        # Never write through a link shared with another snapshot
+        os.remove(target)
+    if link_dest is not None and _link(os.path.join(link_dest, rel_path), target, link_mode):
+        return True
+    copy_file(os.path.join(source_dir, rel_path), target)
+    return False
+
+
+def sync_tree(
+    source_dir: str,
+    target_dir: str,
+    exclude: List[str],
+    link_dest: Optional[str] = None,
+    link_mode: str = "hardlink",
+    dry_run: bool = False,
+    skip: Iterable[str] = (),
+    gitignore: bool = False,
+    workers: int = COPY_WORKERS,
+) -> SnapshotStats:
+    """
+    Make target_dir a copy of source_dir, like rsync --delete --link-dest.
+
+    Files already in target_dir with the same size, mtime and mode are kept.
+    Otherwise, files that are unchanged in the link_dest snapshot are hardlinked or
+    reflinked from it (per link_mode) and the rest are copied. Files that are no
+    longer in source_dir are removed, unless gitignore is True and git ignores
+    them. Directories in skip, like the snapshot directory itself, are not copied.
+    See list_files for gitignore.
+
+    Source files are listed once, then linked and copied by a pool of workers
+    threads, since on network filesystems each file costs several round trips.
+
+    Hardlinked files share their contents with the previous snapshot, so they must
+    be replaced rather than edited in place. Reflinks do not have this problem but
+    need a copy-on-write filesystem, otherwise files are copied.
+    """
+    if link_mode not in LINK_MODES:
+        raise ValueError(f"Invalid link mode: {link_mode}, expected one of {LINK_MODES}")
+    start_time = time.perf_counter()
+    stats = SnapshotStats()
+    source = list_files(
+        source_dir, exclude, skip=[target_dir, *skip], gitignore=gitignore, workers=workers
+    )
+    # Like rsync --delete, excluded files such as outputs are left in target_dir
+    existing = list_files(target_dir, exclude) if os.path.isdir(target_dir) else {}
+    reference = {}
+    if link_dest is not None and link_mode != "copy":
+        reference = list_files(link_dest, [])
+
+    # (rel_path, replace, link_dest) of files to link or copy
+    pending: List[Tuple[str, bool, Optional[str]]] = []
+    for rel_path, source_stat in source.items():
+        stats.files += 1
+        stats.total_bytes += source_stat.st_size
+        if rel_path in existing and _unchanged(source_stat, existing[rel_path]):
+            stats.unchanged += 1
+            continue
+        linkable = rel_path in reference and _unchanged(source_stat, reference[rel_path])
+        pending.append((rel_path, rel_path in existing, link_dest if linkable else None))
+
+    if dry_run:
+        linked = [item[2] is not None for item in pending]
+    else:
+        for directory in sorted({os.path.dirname(item[0]) for item in pending}):
+            os.makedirs(os.path.join(target_dir, directory), exist_ok=True)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            linked = list(executor.map(
+                lambda rel_path, replace, dest: _sync_file(
+                    source_dir, target_dir, rel_path, replace, dest, link_mode
+                ),
+                *zip(*pending),
+            ))
+    for (rel_path, _, _), was_linked in zip(pending, linked):
+        if was_linked:
+            stats.linked += 1
+        else:
+            stats.copied += 1
+            stats.copied_bytes += source[rel_path].st_size
+
+    stale = existing.keys() - source.keys()
+    if gitignore:
+        # Ignored files, like outputs written to a reused experiment directory, are
+        # not in source but are left in target_dir like excluded ones
+        stale -= git_ignored(source_dir, stale)
+    stats.removed = _remove_stale(target_dir, stale, dry_run)
+    stats.elapsed = time.perf_counter() - start_time
+    return stats
+
+
+def _remove_stale(target_dir: str, rel_paths: Iterable[str], dry_run: bool) -> int:
+    """
+    Remove files from target_dir and then any empty directories left behind,
+    returning the number of files removed
+    """
+    removed = 0
+    for rel_path in rel_paths:
+        if not dry_run:
+            os.remove(os.path.join(target_dir, rel_path))
+        removed += 1
+    if not dry_run and os.path.isdir(target_dir):
+        for directory, _, _ in os.walk(target_dir, topdown=False):
+            if directory != target_dir and len(os.listdir(directory)) == 0:
+                os.rmdir(directory)
+    return removed
+
+
+def object_path(store_dir: str, name: str) -> str:
+    return os.path.join(store_dir, OBJECTS_DIR, name[:2], name)
+
+
+def manifest_path(store_dir: str, experiment_id: str) -> str:
+    return os.path.join(store_dir, MANIFESTS_DIR, f"{experiment_id}.json")
+
+
+def read_manifest(store_dir: str, experiment_id: str) -> Dict:
+    path = manifest_path(store_dir, experiment_id)
+    if not os.path.exists(path):
+        raise ValueError(f"No snapshot manifest for experiment {experiment_id}: {path}")
+    return io.read_json(path)
+
+
+def _object_name(digest: str, mode: int) -> str:
+    # Hardlinks share their mode, so the executable bit is part of the key
+    return digest + (".x" if mode & 0o111 else "")
+
+
+def _hash_file(path: str) -> str:
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(partial(f.read, 1 << 20), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def _store_object(store_dir: str, source: str, mode: int) -> Tuple[str, int]:
+    """
+    Add a file to the object store, returning its object name and the bytes stored,
+    or -1 if the store already had it. The object is named by the hash of the
+    stored copy, not of source, so a file that changes while it is copied can not
+    corrupt the store.
+    """
+    temp_dir = os.path.join(store_dir, OBJECTS_DIR, "tmp")
+    os.makedirs(temp_dir, exist_ok=True)
+    # Temporary files left by runs that crashed are removed by collect_garbage
+    fd, temp_path = tempfile.mkstemp(dir=temp_dir)
+    os.close(fd)
+    try:
+        copy_file(source, temp_path)
+        name = _object_name(_hash_file(temp_path), mode)
+        path = object_path(store_dir, name)
+        if os.path.exists(path):
+            os.remove(temp_path)
+            return name, -1
+        # Objects are shared by every snapshot that contains them, so they are read only
+        os.chmod(temp_path, 0o555 if mode & 0o111 else 0o444)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        size = os.path.getsize(temp_path)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return name, size
+
+
+def _previous_files(store_dir: str, source_dir: str) -> Dict[str, Dict]:
+    """
+    Return the files of the newest manifest of source_dir, whose hashes can be
+    reused for files with the same size, mtime and mode
+    """
+    manifests = Path(store_dir) / MANIFESTS_DIR
+    if not manifests.is_dir():
+        return {}
+    paths = sorted(manifests.glob("*.json"), key=lambda path: path.stat().st_mtime_ns)
+    for path in reversed(paths):
+        manifest = io.read_json(path)
+        if manifest["source"] == source_dir:
+            return manifest["files"]
+    return {}
+
+
+def store_snapshot(
+    source_dir: str,
+    store_dir: str,
+    experiment_id: str,
+    exclude: List[str],
+    skip: Iterable[str] = (),
+    gitignore: bool = False,
+    workers: int = COPY_WORKERS,
+    dry_run: bool = False,
+) -> Tuple[Dict, SnapshotStats]:
+    """
+    Snapshot source_dir into the content addressed store in store_dir, returning
+    the manifest and stats. Files are stored once per distinct contents as
+    objects/<hash[:2]>/<hash> and the experiment's manifest in
+    manifests/<experiment_id>.json maps each path to its object.
+
+    Only files that are not in the store yet are copied, and files unchanged since
+    the previous snapshot of source_dir are not hashed again.
+    """
+    start_time = time.perf_counter()
+    source_dir = os.path.abspath(source_dir)
+    source = list_files(
+        source_dir, exclude, skip=[store_dir, *skip], gitignore=gitignore, workers=workers
+    )
+    previous = _previous_files(store_dir, source_dir)
+
+    def store(rel_path: str) -> Tuple[Dict, int]:
+        stat = source[rel_path]
+        entry: Dict[str, Any] = {
+            "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "mode": stat.st_mode
+        }
+        cached = previous.get(rel_path)
+        if (
+            cached is not None
+            and all(cached[k] == v for k, v in entry.items())
+            and os.path.exists(object_path(store_dir, cached["object"]))
+        ):
+            entry["object"] = cached["object"]
+            return entry, -1
+        source_path = os.path.join(source_dir, rel_path)
+        if dry_run:
+            name = _object_name(_hash_file(source_path), stat.st_mode)
+            stored = -1 if os.path.exists(object_path(store_dir, name)) else stat.st_size
+        else:
+            # Only the stored copy is hashed, a copy of an object the store already
+            # has is dropped
+            name, stored = _store_object(store_dir, source_path, stat.st_mode)
+        entry["object"] = name
+        return entry, stored
+
+    stats = SnapshotStats()
+    files = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for rel_path, (entry, stored) in zip(source, executor.map(store, source)):
+            files[rel_path] = entry
+            stats.files += 1
+            stats.total_bytes += entry["size"]
+            if stored < 0:
+                stats.unchanged += 1
+            else:
+                stats.copied += 1
+                stats.copied_bytes += stored
+
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "experiment_id": str(experiment_id),
+        "source": source_dir,
+        "created": time.time(),
+        # So materialize leaves the files the snapshot did not capture alone
+        "exclude": list(exclude),
+        "gitignore": gitignore,
+        "files": files,
+    }
+    if not dry_run:
+        path = manifest_path(store_dir, experiment_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        io.write_json(path, manifest, atomic=True)
+    stats.elapsed = time.perf_counter() - start_time
+    return manifest, stats
+
+
+def materialize(
+    store_dir: str,
+    experiment_id: str,
+    target_dir: str,
+    workers: int = COPY_WORKERS,
+    manifest: Optional[Dict] = None,
+) -> SnapshotStats:
+    """
+    Rebuild the tree of a stored snapshot in target_dir by hardlinking its objects,
+    falling back to copies across filesystems. Files in an existing target_dir that
+    already link to the right object are kept and files not in the snapshot are
+    removed, except those the snapshot excluded or, like sync_tree, ignored.
+    Materialized files are read only, since they share the object.
+    """
+    start_time = time.perf_counter()
+    if manifest is None:
+        manifest = read_manifest(store_dir, experiment_id)
+    files = manifest["files"]
+    exclude = manifest.get("exclude", [])
+    existing = list_files(target_dir, exclude) if os.path.isdir(target_dir) else {}
+    for directory in sorted({os.path.dirname(rel_path) for rel_path in files}):
+        os.makedirs(os.path.join(target_dir, directory), exist_ok=True)
+
+    def place(rel_path: str) -> Optional[bool]:
+        source = object_path(store_dir, files[rel_path]["object"])
+        target = os.path.join(target_dir, rel_path)
+        if rel_path in existing:
+            if os.path.samestat(existing[rel_path], os.stat(source)):
+                return None
+            os.remove(target)
+        try:
+            os.link(source, target)
+            return True
+        except OSError:
+            copy_file(source, target)
+            return False
+
+    stats = SnapshotStats()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for rel_path, linked in zip(files, executor.map(place, files)):
+            stats.files += 1
+            stats.total_bytes += files[rel_path]["size"]
+            if linked is None:
+                stats.unchanged += 1
+            elif linked:
+                stats.linked += 1
+            else:
+                stats.copied += 1
+                stats.copied_bytes += files[rel_path]["size"]
+    stale = existing.keys() - files.keys()
+    if manifest.get("gitignore", False) and os.path.isdir(manifest["source"]):
+        stale -= git_ignored(manifest["source"], stale)
+    stats.removed = _remove_stale(target_dir, stale, False)
+    stats.elapsed = time.perf_counter() - start_time
+    return stats
+
+
+def collect_garbage(
+    store_dir: str, min_age: float = GC_MIN_AGE, dry_run: bool = False
+) -> Tuple[int, int]:
+    """
+    Remove objects that no manifest references, returning the number of objects
+    and bytes removed. Objects added less than min_age seconds ago are kept, since
+    a snapshot that is still being stored has not written its manifest yet.
+    """
+    referenced: Set[str] = set()
+    manifests = Path(store_dir) / MANIFESTS_DIR
+    if manifests.is_dir():
+        for path in manifests.glob("*.json"):
+            referenced.update(entry["object"] for entry in io.read_json(path)["files"].values())
+
+    removed, removed_bytes = 0, 0
+    now = time.time()
+    objects = Path(store_dir) / OBJECTS_DIR
+    if not objects.is_dir():
+        return removed, removed_bytes
+    for directory in objects.iterdir():
+        for path in directory.iterdir():
+            stat = path.stat()
+            # Objects are made read only as they are added, which sets the ctime
+            if path.name in referenced or now - stat.st_ctime < min_age:
+                continue
+            if not dry_run:
+                path.unlink()
+            removed += 1
+            removed_bytes += stat.st_size
+    return removed, removed_bytes
+
+
+def _copy_snapshot(
+    current_dir: str,
+    experiment_dir: Path,
+    exclude: List[str],
+    base_dir: str,
+    dry_run: bool,
+    incremental: bool,
+    link_dest: Optional[str],
+    link_mode: str,
+    gitignore: bool,
+    workers: int,
+):
+    if incremental:
+        if link_dest is None:
+            latest = latest_snapshot(base_dir, exclude=experiment_dir)
+            link_dest = None if latest is None else str(latest)
+        console.log(
+            f"Excluding: {exclude} for Syncing: {current_dir} to {experiment_dir}"
+            f" with {link_mode} from: {link_dest}"
+        )
+    else:
+        link_dest = None
+        if experiment_dir.exists():
+            console.log("Experiment code dir exists, deleting before copying")
+            if not dry_run:
+                shutil.rmtree(experiment_dir)
+        console.log(f"Excluding: {exclude} for Copying: {current_dir} to {experiment_dir}")
+
+    stats = sync_tree(
+        current_dir,
+        str(experiment_dir),
+        exclude,
+        link_dest=None if link_dest is None else str(link_dest),
+        link_mode=link_mode,
+        dry_run=dry_run,
+        skip=[base_dir],
+        gitignore=gitignore,
+        workers=workers,
+    )
+    console.log(
+        f"Snapshot of {stats.files} files ({stats.total_bytes / 2**20:.1f} MiB)"
+        f" in {stats.elapsed:.2f}s:"
+        f" copied {stats.copied} ({stats.copied_bytes / 2**20:.1f} MiB),"
+        f" linked {stats.linked}, kept {stats.unchanged}, removed {stats.removed}"
+    )
+
 
 @cli.command()
 def main(
-    command: str,
+    command: Optional[str] = typer.Argument(None),
     exclude: List[str] = ["core", "auto_fig", "outputs"],
     base_dir: str = SNAPSHOT_DIR,
     experiment_id: Optional[str] = None,
     dry_run: bool = False,
     min_experiment_id: int=200_000,
     max_experiment_id: int=300_000,
+    incremental: bool = False,
+    link_dest: Optional[str] = None,
+    link_mode: str = "hardlink",
+    gitignore: bool = False,
+    workers: int = COPY_WORKERS,
+    store: bool = False,
+    commands_file: Optional[str] = None,
+    max_parallel: int = 1,
+    slurm_array: bool = False,
+    sbatch_option: Optional[List[str]] = None,
+    submit: bool = False,
 ):
     """
     This tool helps isolate experiments on NFS by:
@@ -32,28 +694,230 @@ def main(
 
     For example, you can run:
     $ snapshot --experiment-id 42 'echo "my awesome experiment"'
+
+    With --incremental, an existing experiment directory is updated in place and
+    only changed files are copied. Unchanged files are hardlinked (or reflinked
+    with --link-mode reflink) from --link-dest, which defaults to the most recent
+    snapshot in base_dir.
+
+    With --gitignore, files ignored by git are not copied. Files are copied by a
+    pool of --workers threads.
+
+    With --store, files are added to a content addressed store in base_dir that
+    only keeps one copy of each distinct file, and a manifest of the experiment is
+    written. The experiment directory is then built from hardlinks to the store.
+    Use snapshot-restore to rebuild it later and snapshot-gc to free objects that
+    are no longer in any manifest.
+
+    With --commands-file, every command in the file (one per line, - for stdin)
+    runs against the same snapshot, either locally with up to --max-parallel at
+    a time or, with --slurm-array, as the tasks of a SLURM array job whose sbatch
+    script is written to base_dir/logs/experiment_<id> (and run with --submit).
+    Each command gets SNAPSHOT_TASK_ID and SNAPSHOT_TASK_COUNT environment
+    variables in addition to SNAPSHOT_EXPERIMENT_ID.
     """
     if dry_run:
         console.log("Running in dry run mode, no changes will be made")
+    if (command is None) == (commands_file is None):
+        raise typer.BadParameter("Pass either a command or --commands-file")
+    commands = [] if commands_file is None else read_commands(commands_file)
 
     current_dir = os.getcwd()
     if experiment_id is None:
-        experiment_id = random.randint(min_experiment_id, max_experiment_id)
+        experiment_id = str(random.randint(min_experiment_id, max_experiment_id))
 
     experiment_dir = Path(base_dir) / f"experiment_{experiment_id}"
-    if experiment_dir.exists():
-        console.log("Experiment code dir exists, deleting before copying")
-        shutil.rmtree(experiment_dir)
-
-    console.log(f"Excluding: {exclude} for Copying: {current_dir} to {experiment_dir}")
-    if not dry_run:
-        shutil.copytree(
-            current_dir, experiment_dir, ignore=shutil.ignore_patterns(*exclude)
+    # Resolved before changing into the experiment directory, which a relative
+    # base_dir would otherwise be taken relative to
+    log_dir = Path(base_dir).resolve() / "logs" / f"experiment_{experiment_id}"
+    if store:
+        console.log(f"Excluding: {exclude} for Storing: {current_dir} in {base_dir}")
+        manifest, stats = store_snapshot(
+            current_dir,
+            base_dir,
+            experiment_id,
+            exclude,
+            gitignore=gitignore,
+            workers=workers,
+            dry_run=dry_run,
+        )
+        console.log(
+            f"Stored {stats.files} files ({stats.total_bytes / 2**20:.1f} MiB)"
+            f" in {stats.elapsed:.2f}s:"
+            f" added {stats.copied} objects ({stats.copied_bytes / 2**20:.1f} MiB),"
+            f" {stats.unchanged} already stored"
         )
+        if not dry_run:
+            stats = materialize(
+                base_dir, experiment_id, str(experiment_dir), workers=workers, manifest=manifest
+            )
+            console.log(f"Linked {stats.files} files to {experiment_dir} in {stats.elapsed:.2f}s")
+    else:
+        _copy_snapshot(
+            current_dir, experiment_dir, exclude, base_dir, dry_run,
+            incremental, link_dest, link_mode, gitignore, workers,
+        )
+    if not dry_run:
         os.chdir(experiment_dir)
 
-    console.log(f"Running: {command} from {os.getcwd()}")
-    if not dry_run:
-        new_env = os.environ.copy()
-        new_env['SNAPSHOT_EXPERIMENT_ID'] = str(experiment_id)
-        subprocess.run(command, shell=True, check=True, env=new_env)
+    if command is not None:
+        console.log(f"Running: {command} from {os.getcwd()}")
+        if not dry_run:
+            new_env = os.environ.copy()
+            new_env["SNAPSHOT_EXPERIMENT_ID"] = experiment_id
+            subprocess.run(command, shell=True, check=True, env=new_env)
+    elif slurm_array:
+        write_array_script(
+            commands, os.getcwd(), log_dir, experiment_id,
+            max_parallel=max_parallel, sbatch_options=sbatch_option or (),
+            dry_run=dry_run, submit=submit,
+        )
+    else:
+        run_commands(commands, experiment_id, log_dir, max_parallel, dry_run=dry_run)
+
+
+def restore_main(
+    experiment_id: str,
+    target_dir: Optional[str] = None,
+    base_dir: str = SNAPSHOT_DIR,
+    workers: int = COPY_WORKERS,
+):
+    """
+    Rebuild the directory of an experiment snapshotted with --store, by default
+    in its experiment_<id> directory
+    """
+    if target_dir is None:
+        target_dir = str(Path(base_dir) / f"experiment_{experiment_id}")
+    stats = materialize(base_dir, experiment_id, target_dir, workers=workers)
+    console.log(
+        f"Restored {stats.files} files ({stats.total_bytes / 2**20:.1f} MiB) to {target_dir}"
+        f" in {stats.elapsed:.2f}s: linked {stats.linked}, copied {stats.copied},"
+        f" kept {stats.unchanged}, removed {stats.removed}"
+    )
+
+
+def gc_main(base_dir: str = SNAPSHOT_DIR, min_age: float = GC_MIN_AGE, dry_run: bool = False):
+    """
+    Remove stored snapshot objects that are not referenced by any manifest. Delete
+    an experiment's manifests/<id>.json first to free the files only it used.
+    """
+    removed, removed_bytes = collect_garbage(base_dir, min_age=min_age, dry_run=dry_run)
+    console.log(f"Removed {removed} objects ({removed_bytes / 2**20:.1f} MiB)")
+
+
+def read_commands(path: str) -> List[str]:
+    """
+    Read one shell command per line from path, or stdin if path is -, skipping
+    blank lines and # comments
+    """
+    if path == "-":
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(path) as f:
+            lines = f.read().splitlines()
+    commands = [line.strip() for line in lines]
+    commands = [c for c in commands if c != "" and not c.startswith("#")]
+    if len(commands) == 0:
+        raise ValueError(f"No commands in: {path}")
+    return commands
+
+
+def _task_env(experiment_id: str, task_id: int, task_count: int) -> Dict[str, str]:
+    env = os.environ.copy()
+    env["SNAPSHOT_EXPERIMENT_ID"] = str(experiment_id)
+    env["SNAPSHOT_TASK_ID"] = str(task_id)
+    env["SNAPSHOT_TASK_COUNT"] = str(task_count)
+    return env
+
+
+def run_commands(
+    commands: List[str],
+    experiment_id: str,
+    log_dir: Path,
+    max_parallel: int = 1,
+    dry_run: bool = False,
+):
+    """
+    Run commands from the current directory with up to max_parallel at a time.
+    Unless commands run one at a time, the output of each goes to
+    log_dir/task_<i>.log instead of the terminal. Raises BatchError listing the
+    failed tasks once every command has finished.
+    """
+    def run(task_id: int) -> int:
+        command = commands[task_id]
+        console.log(f"Running task {task_id}: {command} from {os.getcwd()}")
+        if dry_run:
+            return 0
+        env = _task_env(experiment_id, task_id, len(commands))
+        if max_parallel == 1:
+            return subprocess.run(command, shell=True, env=env).returncode
+        with open(log_dir / f"task_{task_id}.log", "wb") as log_file:
+            return subprocess.run(
+                command, shell=True, env=env, stdout=log_file, stderr=subprocess.STDOUT
+            ).returncode
+
+    if max_parallel > 1 and not dry_run:
+        log_dir.mkdir(parents=True, exist_ok=True)
+        console.log(f"Writing task output to: {log_dir}")
+    with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+        returncodes = list(executor.map(run, range(len(commands))))
+    failed = [task_id for task_id, code in enumerate(returncodes) if code != 0]
+    for task_id in failed:
+        console.log(
+            f"Task {task_id} failed with exit code {returncodes[task_id]}:"
+            f" {commands[task_id]}"
+        )
+    if len(failed) > 0:
+        raise BatchError(
+            f"{len(failed)} of {len(commands)} commands failed,"
+            f" tasks: {', '.join(map(str, failed))}"
+        )
+
+
+def write_array_script(
+    commands: List[str],
+    experiment_dir: str,
+    log_dir: Path,
+    experiment_id: str,
+    max_parallel: int = 1,
+    sbatch_options: Iterable[str] = (),
+    dry_run: bool = False,
+    submit: bool = False,
+) -> Path:
+    """
+    Write an sbatch script for a SLURM array job with one task per command, all
+    running from experiment_dir, and submit it if submit is True. If max_parallel
+    is more than one, at most that many tasks run at once. sbatch_options are
+    extra options like --partition=dev.
+    """
+    array = f"0-{len(commands) - 1}"
+    if max_parallel > 1:
+        array += f"%{max_parallel}"
+    lines = [
+        "#!/bin/bash",
+        f"#SBATCH --job-name=snapshot_{experiment_id}",
+        f"#SBATCH --array={array}",
+        f"#SBATCH --output={log_dir}/task_%a.log",
+    ]
+    lines.extend(f"#SBATCH {option}" for option in sbatch_options)
+    lines.extend([
+        f"cd {shlex.quote(experiment_dir)}",
+        f"export SNAPSHOT_EXPERIMENT_ID={shlex.quote(str(experiment_id))}",
+        "export SNAPSHOT_TASK_ID=$SLURM_ARRAY_TASK_ID",
+        f"export SNAPSHOT_TASK_COUNT={len(commands)}",
+        "COMMANDS=(",
+        *(f"  {shlex.quote(command)}" for command in commands),
+        ")",
+        'eval "${COMMANDS[$SLURM_ARRAY_TASK_ID]}"',
+    ])
+    script = "\n".join(lines) + "\n"
+    script_path = log_dir / "array.sbatch"
+    if dry_run:
+        console.log(f"Would write {script_path}:\n{script}")
+        return script_path
+    log_dir.mkdir(parents=True, exist_ok=True)
+    script_path.write_text(script)
+    console.log(f"Wrote SLURM array script for {len(commands)} commands: {script_path}")
+    if submit:
+        subprocess.run(["sbatch", str(script_path)], check=True)
+    return script_path
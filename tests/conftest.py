@@ -0,0 +1,96 @@
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import pytest
+
+
+class FileServer(ThreadingHTTPServer):
+    """
+    Local stand in for a file host that serves files from root with support for
+    single HTTP Range requests. Requests are recorded, ranges and HEAD requests can
+    be disabled and paths can be made to fail a number of times before succeeding.
+    """
+
+    def __init__(self, root: Path):
+        super().__init__(("127.0.0.1", 0), RangeRequestHandler)
+        self.root = root
+        self.supports_range = True
+        # Status to reject HEAD requests with, like presigned URLs that only allow GET
+        self.head_status: Optional[int] = None
+        self.failures: Dict[str, int] = {}
+        self.requests: List[Tuple[str, str, Optional[str]]] = []
+        self.lock = threading.Lock()
+
+    def url(self, name: str) -> str:
+        return f"http://127.0.0.1:{self.server_port}/{name}"
+
+
+class RangeRequestHandler(BaseHTTPRequestHandler):
+    server: FileServer
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+    def _respond(self, send_body: bool):
+        name = self.path.lstrip("/")
+        with self.server.lock:
+            self.server.requests.append((self.command, name, self.headers.get("Range")))
+            failures = self.server.failures.get(name, 0)
+            if failures > 0:
+                self.server.failures[name] = failures - 1
+        path = self.server.root / name
+        if failures > 0 or not path.is_file():
+            self.send_response(500 if failures > 0 else 404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        data = path.read_bytes()
+        match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if match is not None and self.server.supports_range:
+            start = int(match.group(1))
+            end = int(match.group(2)) if match.group(2) else len(data) - 1
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(data)}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            body = data[start : end + 1]
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(data)}")
+        else:
+            body = data
+            self.send_response(200)
+        if self.server.supports_range:
+            self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        self._respond(send_body=True)
+
+    def do_HEAD(self):  # pylint: disable=invalid-name
+        if self.server.head_status is not None:
+            self.send_response(self.server.head_status)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self._respond(send_body=False)
+
+
+@pytest.fixture
+def http_server(tmp_path: Path):
+    root = tmp_path / "http_root"
+    root.mkdir()
+    server = FileServer(root)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,327 @@
+from pathlib import Path
+
+import bibtexparser
+import numpy as np
+import pytest
+import typer
+
+from pedroai import bibtex, io
+
+BIB = """@string{acl = "Association for Computational Linguistics"}
+@inproceedings{smith2020,
+  title = {Attention Is All You Need},
+  author = {Smith, John and Doe, Jane},
+  booktitle = acl,
+  year = {2020},
+  month = jan,
+}
+@article{lee2019,
+  title = {BERT: Pre-training of Deep Bidirectional Transformers},
+  author = {Lee, Kenton},
+  journal = {arXiv preprint arXiv:1810.04805},
+  year = {2019},
+}
+"""
+
+
+# Covers the parts of bibtexparser's grammar that parse_bib replicates
+CORPUS = (
+    BIB
+    + """
+Some text that is an implicit comment @misc{not_an_entry, title = {x}}
+@comment{An explicit comment}
+@STRING(emnlp = "Empirical Methods in " # "Natural Language Processing")
+@preamble{ "\\newcommand{\\noop}[1]{}" }
+
+@Article(paren2018,
+  Title = "A {"}quoted{"} title" # { and } # emnlp,
+  title = {The first of repeated fields is kept},
+  year = 2018,
+  month = dec # "~1",
+  Abstract = {Nested {braces {and}} text
+      continued on a line
+	and a line with a tab
+@ that starts with an at},
+  note = {},
+  pages = "",
+  empty = {{}}
+)
+@misc{inline1, title={One}} @misc{inline2, title={Two}} trailing text
+@misc{no_fields,}
+@misc{bad key, title = {Spaces are not allowed in keys}}
+@misc{bad_number, year = 2020a}
+@misc{last, title = {Last}, year = {2021},}
+"""
+)
+
+
+def _search(index, title: str) -> str:
+    searcher = index.searcher()
+    hits = searcher.search(index.parse_query(title, ["title"]), 1).hits
+    return searcher.doc(hits[0][1])["id"][0]
+
+
+def test_load_indexed_bib(tmp_path: Path, monkeypatch):
+    (tmp_path / "master.bib").write_text(BIB)
+    index_dir = str(tmp_path / "index")
+    bib, index = bibtex.load_indexed_bib(tmp_path / "master.bib")
+    assert 2 == len(bib.entries)
+    assert "lee2019" == _search(index, "bidirectional transformers")
+
+    bib, index = bibtex.load_indexed_bib(
+        tmp_path / "master.bib", persist=True, index_dir=index_dir
+    )
+    assert "smith2020" == _search(index, "attention")
+
+    # The persisted index is reused without parsing the file again
+    def fail(filename):
+        raise AssertionError(f"Parsed {filename}")
+
+    monkeypatch.setattr(bibtex, "parse_bib", fail)
+    bib, index = bibtex.load_indexed_bib(
+        tmp_path / "master.bib", persist=True, index_dir=index_dir
+    )
+    assert (
+        "Association for Computational Linguistics"
+        == bib.entries_dict["smith2020"]["booktitle"]
+    )
+    assert "smith2020" == _search(index, "attention")
+
+    (tmp_path / "master.bib").write_text(BIB.replace("2019", "2018"))
+    with pytest.raises(AssertionError, match="Parsed"):
+        bibtex.load_indexed_bib(
+            tmp_path / "master.bib", persist=True, index_dir=index_dir
+        )
+
+
+def _entry(key: str, title: str, **fields) -> dict:
+    return {"ID": key, "ENTRYTYPE": "article", "title": title, **fields}
+
+
+def test_normalize_title():
+    assert "muller s bert a study" == bibtex.normalize_title(
+        "M{\\\"u}ller's {BERT}: A  Study"
+    )
+
+
+def test_find_duplicates():
+    entries = [
+        _entry(
+            "vaswani2017",
+            "Attention Is All You Need",
+            author="Vaswani, Ashish",
+            year="2017",
+        ),
+        _entry(
+            "vaswani17",
+            "Attention is all you need.",
+            author="Ashish Vaswani",
+            year="2017",
+        ),
+        _entry(
+            "devlin2018",
+            "BERT: Pre-training of Deep Bidirectional Transformers",
+            journal="arXiv preprint arXiv:1810.04805",
+            year="2018",
+        ),
+        _entry(
+            "devlin2019",
+            "{BERT}: Pre-training of Deep Bidirectional Transformers for Language Understanding",
+            eprint="1810.04805v2",
+            year="2019",
+        ),
+        _entry(
+            "liu2019",
+            "RoBERTa: A Robustly Optimized BERT Pretraining Approach",
+            year="2019",
+        ),
+        _entry("a", "Some Title", doi="10.1000/XYZ.1"),
+        _entry("b", "Completely Different Title", url="https://doi.org/10.1000/xyz.1"),
+    ]
+    clusters = bibtex.find_duplicates(entries)
+    assert [[0, 1], [5, 6], [2, 3]] == [c["entries"] for c in clusters]
+    assert 1.0 == clusters[0]["confidence"]
+    assert clusters[1]["pairs"][0]["doi"]
+    assert clusters[2]["pairs"][0]["arxiv"]
+
+    deduped, report = bibtex.dedup_entries(
+        entries, ["a.bib"] * len(entries), auto_merge=0.995
+    )
+    assert ["vaswani2017", "devlin2018", "devlin2019", "liu2019", "a"] == [
+        e["ID"] for e in deduped
+    ]
+    assert [True, True, False] == [c["merged"] for c in report["duplicates"]]
+    assert "https://doi.org/10.1000/xyz.1" == deduped[-1]["url"]
+
+    # Only fields that an @article can have are merged into one
+    merged = bibtex.merge_entries(
+        [
+            _entry("x", "T", journal="J"),
+            _entry("y", "T", ENTRYTYPE="inproceedings", booktitle="B", pages="1--2"),
+        ]
+    )
+    assert "1--2" == merged["pages"]
+    assert "booktitle" not in merged
+
+
+def test_find_duplicates_distinct_titles():
+    words = "graph neural network language model vision robust sparse attention".split()
+    rng = np.random.RandomState(0)
+    entries = [
+        _entry(
+            str(i),
+            " ".join(rng.choice(words, size=6)) + f" {i}",
+            year=str(2000 + i % 20),
+        )
+        for i in range(500)
+    ]
+    entries.append(dict(entries[10], ID="copy"))
+    clusters = bibtex.find_duplicates(entries, threshold=0.9)
+    assert [[10, 500]] == [c["entries"] for c in clusters]
+
+
+def test_parse_bib(tmp_path: Path):
+    (tmp_path / "corpus.bib").write_text(CORPUS)
+    expected = bibtex.parse_bib(tmp_path / "corpus.bib", fast=False)
+    assert 6 == len(expected.entries)
+    for bib in (
+        bibtex.parse_bib(tmp_path / "corpus.bib"),
+        # Batches that split the abstract, which has a line starting with @
+        bibtex.parse_bib_string(CORPUS, workers=8, batch_size=100),
+    ):
+        assert expected.entries == bib.entries
+        assert expected.strings == bib.strings
+        assert expected.comments == bib.comments
+        assert expected.preambles == bib.preambles
+
+
+def test_format_bibtex(tmp_path: Path, monkeypatch):
+    monkeypatch.setattr("pedroai.io.CACHE_DIR", str(tmp_path / "cache"))
+    bib_file = tmp_path / "refs.bib"
+    bib_file.write_text(CORPUS)
+    bibtex.write_bib(bibtex.parse_bib(bib_file, fast=False), tmp_path / "expected.bib")
+    expected = (tmp_path / "expected.bib").read_text()
+
+    with pytest.raises(typer.Exit):
+        bibtex.format_bibtex(bib_file, None, check=True)
+    assert CORPUS == bib_file.read_text()
+    bibtex.format_bibtex(bib_file, None)
+    assert expected == bib_file.read_text()
+    bibtex.format_bibtex(bib_file, None, check=True)
+
+    # Formatted files are not parsed or written again
+    def fail(*args):
+        raise AssertionError("Parsed")
+
+    monkeypatch.setattr(bibtex, "parse_bib_cached", fail)
+    mtime = bib_file.stat().st_mtime_ns
+    bibtex.format_bibtex(bib_file, None)
+    assert mtime == bib_file.stat().st_mtime_ns
+    monkeypatch.undo()
+    monkeypatch.setattr("pedroai.io.CACHE_DIR", str(tmp_path / "cache"))
+
+    # Only the changed entry is parsed and rendered again
+    parsed, rendered = [], []
+    parse_batch = bibtex._parse_batch
+    render = bibtexparser.bwriter.BibTexWriter._entry_to_bibtex
+
+    def count_parse(text, partial):
+        parsed.append(text)
+        return parse_batch(text, partial)
+
+    def count_render(writer, entry):
+        rendered.append(entry["ID"])
+        return render(writer, entry)
+
+    monkeypatch.setattr(bibtex, "_parse_batch", count_parse)
+    monkeypatch.setattr(
+        bibtexparser.bwriter.BibTexWriter, "_entry_to_bibtex", count_render
+    )
+    bib_file.write_text(expected.replace("{Last}", "{Changed}"))
+    bibtex.format_bibtex(bib_file, None)
+    assert 1 == len(parsed) and "{Changed}" in parsed[0]
+    assert ["last"] == rendered
+    assert expected.replace("{Last}", "{Changed}") == bib_file.read_text()
+
+
+def test_merge_bibtex(tmp_path: Path):
+    # Duplicates within the first file are kept, since papers cite their keys
+    (tmp_path / "a.bib").write_text(
+        BIB
+        + """
+@inproceedings{vaswani2017,
+  title = {Attention Is All You Need},
+  author = {Smith, John and Doe, Jane},
+  year = {2020},
+}
+"""
+    )
+    # An identical entry, a duplicate with another key, a different entry with a
+    # taken key and a new entry
+    (tmp_path / "b.bib").write_text(
+        BIB.split("@article")[0]
+        + """
+@article{devlin2019,
+  title = {{BERT}: Pre-training of Deep Bidirectional Transformers},
+  author = {Lee, Kenton},
+  year = {2019},
+  doi = {10.18653/v1/N19-1423},
+}
+@misc{lee2019,
+  title = {Question Answering over Knowledge Graphs},
+  year = {2019},
+}
+@misc{new2021,
+  title = {Sparse Graph Attention for Retrieval},
+  year = {2021},
+}
+"""
+    )
+    (tmp_path / "c.bib").write_text(
+        """@misc{new2021,
+  title = {Sparse Graph Attention for Retrieval},
+  year = {2021},
+}
+@misc{lee2019_2,
+  title = {Robust Vision Models},
+  year = {2022},
+}
+"""
+    )
+    inputs = [tmp_path / "a.bib", tmp_path / "b.bib", tmp_path / "c.bib"]
+    bibtex.merge_bibtex(
+        inputs,
+        tmp_path / "merged.bib",
+        batch=True,
+        report_file=tmp_path / "report.json",
+        workers=1,
+    )
+    merged = bibtex.parse_bib(tmp_path / "merged.bib").entries_dict
+    assert {
+        "smith2020",
+        "vaswani2017",
+        "lee2019",
+        "lee2019_3",
+        "new2021",
+        "lee2019_2",
+    } == set(merged)
+    assert "10.18653/v1/N19-1423" == merged["lee2019"]["doi"]
+    assert "Robust Vision Models" == merged["lee2019_2"]["title"]
+    report = io.read_json(tmp_path / "report.json")
+    assert 9 == report["entries"] and 2 == report["identical_entries"]
+    assert [["lee2019", "devlin2019"]] == [
+        [e["ID"] for e in c["entries"]] for c in report["duplicates"]
+    ]
+    assert [
+        {"ID": "lee2019", "new_ID": "lee2019_3", "source": str(inputs[1])}
+    ] == report["renamed"]
+
+    bibtex.merge_bibtex(
+        inputs, tmp_path / "new.bib", batch=True, new_only=True, workers=2
+    )
+    with pytest.raises(ValueError):
+        bibtex.merge_bibtex(
+            inputs, tmp_path / "new.bib", batch=True, persist_index=True
+        )
+    new = bibtex.parse_bib(tmp_path / "new.bib").entries_dict
+    assert {"lee2019_3", "new2021", "lee2019_2"} == set(new)
@@ -0,0 +1,228 @@
+import hashlib
+import os
+from pathlib import Path
+
+import pytest
+import toml
+
+from pedroai.download import (
+    VERSION,
+    ChecksumError,
+    ChecksumManifest,
+    DownloadError,
+    DownloadSpec,
+    Job,
+    JobError,
+    download_file,
+    download_files,
+    job_dependencies,
+    main,
+    parse_checksum,
+    run_jobs,
+)
+
+
+def test_download_files(tmp_path: Path, http_server, caplog):
+    for i in range(5):
+        (http_server.root / f"file_{i}.txt").write_text(f"contents {i}")
+    http_server.failures["file_0.txt"] = 2
+    downloads = {
+        str(tmp_path / f"file_{i}.txt"): http_server.url(f"file_{i}.txt")
+        for i in range(5)
+    }
+    downloads[str(tmp_path / "missing.txt")] = http_server.url("missing.txt")
+    # A local error, here a file where the directory should be, is not retried
+    (http_server.root / "local.txt").write_text("contents")
+    (tmp_path / "blocked").write_text("")
+    downloads[str(tmp_path / "blocked" / "local.txt")] = http_server.url("local.txt")
+
+    manifest_path = str(tmp_path / "checksums.json")
+    failures = download_files(
+        downloads, jobs=3, max_per_host=2, backoff=0.01, manifest_path=manifest_path
+    )
+    assert {
+        str(tmp_path / "missing.txt"),
+        str(tmp_path / "blocked" / "local.txt"),
+    } == set(failures)
+    assert isinstance(failures[str(tmp_path / "blocked" / "local.txt")], OSError)
+    # Nothing had a checksum, so there is no manifest to save
+    assert not os.path.exists(manifest_path)
+    for i in range(5):
+        assert f"contents {i}" == (tmp_path / f"file_{i}.txt").read_text()
+    # The missing file is a client error and is not retried
+    assert 1 == sum(1 for _, name, _ in http_server.requests if name == "missing.txt")
+    assert not [r for r in caplog.records if "local.txt failed" in r.getMessage()]
+
+    (tmp_path / "file_1.txt").write_text("local")
+    assert {} == download_files(
+        {str(tmp_path / "file_1.txt"): http_server.url("file_1.txt")},
+        manifest_path=manifest_path,
+    )
+    assert "local" == (tmp_path / "file_1.txt").read_text()
+
+
+def test_main_reports_failures(tmp_path: Path, http_server, monkeypatch):
+    (http_server.root / "data.txt").write_text("data")
+    config = {
+        "version": VERSION,
+        "options": {"create_dirs": True, "directories": ["data"]},
+        "downloads": {
+            "data/data.txt": http_server.url("data.txt"),
+            "data/other.txt": {"url": http_server.url("other.txt"), "checksum": ""},
+        },
+        "jobs": {},
+    }
+    (tmp_path / "files.toml").write_text(toml.dumps(config))
+    monkeypatch.chdir(tmp_path)
+    with pytest.raises(DownloadError, match="data/other.txt"):
+        main(jobs=2)
+    assert "data" == (tmp_path / "data" / "data.txt").read_text()
+
+
+def test_download_files_checksums(tmp_path: Path, http_server):
+    data = b"checksummed contents"
+    (http_server.root / "data.txt").write_bytes(data)
+    sha256 = hashlib.sha256(data).hexdigest()
+    manifest_path = str(tmp_path / "manifest.json")
+    local_file = str(tmp_path / "data.txt")
+    downloads = {
+        local_file: DownloadSpec(url=http_server.url("data.txt"), checksum=sha256),
+        str(tmp_path / "bad.txt"): DownloadSpec(
+            url=http_server.url("data.txt"), checksum="md5:" + "0" * 32
+        ),
+    }
+
+    failures = download_files(downloads, manifest_path=manifest_path)
+    assert [str(tmp_path / "bad.txt")] == list(failures)
+    assert isinstance(failures[str(tmp_path / "bad.txt")], ChecksumError)
+    assert not (tmp_path / "bad.txt").exists()
+    assert data == (tmp_path / "data.txt").read_bytes()
+    assert sha256 == ChecksumManifest(manifest_path).lookup(local_file, "sha256")
+
+    # Verified files are trusted from the manifest without hashing or downloading
+    del downloads[str(tmp_path / "bad.txt")]
+    n_requests = len(http_server.requests)
+    assert {} == download_files(downloads, manifest_path=manifest_path)
+    assert n_requests == len(http_server.requests)
+
+    # Partial or corrupted files are re-downloaded
+    (tmp_path / "data.txt").write_bytes(data[:5])
+    assert {} == download_files(downloads, manifest_path=manifest_path)
+    assert data == (tmp_path / "data.txt").read_bytes()
+
+
+def test_parse_checksum():
+    assert ("sha256", "ab" * 32) == parse_checksum("SHA256:" + "AB" * 32)
+    assert ("md5", "0" * 32) == parse_checksum("0" * 32)
+    assert parse_checksum("") is None
+    with pytest.raises(ValueError):
+        parse_checksum("unknown:1234")
+
+
+def test_main_job_dag(tmp_path: Path, http_server, monkeypatch):
+    (http_server.root / "raw.txt").write_text("raw")
+    config = {
+        "version": VERSION,
+        "options": {"create_dirs": True, "directories": ["data"]},
+        "downloads": {"data/raw.txt": http_server.url("raw.txt")},
+        "jobs": {
+            "upper": {
+                "name": "upper",
+                "command": "tr a-z A-Z < data/raw.txt > data/upper.txt",
+                "inputs": ["data/raw.txt"],
+                "outputs": ["data/upper.txt"],
+            },
+            "both": {
+                "name": "both",
+                "command": "cat data/raw.txt data/upper.txt > data/both.txt",
+                "depends_on": ["upper", "data/raw.txt"],
+                "inputs": ["data/upper.txt"],
+                "outputs": ["data/both.txt"],
+            },
+            "legacy": {
+                "name": "legacy",
+                "command": "echo legacy >> data/legacy.txt",
+                "check": "data/legacy.txt",
+            },
+        },
+    }
+    (tmp_path / "files.toml").write_text(toml.dumps(config))
+    monkeypatch.chdir(tmp_path)
+    main(jobs=2, job_workers=2)
+    assert "RAW" == (tmp_path / "data" / "upper.txt").read_text()
+    assert "rawRAW" == (tmp_path / "data" / "both.txt").read_text()
+
+    # Up to date outputs are not rebuilt, and check paths still skip jobs
+    (tmp_path / "data" / "both.txt").write_text("stale")
+    main(jobs=2)
+    assert "stale" == (tmp_path / "data" / "both.txt").read_text()
+    assert "legacy\n" == (tmp_path / "data" / "legacy.txt").read_text()
+
+    # Newer inputs rebuild the outputs that depend on them
+    (tmp_path / "data" / "raw.txt").write_text("new")
+    raw_mtime = (tmp_path / "data" / "raw.txt").stat().st_mtime_ns
+    os.utime(tmp_path / "data" / "raw.txt", ns=(raw_mtime, raw_mtime + 10**9))
+    main(jobs=2)
+    assert "NEW" == (tmp_path / "data" / "upper.txt").read_text()
+    assert "newNEW" == (tmp_path / "data" / "both.txt").read_text()
+
+
+def test_run_jobs_failures(tmp_path: Path):
+    jobs = {
+        "setup": Job(name="setup", command="true"),
+        "fails": Job(name="fails", command="exit 1", depends_on=["setup"]),
+        "after": Job(
+            name="after", command=f"touch {tmp_path / 'after'}", depends_on=["fails"]
+        ),
+        "independent": Job(name="independent", command=f"touch {tmp_path / 'ok'}"),
+    }
+    failures = run_jobs(jobs, max_workers=2)
+    assert {"fails", "after"} == set(failures)
+    assert isinstance(failures["after"], JobError)
+    assert not (tmp_path / "after").exists()
+    assert (tmp_path / "ok").exists()
+
+
+def test_job_dependencies():
+    jobs = {
+        "a": Job(name="a", command="", inputs=["raw"], outputs=["a.txt"]),
+        "b": Job(name="b", command="", inputs=["a.txt"], depends_on=["c"]),
+        "c": Job(name="c", command=""),
+        "d": Job(name="d", command=""),
+    }
+    # Jobs without declared dependencies wait on downloads and run in order
+    assert {
+        "a": {"raw"},
+        "b": {"a", "c"},
+        "c": {"raw"},
+        "d": {"raw", "c"},
+    } == job_dependencies(jobs, ["raw"])
+    jobs["c"].depends_on = ["b"]
+    with pytest.raises(ValueError, match="cycle"):
+        job_dependencies(jobs)
+    with pytest.raises(ValueError, match="unknown"):
+        job_dependencies({"a": Job(name="a", command="", depends_on=["missing"])})
+
+
+def test_download_file_segments(tmp_path: Path, http_server):
+    data = os.urandom(5 * 2**20)
+    (http_server.root / "large.bin").write_bytes(data)
+    local_file = str(tmp_path / "large.bin")
+    download_file(
+        http_server.url("large.bin"),
+        local_file,
+        checksum="sha256:" + hashlib.sha256(data).hexdigest(),
+        segments=4,
+    )
+    assert data == Path(local_file).read_bytes()
+    assert 4 == sum(1 for method, _, r in http_server.requests if r is not None)
+
+    with pytest.raises(ChecksumError):
+        download_file(
+            http_server.url("large.bin"),
+            local_file,
+            overwrite=True,
+            checksum="md5:" + "0" * 32,
+            segments=4,
+        )
+    assert not os.path.exists(local_file)
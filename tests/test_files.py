@@ -0,0 +1,121 @@
+import os
+import time
+from pathlib import Path
+
+import pytest
+
+from pedroai.files import (
+    GlobMatcher,
+    du,
+    parse_duration,
+    parse_size,
+    rmf,
+    scan_tree,
+    walk_matches,
+)
+
+
+def _make_tree(root: Path):
+    for path in [
+        "a.pt",
+        "b.txt",
+        "ckpt/step_1/model.pt",
+        "ckpt/step_1/optim.pt",
+        "ckpt/step_2/model.pt",
+        "ckpt/.hidden.pt",
+        "logs/run[1].log",
+        "logs/deep/x/y.log",
+    ]:
+        (root / path).parent.mkdir(parents=True, exist_ok=True)
+        (root / path).write_text(path)
+
+
+@pytest.mark.parametrize(
+    "pattern",
+    ["*.pt", "**/*.pt", "ckpt/*/model.pt", "**/*.log", "logs/run[[]1].log", "?.*"],
+)
+def test_glob_matcher(tmp_path: Path, pattern: str):
+    _make_tree(tmp_path)
+    expected = sorted(
+        str(p.relative_to(tmp_path)) for p in tmp_path.glob(pattern) if p.is_file()
+    )
+    matched = sorted(
+        os.path.relpath(entry.path, tmp_path)
+        for entry in walk_matches(tmp_path, GlobMatcher(pattern))
+    )
+    assert expected == matched
+
+
+def test_glob_matcher_prunes():
+    matcher = GlobMatcher("ckpt/*/model.pt")
+    assert matcher.can_contain("ckpt/step_1")
+    assert not matcher.can_contain("logs")
+    assert not matcher.can_contain("ckpt/step_1/nested")
+    assert GlobMatcher("**/*.pt").can_contain("logs/deep/x")
+    # A trailing ** matches every file below the directory
+    assert GlobMatcher("ckpt/**").matches("ckpt/step_1/model.pt")
+    assert not GlobMatcher("ckpt/**").matches("logs/a.log")
+
+
+def test_parse():
+    assert 100 * 10**6 == parse_size("100M")
+    assert 1536 == parse_size("1.536kb")
+    assert 7 * 86400 == parse_duration("7d")
+    assert 90 == parse_duration("90")
+
+
+def test_rmf(tmp_path: Path):
+    _make_tree(tmp_path)
+    (tmp_path / "ckpt" / "step_1" / "optim.pt").write_text("x" * 1000)
+    old = time.time() - 3 * 86400
+    os.utime(tmp_path / "ckpt" / "step_2" / "model.pt", (old, old))
+
+    assert (4, 1055) == rmf(tmp_path, "ckpt/**/*.pt", dry_run=True, workers=2)
+    assert (tmp_path / "ckpt" / "step_1" / "model.pt").exists()
+
+    assert (1, 20) == rmf(tmp_path, "**/*.pt", older_than="1d", batch_size=2)
+    assert (1, 1000) == rmf(tmp_path, "**/*.pt", min_size="1k")
+    assert (tmp_path / "ckpt" / "step_2").exists()
+
+    assert (3, 39) == rmf(tmp_path, "**/*.pt", remove_empty_dirs=True, batch_size=1)
+    assert not (tmp_path / "ckpt" / "step_1").exists()
+    # Only directories emptied by this run are removed
+    assert (tmp_path / "ckpt" / "step_2").exists()
+    assert (tmp_path / "logs" / "deep" / "x" / "y.log").exists()
+    assert (tmp_path / "b.txt").exists()
+
+    # Symlinks to directories are not removed, even if their name matches
+    (tmp_path / "linked.pt").symlink_to(tmp_path / "logs")
+    assert (0, 0) == rmf(tmp_path, "*.pt")
+    assert (tmp_path / "linked.pt").is_symlink()
+
+
+def test_du(tmp_path: Path, monkeypatch):
+    root = tmp_path / "root"
+    _make_tree(root)
+    monkeypatch.setattr("pedroai.io.CACHE_DIR", str(tmp_path / "cache"))
+    groups, directories = du(root / "ckpt", glob=[], top=5, workers=2)
+    assert {".pt": [4, 75]} == groups
+    assert {".": [1, 15], "step_1": [2, 40], "step_2": [1, 20]} == directories
+
+    groups, _ = du(root, glob=["ckpt/**", "**/*.log"], workers=2)
+    assert {"ckpt/**": [4, 75], "**/*.log": [2, 32], "(other)": [2, 9]} == groups
+
+
+def test_scan_tree_cache(tmp_path: Path):
+    root = tmp_path / "root"
+    _make_tree(root)
+    cache_path = str(tmp_path / "du.pkl")
+    records, listed = scan_tree(root, workers=2, cache_path=cache_path)
+    assert 7 == listed == len(records)
+    assert {"model.pt", "optim.pt"} == {name for name, _ in records["ckpt/step_1"][1]}
+
+    records, listed = scan_tree(root, workers=2, cache_path=cache_path)
+    assert 0 == listed
+
+    (root / "ckpt" / "step_1" / "new.pt").write_text("new")
+    dir_mtime = os.stat(root / "ckpt" / "step_1").st_mtime_ns + 10**9
+    os.utime(root / "ckpt" / "step_1", ns=(dir_mtime, dir_mtime))
+    records, listed = scan_tree(root, workers=2, cache_path=cache_path)
+    assert 1 == listed
+    assert ("new.pt", 3) in records["ckpt/step_1"][1]
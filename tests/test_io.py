@@ -1,9 +1,35 @@
+import hashlib
+import json
+import os
 import types
 from pathlib import Path
 
+import numpy as np
+import pytest
 from pydantic import BaseModel
 
-from pedroai.io import read_jsonlines, write_json, write_jsonlines
+import pedroai.io
+from pedroai.io import (
+    COMPRESSION_EXTENSIONS,
+    SEGMENT_MIN_SIZE,
+    ColumnStore,
+    JsonlIndex,
+    JsonlWriter,
+    ParseCache,
+    _iter_file_lines,
+    _iter_mmap_lines,
+    _jsonlines_ranges,
+    convert_jsonl_to_columns,
+    detect_compression,
+    dumps_jsonline,
+    download,
+    get_path,
+    project,
+    read_json,
+    read_jsonlines,
+    write_json,
+    write_jsonlines,
+)
 
 
 class JsonTest(BaseModel):
@@ -30,3 +56,400 @@ def test_pydantic_write_json(tmp_path):
 
     parsed_obj = JsonTest.parse_file(tmp_path / "pydantic_test.json")
     assert obj.text == parsed_obj.text
+
+
+def test_read_jsonlines_parallel(tmp_path: Path):
+    elements = [{"id": i, "text": "x" * (i % 7)} for i in range(1000)]
+    write_jsonlines(tmp_path / "elements.jsonl", elements)
+
+    parsed_elements = read_jsonlines(tmp_path / "elements.jsonl", workers=3)
+    assert isinstance(parsed_elements, list)
+    assert elements == parsed_elements
+
+    lazy_elements = read_jsonlines(tmp_path / "elements.jsonl", lazy=True, workers=3)
+    assert isinstance(lazy_elements, types.GeneratorType)
+    assert elements == list(lazy_elements)
+
+    unordered_elements = read_jsonlines(
+        tmp_path / "elements.jsonl", workers=3, ordered=False
+    )
+    assert elements == sorted(unordered_elements, key=lambda e: e["id"])
+
+
+def test_jsonlines_ranges(tmp_path: Path):
+    path = tmp_path / "elements.jsonl"
+    write_jsonlines(path, [{"id": i} for i in range(10)])
+    for n_shards in (1, 2, 3, 100):
+        ranges = _jsonlines_ranges(path, n_shards)
+        assert ranges[0][0] == 0
+        assert ranges[-1][1] == path.stat().st_size
+        for (_, end), (start, _) in zip(ranges, ranges[1:]):
+            assert end == start
+        contents = path.read_bytes()
+        for start, _ in ranges:
+            assert start == 0 or contents[start - 1 : start] == b"\n"
+
+
+def test_read_jsonlines_binary_streaming(tmp_path: Path):
+    path = tmp_path / "elements.jsonl"
+    path.write_bytes(b'{"id": 1}\n\n  \n{"id": "\xc3\xa9"}\r\n{"id": 3}')
+    expected = [{"id": 1}, {"id": "é"}, {"id": 3}]
+    assert expected == read_jsonlines(path)
+    assert expected == read_jsonlines(path, use_mmap=True)
+    assert expected == list(read_jsonlines(path, lazy=True, use_mmap=True))
+
+    with open(path, "rb") as f:
+        lines = [line for chunk in _iter_file_lines(f, chunk_size=3) for line in chunk]
+    assert [b'{"id": 1}', b'{"id": "\xc3\xa9"}\r', b'{"id": 3}'] == lines
+    with open(path, "rb") as f:
+        lines = [line for chunk in _iter_mmap_lines(f, chunk_size=3) for line in chunk]
+    assert [b'{"id": 1}', b'{"id": "\xc3\xa9"}\r', b'{"id": 3}'] == lines
+
+
+def test_read_jsonlines_batches(tmp_path: Path):
+    elements = [{"id": i} for i in range(5)]
+    write_jsonlines(tmp_path / "elements.jsonl", elements)
+    batches = read_jsonlines(tmp_path / "elements.jsonl", batch_size=2)
+    assert [elements[0:2], elements[2:4], elements[4:]] == batches
+
+    lazy_batches = read_jsonlines(tmp_path / "elements.jsonl", lazy=True, batch_size=2)
+    assert isinstance(lazy_batches, types.GeneratorType)
+    assert [elements[0:2], elements[2:4], elements[4:]] == list(lazy_batches)
+
+
+def test_read_jsonlines_fields(tmp_path: Path):
+    elements = [
+        {"id": 1, "meta": {"tags": ["a", "b"], "x/y": 2}, "text": "hello"},
+        {"id": 2, "meta": {"tags": []}, "text": "world"},
+    ]
+    write_jsonlines(tmp_path / "elements.jsonl", elements)
+    fields = ["id", "meta.tags", "meta.tags.0", "/meta/x~1y", "missing"]
+    expected = [project(e, fields) for e in elements]
+    assert expected == [
+        {
+            "id": 1,
+            "meta.tags": ["a", "b"],
+            "meta.tags.0": "a",
+            "/meta/x~1y": 2,
+            "missing": None,
+        },
+        {
+            "id": 2,
+            "meta.tags": [],
+            "meta.tags.0": None,
+            "/meta/x~1y": None,
+            "missing": None,
+        },
+    ]
+    assert expected == read_jsonlines(tmp_path / "elements.jsonl", fields=fields)
+    assert expected == list(
+        read_jsonlines(tmp_path / "elements.jsonl", lazy=True, fields=fields)
+    )
+    assert expected == read_jsonlines(
+        tmp_path / "elements.jsonl", workers=2, fields=fields
+    )
+
+    # Lines whose root is not an object have no fields, except array indices
+    others = [3, "text", None, [{"id": 4}]]
+    write_jsonlines(tmp_path / "others.jsonl", others)
+    assert [project(e, ["id", "0.id"]) for e in others] == read_jsonlines(
+        tmp_path / "others.jsonl", fields=["id", "0.id"]
+    )
+
+
+def test_get_path():
+    obj = {"a": {"b": [1, {"c": 2}]}}
+    assert 2 == get_path(obj, "a.b.1.c")
+    assert 2 == get_path(obj, "/a/b/1/c")
+    assert obj == get_path(obj, "")
+    assert get_path(obj, "a.b.5") is None
+    assert "default" == get_path(obj, "a.b.0.c", default="default")
+
+
+@pytest.mark.parametrize("extension", [".gz", ".bz2", ".xz", ".zst"])
+def test_compressed_jsonlines(tmp_path: Path, extension: str):
+    if extension == ".zst":
+        pytest.importorskip("zstandard")
+    elements = [{"id": i} for i in range(100)]
+    path = tmp_path / f"elements.jsonl{extension}"
+    write_jsonlines(path, elements, compresslevel=1)
+    assert detect_compression(path) == COMPRESSION_EXTENSIONS[extension]
+    with open(path, "rb") as f:
+        assert f.read(1) != b"{"
+
+    assert elements == read_jsonlines(path)
+    lazy_elements = read_jsonlines(path, lazy=True)
+    assert isinstance(lazy_elements, types.GeneratorType)
+    assert elements == list(lazy_elements)
+    assert elements == read_jsonlines(path, workers=2)
+
+    write_json(path.with_suffix(".json" + extension), {"elements": elements})
+    assert {"elements": elements} == read_json(path.with_suffix(".json" + extension))
+
+
+def test_detect_compression_magic(tmp_path: Path):
+    path = tmp_path / "elements.jsonl.gz"
+    write_jsonlines(path, [{"id": 1}])
+    renamed = path.rename(tmp_path / "elements.data")
+    assert detect_compression(renamed) == "gzip"
+    assert [{"id": 1}] == read_jsonlines(renamed)
+    assert detect_compression(tmp_path / "plain.jsonl") is None
+
+
+def test_write_jsonlines_iterable(tmp_path: Path):
+    path = tmp_path / "elements.jsonl"
+    write_jsonlines(path, ({"id": i, "text": JsonTest(text=str(i))} for i in range(3)))
+    assert [{"id": i, "text": {"text": str(i)}} for i in range(3)] == read_jsonlines(
+        path
+    )
+
+    write_jsonlines(path, [JsonTest(text="hello"), {1: 2**70}])
+    lines = path.read_text().splitlines()
+    assert [{"text": "hello"}, {"1": 2**70}] == [json.loads(line) for line in lines]
+
+    # Non-finite floats are written like the standard library does, not as null
+    write_jsonlines(path, [{"x": float("nan")}, {"x": [None, float("-inf")]}])
+    assert ['{"x":NaN}', '{"x":[null,-Infinity]}'] == path.read_text().splitlines()
+
+
+def test_dumps_jsonline_without_orjson(monkeypatch):
+    obj = {"id": 1, "text": "café", "scores": [0.5, None], "model": JsonTest(text="a")}
+    with_orjson = dumps_jsonline(obj)
+    monkeypatch.setattr(pedroai.io, "orjson", None)
+    assert with_orjson == dumps_jsonline(obj)
+
+
+def test_jsonl_writer(tmp_path: Path):
+    path = tmp_path / "elements.jsonl.gz"
+    with JsonlWriter(path, buffer_size=16) as writer:
+        for i in range(10):
+            writer.write({"id": i})
+        writer.write_all({"id": i} for i in range(10, 20))
+        assert writer.count == 20
+    assert [{"id": i} for i in range(20)] == read_jsonlines(path)
+
+
+def test_atomic_write(tmp_path: Path):
+    path = tmp_path / "elements.jsonl.gz"
+    write_jsonlines(path, [{"id": 1}], atomic=True)
+    assert [{"id": 1}] == read_jsonlines(path)
+
+    def failing_elements():
+        yield {"id": 2}
+        raise RuntimeError("preempted")
+
+    with pytest.raises(RuntimeError):
+        write_jsonlines(path, failing_elements(), atomic=True)
+    assert [{"id": 1}] == read_jsonlines(path)
+    assert [path] == list(tmp_path.iterdir())
+
+    write_json(tmp_path / "obj.json", {"id": 3}, atomic=True)
+    assert {"id": 3} == read_json(tmp_path / "obj.json")
+
+
+@pytest.mark.parametrize("name", ["elements.jsonl", "elements.jsonl.gz"])
+def test_jsonl_writer_append_checkpoints(tmp_path: Path, name: str):
+    path = tmp_path / name
+    with JsonlWriter(path, append=True) as writer:
+        writer.write({"id": 0})
+    writer = JsonlWriter(path, append=True)
+    writer.write({"id": 1})
+    writer.checkpoint()
+    writer.write({"id": 2})
+    writer.flush()
+    # Simulate the process dying before the next checkpoint
+    assert writer._raw is not None  # pylint: disable=protected-access
+    writer._raw.close()  # pylint: disable=protected-access
+
+    with JsonlWriter(path, append=True) as writer:
+        writer.write({"id": 3})
+    assert [{"id": 0}, {"id": 1}, {"id": 3}] == read_jsonlines(path)
+    assert [path] == list(tmp_path.iterdir())
+
+
+def test_jsonl_index(tmp_path: Path):
+    path = tmp_path / "elements.jsonl"
+    elements = [{"id": i} for i in range(10)]
+    write_jsonlines(path, elements)
+    with open(path, "a") as f:
+        f.write('\n{"id": 10}')
+    elements.append({"id": 10})
+
+    with JsonlIndex(path) as index:
+        assert len(elements) == len(index)
+        assert elements[3] == index[3]
+        assert elements[-1] == index[-1]
+        assert elements[2:8:2] == index[2:8:2]
+        assert elements == list(index)
+        sample = index.sample(5, seed=0)
+        assert 5 == len({e["id"] for e in sample})
+        shards = [list(index.shard(i, 3)) for i in range(3)]
+        assert elements == shards[0] + shards[1] + shards[2]
+        with pytest.raises(IndexError):
+            index[len(elements)]
+    assert (tmp_path / "elements.jsonl.idx.npy").exists()
+
+    write_jsonlines(path, elements[:4])
+    with JsonlIndex(path) as index:
+        assert elements[:4] == list(index)
+
+    # Whitespace-only lines are skipped, and an unwritable index stays in memory
+    with open(path, "a") as f:
+        f.write('  \n\t\r\n {"id": 4}\n \n')
+    index_path = tmp_path / "missing" / "elements.idx.npy"
+    with JsonlIndex(path, index_path=index_path) as index:
+        assert elements[:5] == list(index)
+        assert elements[4] == index[-1]
+    assert not index_path.exists()
+
+
+def test_column_store(tmp_path: Path):
+    elements = [
+        {"id": 0, "score": 1, "text": "héllo", "tags": ["a"], "a.b": True},
+        {"id": 1, "score": 2.5, "text": None, "tags": [], "a.b": False},
+        {"id": 2, "score": 3, "tags": {"x": 1}, "extra": "late"},
+    ]
+    write_jsonlines(tmp_path / "elements.jsonl", elements)
+    convert_jsonl_to_columns(tmp_path / "elements.jsonl", tmp_path / "columns")
+    store = ColumnStore(tmp_path / "columns")
+
+    assert 3 == len(store)
+    assert ["id", "score", "text", "tags", "a.b", "extra"] == store.columns
+    assert store["id"].dtype == np.int64
+    assert [0, 1, 2] == store["id"].tolist()
+    assert [1.0, 2.5, 3.0] == store["score"].tolist()
+    assert ["héllo", None, None] == store["text"].to_list()
+    assert [["a"], [], {"x": 1}] == store["tags"].to_list()
+    assert [True, False, False] == store["a.b"].tolist()
+    valid = store.valid("a.b")
+    assert valid is not None
+    assert [True, True, False] == valid.tolist()
+    assert [None, None, "late"] == store["extra"].to_list()
+    assert store.valid("id") is None
+
+    rows = store.read(["id", "text"], start=1)
+    assert [1, 2] == rows["id"].tolist()
+    assert [None, None] == rows["text"].to_list()
+    assert "héllo" == store["text"][:1][0]
+
+    convert_jsonl_to_columns(
+        tmp_path / "elements.jsonl", tmp_path / "projected", columns=["tags.0", "id"]
+    )
+    projected = ColumnStore(tmp_path / "projected")
+    assert ["a", None, None] == projected["tags.0"].to_list()
+    assert [0, 1, 2] == projected["id"].tolist()
+
+
+def test_parse_cache(tmp_path: Path, monkeypatch):
+    cache = ParseCache(tmp_path / "cache", memory_budget=1 << 20)
+    monkeypatch.setattr(pedroai.io, "parse_cache", cache)
+    path = tmp_path / "elements.jsonl"
+    write_jsonlines(path, [{"id": 1}])
+
+    assert [{"id": 1}] == read_jsonlines(path, cache=True)
+    assert 1 == len(list((tmp_path / "cache").glob("*/*.pkl")))
+    # Unordered reads may return a different order, so they are cached separately
+    assert [{"id": 1}] == read_jsonlines(path, cache=True, ordered=False)
+    assert 2 == len(list((tmp_path / "cache").glob("*/*.pkl")))
+
+    parses = []
+    monkeypatch.setattr(
+        pedroai.io, "_read_jsonlines_list", lambda *args, **kwargs: parses.append(1)
+    )
+    cached = read_jsonlines(path, cache=True)
+    assert [{"id": 1}] == cached
+    cached.append({"id": 2})
+    cache.clear(disk=False)
+    assert [{"id": 1}] == read_jsonlines(path, cache=True, content_hash=False)
+    assert not parses
+
+    with pytest.raises(ValueError):
+        read_jsonlines(path, lazy=True, cache=True)
+
+    write_json(tmp_path / "obj.json", {"id": 3})
+    assert {"id": 3} == read_json(tmp_path / "obj.json", cache=True, content_hash=True)
+    assert {"id": 3} == read_json(tmp_path / "obj.json", cache=True, content_hash=True)
+
+
+def test_download(tmp_path: Path, http_server):
+    data = bytes(range(256)) * 1000
+    (http_server.root / "data.bin").write_bytes(data)
+    local_path = tmp_path / "downloads" / "data.bin"
+
+    progress = []
+    size = download(
+        http_server.url("data.bin"),
+        local_path,
+        chunk_size=4096,
+        progress=False,
+        callback=lambda downloaded, total: progress.append((downloaded, total)),
+    )
+    assert len(data) == size
+    assert data == local_path.read_bytes()
+    assert (len(data), len(data)) == progress[-1]
+
+
+def test_download_resume(tmp_path: Path, http_server):
+    data = bytes(range(256)) * 1000
+    (http_server.root / "data.bin").write_bytes(data)
+    local_path = tmp_path / "data.bin"
+    (tmp_path / "data.bin.part").write_bytes(data[:1000])
+
+    download(http_server.url("data.bin"), local_path, progress=False)
+    assert data == local_path.read_bytes()
+    assert not (tmp_path / "data.bin.part").exists()
+    assert ("GET", "data.bin", "bytes=1000-") == http_server.requests[-1]
+
+    http_server.supports_range = False
+    (tmp_path / "data.bin.part").write_bytes(b"garbage")
+    download(http_server.url("data.bin"), local_path, progress=False)
+    assert data == local_path.read_bytes()
+
+
+def test_download_segmented(tmp_path: Path, http_server):
+    data = os.urandom(3 * SEGMENT_MIN_SIZE + 12345)
+    (http_server.root / "data.bin").write_bytes(data)
+    local_path = tmp_path / "data.bin"
+
+    hasher = hashlib.sha256()
+    size = download(
+        http_server.url("data.bin"),
+        local_path,
+        progress=False,
+        segments=8,
+        hasher=hasher,
+    )
+    assert len(data) == size
+    assert data == local_path.read_bytes()
+    assert hashlib.sha256(data).hexdigest() == hasher.hexdigest()
+    ranges = sorted(r for method, _, r in http_server.requests if method == "GET")
+    assert 3 == len(ranges)
+    assert not (tmp_path / "data.bin.part.segments").exists()
+
+    # An interrupted segmented download resumes each range where it stopped
+    local_path.unlink()
+    first = len(data) // 3
+    part = bytearray(len(data))
+    part[:1000] = data[:1000]
+    (tmp_path / "data.bin.part").write_bytes(bytes(part))
+    segments = [[0, first, 1000], [first, 2 * first, 0], [2 * first, len(data), 0]]
+    write_json(
+        tmp_path / "data.bin.part.segments", {"size": len(data), "segments": segments}
+    )
+    http_server.requests.clear()
+    download(http_server.url("data.bin"), local_path, progress=False, segments=3)
+    assert data == local_path.read_bytes()
+    assert f"bytes=1000-{first - 1}" in [r for _, _, r in http_server.requests]
+
+    # Without range support the file is downloaded in one request
+    http_server.supports_range = False
+    local_path.unlink()
+    download(http_server.url("data.bin"), local_path, progress=False, segments=3)
+    assert data == local_path.read_bytes()
+
+    # Servers that reject HEAD fall back to downloading in one request
+    http_server.supports_range = True
+    http_server.head_status = 405
+    local_path.unlink()
+    download(http_server.url("data.bin"), local_path, progress=False, segments=3)
+    assert data == local_path.read_bytes()
@@ -1,4 +1,4 @@
-from pedroai.iter import group_by
+from pedroai.iter import batched, group_by
 
 
 def test_group_by():
@@ -6,3 +6,8 @@ def test_group_by():
     grouped = group_by(lambda x: x % 2 == 0, items)
     assert [1, 3, 5] == sorted(grouped[False])
     assert [2, 4, 6] == sorted(grouped[True])
+
+
+def test_batched():
+    assert [[1, 2], [3, 4], [5]] == list(batched([1, 2, 3, 4, 5], 2))
+    assert [] == list(batched([], 2))
@@ -0,0 +1,244 @@
+import os
+import subprocess
+from pathlib import Path
+
+import pytest
+
+from pedroai.snapshot import (
+    BatchError,
+    collect_garbage,
+    copy_file,
+    latest_snapshot,
+    list_files,
+    main,
+    manifest_path,
+    materialize,
+    store_snapshot,
+    sync_tree,
+    write_array_script,
+)
+
+
+def _make_tree(root: Path):
+    (root / "pkg").mkdir(parents=True)
+    (root / "pkg" / "model.py").write_text("model")
+    (root / "train.py").write_text("train")
+    (root / "outputs").mkdir()
+    (root / "outputs" / "big.bin").write_text("ignored")
+
+
+def test_sync_tree(tmp_path: Path):
+    source = tmp_path / "source"
+    _make_tree(source)
+    first = tmp_path / "snapshots" / "experiment_1"
+
+    stats = sync_tree(str(source), str(first), ["outputs"])
+    assert (2, 0) == (stats.copied, stats.linked)
+    assert "model" == (first / "pkg" / "model.py").read_text()
+    assert not (first / "outputs").exists()
+
+    # Unchanged files are hardlinked from the previous snapshot
+    (source / "train.py").write_text("train v2")
+    second = tmp_path / "snapshots" / "experiment_2"
+    stats = sync_tree(str(source), str(second), ["outputs"], link_dest=str(first))
+    assert (1, 1) == (stats.copied, stats.linked)
+    assert os.path.samefile(first / "pkg" / "model.py", second / "pkg" / "model.py")
+    assert "train v2" == (second / "train.py").read_text()
+    assert "train" == (first / "train.py").read_text()
+    assert second == latest_snapshot(str(tmp_path / "snapshots"))
+
+    # Syncing an existing snapshot keeps unchanged files and removes stale ones
+    (source / "pkg" / "model.py").write_text("model v2")
+    (source / "train.py").unlink()
+    stats = sync_tree(str(source), str(second), ["outputs"], link_dest=str(first))
+    assert (1, 1, 0) == (stats.copied, stats.removed, stats.unchanged)
+    assert not (second / "train.py").exists()
+    assert "model v2" == (second / "pkg" / "model.py").read_text()
+    # Replacing a hardlinked file does not change the previous snapshot
+    assert "model" == (first / "pkg" / "model.py").read_text()
+
+    stats = sync_tree(str(source), str(second), ["outputs"], link_mode="reflink")
+    assert 1 == stats.unchanged
+
+
+def test_list_files_gitignore(tmp_path: Path):
+    repo = tmp_path / "repo"
+    _make_tree(repo)
+    (repo / ".venv" / "lib").mkdir(parents=True)
+    (repo / ".venv" / "lib" / "site.py").write_text("venv")
+    (repo / "data.bin").write_text("data")
+    (repo / ".gitignore").write_text(".venv/\n*.bin\n")
+    subprocess.run(["git", "init", "-q"], cwd=repo, check=True)
+    subprocess.run(["git", "add", "train.py"], cwd=repo, check=True)
+
+    expected = [".gitignore", os.path.join("pkg", "model.py"), "train.py"]
+    files = list_files(str(repo), ["outputs"], gitignore=True, workers=2)
+    assert expected == sorted(files)
+    assert 5 == files["train.py"].st_size
+    assert 5 == len(list_files(str(repo), ["outputs", ".git"], gitignore=False))
+
+    stats = sync_tree(
+        str(repo), str(tmp_path / "snapshot"), ["outputs"], gitignore=True
+    )
+    assert (3, 3) == (stats.files, stats.copied)
+    # Outside of a git repository every file is listed
+    assert 3 == len(list_files(str(tmp_path / "snapshot"), [], gitignore=True))
+
+    # Ignored files in a reused snapshot are kept, other stale files are removed
+    (tmp_path / "snapshot" / "results.bin").write_text("results")
+    (repo / "pkg" / "model.py").unlink()
+    stats = sync_tree(
+        str(repo), str(tmp_path / "snapshot"), ["outputs"], gitignore=True
+    )
+    assert 1 == stats.removed
+    assert (tmp_path / "snapshot" / "results.bin").exists()
+    assert not (tmp_path / "snapshot" / "pkg").exists()
+
+    # The same goes for snapshots materialized from the store
+    store = str(tmp_path / "store")
+    store_snapshot(str(repo), store, "1", ["outputs"], gitignore=True)
+    materialize(store, "1", str(tmp_path / "restored"))
+    (tmp_path / "restored" / "results.bin").write_text("results")
+    assert 0 == materialize(store, "1", str(tmp_path / "restored")).removed
+    assert (tmp_path / "restored" / "results.bin").exists()
+
+
+def test_copy_file(tmp_path: Path):
+    data = os.urandom(3 * 2**20 + 7)
+    (tmp_path / "source").write_bytes(data)
+    os.chmod(tmp_path / "source", 0o755)
+    os.utime(tmp_path / "source", ns=(10**18, 10**18))
+    copy_file(str(tmp_path / "source"), str(tmp_path / "target"))
+    assert data == (tmp_path / "target").read_bytes()
+    target = os.stat(tmp_path / "target")
+    assert (0o755, 10**18) == (target.st_mode & 0o777, target.st_mtime_ns)
+
+
+def test_store_snapshot(tmp_path: Path):
+    source = tmp_path / "source"
+    _make_tree(source)
+    (source / "run.sh").write_text("train")
+    os.chmod(source / "run.sh", 0o755)
+    store = str(tmp_path / "store")
+
+    manifest, stats = store_snapshot(str(source), store, "1", ["outputs"])
+    # train.py and run.sh have the same contents but a different mode
+    assert (3, 3, 0) == (stats.files, stats.copied, stats.unchanged)
+    assert {"pkg/model.py", "train.py", "run.sh"} == set(manifest["files"])
+
+    (source / "train.py").write_text("train v2")
+    _, stats = store_snapshot(str(source), store, "2", ["outputs"])
+    assert (1, 2) == (stats.copied, stats.unchanged)
+
+    # New files with contents the store already has are not stored again
+    (source / "copy.py").write_text("model")
+    _, stats = store_snapshot(str(source), store, "3", ["outputs"])
+    assert (0, 4) == (stats.copied, stats.unchanged)
+    assert [] == os.listdir(os.path.join(store, "objects", "tmp"))
+    os.remove(source / "copy.py")
+
+    target = tmp_path / "restored"
+    stats = materialize(store, "1", str(target))
+    assert 3 == stats.linked
+    assert "train" == (target / "train.py").read_text()
+    assert os.access(target / "run.sh", os.X_OK)
+    assert not os.access(target / "train.py", os.X_OK)
+
+    # Materializing over an existing tree only replaces files that differ
+    # and removes stale files, but not the excluded ones
+    (target / "stale.txt").write_text("stale")
+    (target / "outputs").mkdir()
+    (target / "outputs" / "ckpt.pt").write_text("checkpoint")
+    stats = materialize(store, "2", str(target))
+    assert (1, 2, 1) == (stats.linked, stats.unchanged, stats.removed)
+    assert "train v2" == (target / "train.py").read_text()
+    assert not (target / "stale.txt").exists()
+    assert (target / "outputs" / "ckpt.pt").exists()
+
+    assert (0, 0) == collect_garbage(store, min_age=0)
+    os.remove(manifest_path(store, "1"))
+    assert (1, 5) == collect_garbage(store, min_age=0)
+    assert "model" == (target / "pkg" / "model.py").read_text()
+
+
+def test_batch_commands(tmp_path: Path, monkeypatch):
+    source = tmp_path / "source"
+    _make_tree(source)
+    commands = tmp_path / "commands.txt"
+    commands.write_text(
+        "# one task per line\n"
+        "mkdir -p outputs && echo $SNAPSHOT_EXPERIMENT_ID $SNAPSHOT_TASK_ID > outputs/task_a.txt\n"
+        "\n"
+        "mkdir -p outputs && echo $SNAPSHOT_TASK_ID $SNAPSHOT_TASK_COUNT > outputs/task_b.txt\n"
+    )
+    base_dir = tmp_path / "snapshots"
+    monkeypatch.chdir(source)
+    main(
+        None,
+        base_dir=str(base_dir),
+        experiment_id="7",
+        commands_file=str(commands),
+        max_parallel=2,
+        incremental=True,
+    )
+    outputs = base_dir / "experiment_7" / "outputs"
+    assert "7 0\n" == (outputs / "task_a.txt").read_text()
+    assert "1 2\n" == (outputs / "task_b.txt").read_text()
+    assert (base_dir / "logs" / "experiment_7" / "task_1.log").exists()
+
+    # Outputs are excluded, so syncing the snapshot again keeps them
+    monkeypatch.chdir(source)
+    commands.write_text("exit 3\ntrue\n")
+    with pytest.raises(BatchError, match="tasks: 0"):
+        main(
+            None,
+            base_dir=str(base_dir),
+            experiment_id="7",
+            commands_file=str(commands),
+            incremental=True,
+        )
+    assert (outputs / "task_a.txt").exists()
+
+
+def test_batch_commands_relative_base_dir(tmp_path: Path, monkeypatch):
+    source = tmp_path / "source"
+    _make_tree(source)
+    commands = tmp_path / "commands.txt"
+    commands.write_text("true\n")
+    monkeypatch.chdir(source)
+    main(
+        None,
+        base_dir="../snapshots",
+        experiment_id="8",
+        commands_file=str(commands),
+        slurm_array=True,
+    )
+    log_dir = tmp_path / "snapshots" / "logs" / "experiment_8"
+    assert (log_dir / "array.sbatch").exists()
+    assert not (tmp_path / "snapshots" / "experiment_8" / "snapshots").exists()
+
+
+def test_write_array_script(tmp_path: Path):
+    commands = ["python train.py --lr 0.1", "python train.py --name 'a b'"]
+    script_path = write_array_script(
+        commands,
+        str(tmp_path / "experiment_3"),
+        tmp_path / "logs",
+        "3",
+        max_parallel=4,
+        sbatch_options=["--partition=dev"],
+    )
+    script = script_path.read_text()
+    assert "#SBATCH --array=0-1%4\n" in script
+    assert "#SBATCH --partition=dev\n" in script
+
+    # Run the script as the second array task
+    (tmp_path / "experiment_3").mkdir()
+    script = script.replace("eval", "echo $SNAPSHOT_TASK_ID $SNAPSHOT_TASK_COUNT;echo")
+    result = subprocess.run(
+        ["bash", "-c", script],
+        env={**os.environ, "SLURM_ARRAY_TASK_ID": "1"},
+        stdout=subprocess.PIPE,
+        check=True,
+    )
+    assert "1 2\npython train.py --name 'a b'\n" == result.stdout.decode()